@@ -11,6 +11,10 @@ import pandas as pd
 from os.path import basename, isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import print_message
+from routine_qiime2_analyses._routine_q2_pool import run_pool
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_dag import dag_planning
+from routine_qiime2_analyses._routine_q2_runs import is_planned
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -21,7 +25,8 @@ from routine_qiime2_analyses._routine_q2_io_utils import (
 )
 from routine_qiime2_analyses._routine_q2_metadata import (
     check_metadata_cases_dict,
-    check_metadata_formulas
+    check_metadata_formulas,
+    write_case_meta
 )
 from routine_qiime2_analyses._routine_q2_cmds import (
     get_new_meta_pd, get_case,
@@ -61,8 +66,8 @@ def run_single_adonis(odir: str, subset: str, case_vals_list: list, metric: str,
             new_qzv = '%s_adonis.qzv' % cur_rad
             new_mat_qza = '%s/%s' % (odir, basename(mat_qza).replace('.qza', '_%s.qza' % case))
             new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
-            new_meta_pd.reset_index().to_csv(new_meta, index=False, sep='\t')
-            if force or not isfile(new_qzv):
+            new_meta = write_case_meta(new_meta, new_meta_pd)
+            if is_stale(force, new_qzv, (new_meta, mat_qza), (formula,)):
                 write_diversity_adonis(new_meta, mat_qza, new_mat_qza,
                                        formula, new_qzv, cur_sh_o)
                 remove = False
@@ -97,6 +102,7 @@ def run_adonis(p_formulas: str, i_datasets_folder: str, betas: dict,
 
     metric_check = set()
     all_sh_pbs = {}
+    adonis_tasks = []
     first_print = 0
 
     for dat, metric_groups_metas_qzas_dms_trees_ in betas.items():
@@ -113,7 +119,7 @@ def run_adonis(p_formulas: str, i_datasets_folder: str, betas: dict,
 
                 for subset, metas_qzas_mat_qzas_trees in subset_files.items():
                     for meta, qza, mat_qza, tree in metas_qzas_mat_qzas_trees:
-                        if not isfile(mat_qza):
+                        if not isfile(mat_qza) and not (dag_planning() and is_planned(mat_qza)):
                             if not first_print:
                                 print('Beta diversity, distances matrices must be generated already to automatise PERMANOVA\n'
                                       '\t(re-run this after steps "2_run_beta.sh" and "2x_run_beta_export.pbs" are done)')
@@ -134,8 +140,9 @@ def run_adonis(p_formulas: str, i_datasets_folder: str, betas: dict,
                                     job_folder2, dat, cur_depth, metric, fdx, cdx, filt_raref)
                                 cur_sh = cur_sh.replace(' ', '-')
                                 all_sh_pbs.setdefault((dat, out_sh), []).append(cur_sh)
-                                run_single_adonis(odir, subset, case_vals_list, metric, case_var,
-                                                  form, formula, qza, mat_qza, meta_pd, cur_sh, force)
+                                adonis_tasks.append((odir, subset, case_vals_list, metric, case_var,
+                                                     form, formula, qza, mat_qza, meta_pd, cur_sh, force))
+    run_pool(run_single_adonis, adonis_tasks, [x[10] for x in adonis_tasks])
 
     job_folder = get_job_folder(i_datasets_folder, 'adonis')
     main_sh = write_main_sh(job_folder, '3_run_adonis_%s%s' % (prjct_nm, filt_raref), all_sh_pbs,
@@ -8,16 +8,17 @@
 
 import os, sys
 import pandas as pd
-import multiprocessing
 from os.path import basename, isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_pool import run_pool
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_metrics, get_job_folder, get_analysis_folder,
     write_main_sh, get_main_cases_dict, read_meta_pd,
-    read_yaml_file, get_raref_tab_meta_pds, simple_chunks
+    read_yaml_file, get_raref_tab_meta_pds, get_read_pds, simple_chunks
 )
-from routine_qiime2_analyses._routine_q2_metadata import check_metadata_cases_dict
+from routine_qiime2_analyses._routine_q2_metadata import check_metadata_cases_dict, write_case_meta
 from routine_qiime2_analyses._routine_q2_cmds import (
     get_case, write_alpha_group_significance_cmd,
     get_new_meta_pd, get_new_alpha_div, write_metadata_tabulate,
@@ -61,6 +62,7 @@ def run_alpha(i_datasets_folder: str, datasets: dict, datasets_read: dict,
     run_pbs = '%s/1_run_alpha_%s%s%s.sh' % (job_folder, prjct_nm, evaluation, filt_raref)
     main_written = 0
     to_chunk = []
+    sizes = {}
     with open(run_pbs, 'w') as o:
         for dat, tsv_meta_pds_ in datasets.items():
             written = 0
@@ -75,9 +77,10 @@ def run_alpha(i_datasets_folder: str, datasets: dict, datasets_read: dict,
                             print('Must have run rarefaction to use it further...\nExiting')
                             sys.exit(0)
                         tsv_pd, meta_pd = get_raref_tab_meta_pds(meta, tsv)
-                        datasets_read[dat][idx] = [tsv_pd, meta_pd]
+                        datasets_read[dat][idx] = [tsv, meta]
                     else:
-                        tsv_pd, meta_pd = datasets_read[dat][idx]
+                        tsv_pd, meta_pd = get_read_pds(datasets_read[dat][idx])
+                    sizes[out_sh] = max(sizes.get(out_sh, 0), tsv_pd.shape[0] * tsv_pd.shape[1])
                     cur_raref = datasets_rarefs[dat][idx]
                     qza = '%s.qza' % splitext(tsv)[0]
                     divs = {}
@@ -85,7 +88,7 @@ def run_alpha(i_datasets_folder: str, datasets: dict, datasets_read: dict,
                         odir = get_analysis_folder(i_datasets_folder, 'alpha/%s%s' % (dat, cur_raref))
                         out_fp = '%s/%s_%s.qza' % (odir, basename(splitext(qza)[0]), metric)
                         out_tsv = '%s.tsv' % splitext(out_fp)[0]
-                        if force or not isfile(out_fp):
+                        if is_stale(force, out_fp, (qza,), (metric, datasets_phylo[dat], trees.get(dat))):
                             ret_continue = write_diversity_alpha(out_fp, datasets_phylo, trees,
                                                                  dat, qza, metric, cur_sh)
                             if ret_continue:
@@ -105,13 +108,13 @@ def run_alpha(i_datasets_folder: str, datasets: dict, datasets_read: dict,
                             else:
                                 qza_subset_ = '%s/%s_%s_noDropout.qza' % (odir, basename(splitext(qza)[0]),  subset)
                             feats_subset = '%s.meta' % splitext(qza_subset_)[0]
-                            feats = get_subset(tsv_pd, subset_regex)
+                            feats = get_subset(tsv_pd, subset_regex, tsv)
                             if not len(feats):
                                 continue
                             subset_pd = pd.DataFrame({'Feature ID': feats, 'Subset': [subset]*len(feats)})
                             subset_pd.to_csv(feats_subset, index=False, sep='\t')
                             write_filter_features(tsv_pd, feats, qza, qza_subset_,
-                                                  feats_subset, cur_sh, dropout)
+                                                  feats_subset, cur_sh, dropout, not isfile(tsv))
                             for metric in alpha_metrics:
 
                                 if metric in ['faith_pd'] and datasets_phylo[dat][1] and dat in trees:
@@ -130,7 +133,7 @@ def run_alpha(i_datasets_folder: str, datasets: dict, datasets_read: dict,
                                 out_fp = '%s/%s__%s.qza' % (odir, basename(splitext(qza_subset)[0]), metric)
                                 out_tsv = '%s.tsv' % splitext(out_fp)[0]
 
-                                if force or not isfile(out_fp):
+                                if is_stale(force, out_fp, (qza_subset, feats_subset), (metric,)):
                                     ret_continue = write_diversity_alpha(out_fp, {dat: [1, 0]}, trees,
                                                                          dat, qza_subset, metric, cur_sh)
                                     if ret_continue:
@@ -153,7 +156,7 @@ def run_alpha(i_datasets_folder: str, datasets: dict, datasets_read: dict,
         simple_chunks(run_pbs, job_folder2, to_chunk, 'alpha',
                       prjct_nm, run_params["time"], run_params["n_nodes"], run_params["n_procs"],
                       run_params["mem_num"], run_params["mem_dim"],
-                      qiime_env, chmod, noloc, jobs, chunkit, None)
+                      qiime_env, chmod, noloc, jobs, chunkit, None, sizes)
 
     if main_written:
         print_message('# Calculate alpha diversity indices', 'sh', run_pbs, jobs)
@@ -221,7 +224,7 @@ def merge_meta_alpha(i_datasets_folder: str, datasets: dict, datasets_rarefs: di
                             if len(indices) < len(divs_alphas):
                                 force = True
                         to_export_groups.append(out_fp_tsv)
-                        if force or not isfile(out_fp):
+                        if is_stale(force, out_fp, tuple([meta] + [x[0] for x in divs])):
                             write_metadata_tabulate(out_fp, divs, meta, cur_sh)
                             cmd = run_export(out_fp, out_fp_tsv, '')
                             cur_sh.write('echo "%s"\n' % cmd)
@@ -378,7 +381,7 @@ def run_correlations(i_datasets_folder: str, datasets: dict, diversities: dict,
                                 odir = get_analysis_folder(i_datasets_folder, 'alpha_correlations/%s%s' % (dat, cur_raref))
                             for qza in [x[0] for x in divs]:
                                 out_fp = '%s/alpha_corr_%s' % (odir, basename(qza).replace('.qza', '_%s.qzv' % method))
-                                if force or not isfile(out_fp):
+                                if is_stale(force, out_fp, (qza, meta), (method,)):
                                     write_diversity_alpha_correlation(out_fp, qza, method, meta, cur_sh)
                                     written += 1
                                     main_written += 1
@@ -448,7 +451,7 @@ def run_volatility(i_datasets_folder: str, datasets: dict, p_longi_column: str,
                         continue
                     odir = get_analysis_folder(i_datasets_folder, 'longitudinal/%s%s' % (dat, cur_raref))
                     out_fp = '%s/%s_volatility.qzv' % (odir, dat)
-                    if force or not isfile(out_fp):
+                    if is_stale(force, out_fp, (meta_alphas,), (time_point,)):
                         write_longitudinal_volatility(out_fp, meta_alphas, time_point, cur_sh)
                         written += 1
                         main_written += 1
@@ -491,10 +494,10 @@ def run_multi_kw(odir: str, meta_pd: pd.DataFrame, div_qza: str, case_vals_list:
             case = get_case(case_vals, case_var)
             cur_rad = odir + '/' + basename(div_qza).replace('.qza', '_%s' % case)
             new_qzv = '%s_kruskal-wallis.qzv' % cur_rad
-            if force or not isfile(new_qzv):
-                new_meta = '%s.meta' % cur_rad
-                new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
-                new_meta_pd.reset_index().to_csv(new_meta, index=False, sep='\t')
+            new_meta = '%s.meta' % cur_rad
+            new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
+            new_meta = write_case_meta(new_meta, new_meta_pd)
+            if is_stale(force, new_qzv, (div_qza, new_meta)):
                 new_div = get_new_alpha_div(case, div_qza, cur_rad, new_meta_pd, cur_sh_o)
                 write_alpha_group_significance_cmd(new_div, new_meta, new_qzv, cur_sh_o)
                 remove = False
@@ -525,7 +528,7 @@ def run_alpha_group_significance(i_datasets_folder: str, datasets: dict, diversi
     # alpha_metrics = get_metrics('alpha_metrics', As)
     main_cases_dict = get_main_cases_dict(p_perm_groups)
 
-    jobs = []
+    kw_tasks = []
     all_sh_pbs = {}
     first_print = 0
 
@@ -560,14 +563,9 @@ def run_alpha_group_significance(i_datasets_folder: str, datasets: dict, diversi
                         job_folder2, dat, cur_raref, metric, case_var, filt_raref)
                     cur_sh = cur_sh.replace(' ', '-')
                     all_sh_pbs.setdefault((dat, out_sh), []).append(cur_sh)
-                    p = multiprocessing.Process(
-                        target=run_multi_kw,
-                        args=(odir, meta_pd, qza, case_vals_list,
-                              case_var, cur_sh, force))
-                    p.start()
-                    jobs.append(p)
-    for j in jobs:
-        j.join()
+                    kw_tasks.append((odir, meta_pd, qza, case_vals_list,
+                                     case_var, cur_sh, force))
+    run_pool(run_multi_kw, kw_tasks, [x[5] for x in kw_tasks])
 
     job_folder = get_job_folder(i_datasets_folder, 'alpha_group_significance')
     main_sh = write_main_sh(job_folder, '6_run_alpha_group_significance_%s%s' % (filt_raref, prjct_nm), all_sh_pbs,
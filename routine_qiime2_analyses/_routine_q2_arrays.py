@@ -0,0 +1,113 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+from os.path import splitext
+
+from routine_qiime2_analyses._routine_q2_dag import add_dag_job
+from routine_qiime2_analyses._routine_q2_runs import record_script
+from routine_qiime2_analyses._routine_q2_registry import register_script
+from routine_qiime2_analyses._routine_q2_worker import worker_mode, write_worker_script
+from routine_qiime2_analyses._routine_q2_xpbs import write_pbs_batch, xpbs_call
+
+# array jobs state, only filled when the --arrays mode is active.
+ARRAYS = {'active': False, 'cap': 0}
+
+
+def init_arrays(cap: int = None) -> None:
+    """
+    Activate the writing of one Torque array job per analysis.
+
+    :param cap: maximum number of array tasks running at the same time.
+    """
+    ARRAYS['active'] = True
+    ARRAYS['cap'] = cap if cap else 0
+
+
+def arrays_mode() -> bool:
+    """
+    :return: whether the jobs are written as Torque array jobs.
+    """
+    return ARRAYS['active']
+
+
+def add_array_directive(out_pbs: str, n_tasks: int) -> None:
+    """
+    Add the array directive (#PBS -t 0-N%K) after the other Torque
+    directives of a job script.
+
+    :param out_pbs: torque script file.
+    :param n_tasks: number of array tasks.
+    """
+    directive = '#PBS -t 0-%s' % (n_tasks - 1)
+    if ARRAYS['cap']:
+        directive += '%%%s' % ARRAYS['cap']
+    with open(out_pbs) as f:
+        pbs_lines = [x for x in f if not x.startswith('#PBS -t ')]
+    last_directive = 0
+    for ldx, line in enumerate(pbs_lines):
+        if line.startswith('#PBS'):
+            last_directive = ldx + 1
+    if not last_directive and pbs_lines and pbs_lines[0].startswith('#!'):
+        last_directive = 1
+    pbs_lines.insert(last_directive, '%s\n' % directive)
+    with open(out_pbs, 'w') as pbs:
+        for line in pbs_lines:
+            pbs.write(line)
+
+
+def write_array_job(array_sh: str, scripts: list, job_name: str,
+                    qiime_env: str, time: str, n_nodes: str, n_procs: str,
+                    mem_num: str, mem_dim: str, chmod: str, noloc: bool,
+                    tmp: str = None) -> str:
+    """
+    Write a single Torque array job running the given bash scripts, one per
+    array task, together with the index file mapping the array IDs to them.
+
+    :param array_sh: bash script of the array job.
+    :param scripts: bash scripts to run as array tasks.
+    :param job_name: job name.
+    :param qiime_env: qiime2-xxxx.xx conda environment.
+    :param time: walltime in hours.
+    :param n_nodes: number of nodes to use.
+    :param n_procs: number of processors to use.
+    :param mem_num: memory in number.
+    :param mem_dim: memory dimension to the number.
+    :param chmod: whether to change permission of output files (defalt: 775).
+    :param noloc: whether to not use the scratch folder.
+    :return: the torque array job script to submit.
+    """
+    array_index = '%s.index' % splitext(array_sh)[0]
+    array_pbs = '%s.pbs' % splitext(array_sh)[0]
+    with open(array_index, 'w') as o:
+        for idx, script in enumerate(scripts):
+            register_script(script)
+            record_script(script, n_nodes, n_procs, mem_num, mem_dim, time)
+            if worker_mode():
+                write_worker_script(script)
+            if os.getcwd().startswith('/panfs'):
+                script_lines = open(script).readlines()
+                with open(script, 'w') as sh:
+                    for script_line in script_lines:
+                        sh.write(script_line.replace(os.getcwd(), ''))
+                script = script.replace(os.getcwd(), '')
+            o.write('%s\t%s\n' % (idx, script))
+    if os.getcwd().startswith('/panfs'):
+        array_index = array_index.replace(os.getcwd(), '')
+    with open(array_sh, 'w') as o:
+        o.write('script=$(awk -F"\\t" -v i="${PBS_ARRAYID}" \'$1 == i {print $2}\' %s)\n' % array_index)
+        o.write('echo "array task ${PBS_ARRAYID}: ${script}"\n')
+        o.write('sh ${script}\n')
+    xpbs_call(array_sh, array_pbs, job_name, qiime_env, time, n_nodes,
+              n_procs, mem_num, mem_dim, chmod, noloc, tmp)
+    write_pbs_batch()
+    add_array_directive(array_pbs, len(scripts))
+    if os.getcwd().startswith('/panfs'):
+        array_pbs = array_pbs.replace(os.getcwd(), '')
+    add_dag_job(array_pbs, True, scripts)
+    return array_pbs
@@ -8,9 +8,12 @@
 
 import os, sys
 import pandas as pd
+from typing import TextIO
 from os.path import basename, dirname, isfile, splitext, isdir
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_engines import beta_engine_mode
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_metrics,
     get_job_folder,
@@ -18,14 +21,18 @@ from routine_qiime2_analyses._routine_q2_io_utils import (
     get_main_cases_dict,
     read_yaml_file,
     get_raref_tab_meta_pds,
+    get_read_pds,
+    release_read_pds,
     simple_chunks
 )
 from routine_qiime2_analyses._routine_q2_metadata import (
-    check_metadata_cases_dict
+    check_metadata_cases_dict, write_case_meta
 )
 from routine_qiime2_analyses._routine_q2_cmds import (
     write_diversity_beta,
-    write_beta_subset,
+    write_diversity_beta_batch,
+    write_beta_subsets,
+    write_dm_store,
     write_qza_subset,
     write_diversity_pcoa,
     write_diversity_biplot,
@@ -33,6 +40,7 @@ from routine_qiime2_analyses._routine_q2_cmds import (
     write_empress,
     write_emperor_biplot,
     write_empress_biplot,
+    write_filter_features,
     get_subset,
     run_export,
     run_import,
@@ -41,11 +49,57 @@ from routine_qiime2_analyses._routine_q2_cmds import (
 )
 
 
+# non-phylogenetic metrics that the beta engine computes together
+BETA_BATCH_METRICS = {'braycurtis', 'jaccard', 'aitchison', 'euclidean', 'cityblock',
+                      'canberra', 'chebyshev', 'correlation', 'cosine', 'sqeuclidean'}
+
+
+def is_beta_batch(metric: str) -> bool:
+    """
+    :param metric: beta diversity metric.
+    :return: whether the metric is computed by the beta engine
+        (together with the other metrics of the same feature table).
+    """
+    return beta_engine_mode() and metric in BETA_BATCH_METRICS
+
+
+def write_beta_batch(metric: str, metrics: list, qza: str, out_fp: str,
+                     inputs: tuple, params: tuple, force: bool,
+                     cur_sh: TextIO, run_params: dict) -> dict:
+    """
+    Write the computation of a stale beta diversity metric together with
+    that of the next metrics of the same feature table that are also stale,
+    in a single command of the beta engine.
+
+    :param metric: stale beta diversity metric.
+    :param metrics: next beta diversity metrics of the feature table.
+    :param qza: feature table.
+    :param out_fp: distance matrix of the stale metric.
+    :param inputs: input files of the distance matrices.
+    :param params: parameters of the distance matrices (other than the metric).
+    :param force: Force the re-writing of scripts for all commands.
+    :param cur_sh: writing file handle.
+    :param run_params: run parameters.
+    :return: distance matrix per metric computed by the command.
+    """
+    batch = {metric: out_fp}
+    out_fp_root = out_fp[:-len('_%s_DM.qza' % metric)]
+    for other in metrics:
+        if other in batch or not is_beta_batch(other):
+            continue
+        other_fp = '%s_%s_DM.qza' % (out_fp_root, other)
+        if is_stale(force, other_fp, inputs, (other,) + params):
+            batch[other] = other_fp
+    write_diversity_beta_batch(qza, batch, cur_sh, run_params["n_nodes"], run_params["n_procs"])
+    return batch
+
+
 def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
              datasets_read: dict, datasets_rarefs: dict, p_beta_subsets: str,
              p_perm_groups: str, trees: dict, force: bool, prjct_nm: str, qiime_env: str,
              chmod: str, noloc: bool, Bs: tuple, dropout: bool, run_params: dict,
-             filt_raref: str, eval_depths: dict, jobs: bool, chunkit: int) -> dict:
+             filt_raref: str, eval_depths: dict, jobs: bool, chunkit: int,
+             read_later: bool = False) -> dict:
     """
     Run beta: Beta diversity.
     https://docs.qiime2.org/2019.10/plugins/available/diversity/beta/
@@ -59,6 +113,8 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
     :param prjct_nm: Nick name for your project.
     :param qiime_env: qiime2-xxxx.xx conda environment.
     :param chmod: whether to change permission of output files (defalt: 775).
+    :param read_later: whether the (non-rarefied) tables are read again by the
+        next analyses: the tables of a dataset are released once its betas are written.
     :return: deta divesity matrices.
     """
     evaluation = ''
@@ -73,6 +129,7 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
 
     betas = {}
     to_chunk = []
+    sizes = {}
     main_written = 0
     run_pbs = '%s/2_run_beta_%s%s%s.sh' % (job_folder, prjct_nm, evaluation, filt_raref)
     with open(run_pbs, 'w') as o:
@@ -90,13 +147,15 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
                             print('Must have run rarefaction to use it further...\nExiting')
                             sys.exit(0)
                         tsv_pd, meta_pd = get_raref_tab_meta_pds(meta, tsv)
-                        datasets_read[dat][idx] = [tsv_pd, meta_pd]
+                        datasets_read[dat][idx] = [tsv, meta]
                     else:
-                        tsv_pd, meta_pd = datasets_read[dat][idx]
+                        tsv_pd, meta_pd = get_read_pds(datasets_read[dat][idx])
+                    sizes[out_sh] = max(sizes.get(out_sh, 0), tsv_pd.shape[0] * tsv_pd.shape[1])
 
                     cur_raref = datasets_rarefs[dat][idx]
                     divs = {}
-                    for metric in beta_metrics:
+                    batched = {}
+                    for mdx, metric in enumerate(beta_metrics):
                         if 'unifrac' in metric:
                             if not datasets_phylo[dat][0] or dat not in trees:
                                 continue
@@ -106,11 +165,19 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
 
                         odir = get_analysis_folder(i_datasets_folder, 'beta%s/%s%s' % (evaluation, dat, cur_raref))
                         out_fp = '%s/%s_%s_DM.qza' % (odir, basename(splitext(qza)[0]), metric)
-                        if force or not os.path.isfile(out_fp):
-                            tree = write_diversity_beta(out_fp, datasets_phylo, trees,
-                                                        dat, qza, metric, cur_sh, qiime_env,
-                                                        run_params["n_nodes"],
-                                                        run_params["n_procs"], False)
+                        if metric in batched:
+                            tree = ''
+                        elif is_stale(force, out_fp, (qza,), (metric, datasets_phylo[dat], trees.get(dat))):
+                            if is_beta_batch(metric):
+                                batched = write_beta_batch(
+                                    metric, beta_metrics[mdx + 1:], qza, out_fp, (qza,),
+                                    (datasets_phylo[dat], trees.get(dat)), force, cur_sh, run_params)
+                                tree = ''
+                            else:
+                                tree = write_diversity_beta(out_fp, datasets_phylo, trees,
+                                                            dat, qza, metric, cur_sh, qiime_env,
+                                                            run_params["n_nodes"],
+                                                            run_params["n_procs"], False)
                             written += 1
                             main_written += 1
                         else:
@@ -121,6 +188,7 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
 
                         cases_dict = check_metadata_cases_dict(
                             meta, meta_pd, dict(main_cases_dict), 'BETA')
+                        dm_subsets = []
                         for case_var, case_vals_list in cases_dict.items():
                             if case_var == 'ALL':
                                 continue
@@ -137,23 +205,29 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
                                     os.makedirs(dirname(qza_case_fp))
                                 new_meta = '%s.meta' % os.path.splitext(out_case_fp)[0]
                                 new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
-                                new_meta_pd.to_csv(new_meta, index=False, sep='\t')
-                                if force or not os.path.isfile(out_case_fp):
-                                    write_beta_subset(out_fp, out_case_fp, new_meta, cur_sh)
+                                new_meta = write_case_meta(new_meta, new_meta_pd, False)
+                                if is_stale(force, out_case_fp, (out_fp, new_meta)):
+                                    dm_subsets.append((new_meta, out_case_fp))
                                     written += 1
                                     main_written += 1
-                                if force or not isfile(qza_case_fp):
+                                if is_stale(force, qza_case_fp, (qza, new_meta)):
                                     write_qza_subset(qza, qza_case_fp, new_meta, cur_sh)
                                 divs[metric][''].append((new_meta, qza_case_fp, out_case_fp, tree))
+                        if dm_subsets:
+                            write_beta_subsets(out_fp, dm_subsets, cur_sh)
 
                     if beta_subsets and dat in beta_subsets:
                         for subset, subset_regex in beta_subsets[dat].items():
                             subset_done = set()
+                            batched = {}
                             odir = get_analysis_folder(i_datasets_folder, 'beta%s/%s%s/%s' % (
                                 evaluation, dat, cur_raref, subset))
-                            for metric in beta_metrics:
+                            for mdx, metric in enumerate(beta_metrics):
                                 qza_to_subset = tsv.replace('.tsv', '.qza')
+                                tsv_to_subset = tsv
                                 tsv_to_subset_pd = tsv_pd
+                                # table planned upstream (--dag): subset once written
+                                planned = not isfile(tsv)
                                 if 'unifrac' in metric:
                                     if not datasets_phylo[dat][0] or dat not in trees:
                                         continue
@@ -162,17 +236,28 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
                                         tsv_to_subset = '%s.tsv' % splitext(qza_to_subset)[0]
                                         tsv_to_subset_pd = pd.read_csv(tsv_to_subset, header=0, index_col=0,
                                                                  sep='\t', low_memory=False)
+                                        planned = False
                                 if dropout:
                                     qza_subset = '%s/%s_%s.qza' % (odir, basename(splitext(qza)[0]), subset)
                                 else:
                                     qza_subset = '%s/%s_%s_noDropout.qza' % (odir, basename(splitext(qza)[0]), subset)
                                 tsv_subset = '%s.tsv' % splitext(qza_subset)[0]
 
-                                subset_feats = get_subset(tsv_to_subset_pd, subset_regex)
+                                subset_feats = get_subset(tsv_to_subset_pd, subset_regex, tsv_to_subset)
                                 if not len(subset_feats):
                                     continue
 
-                                if tsv_subset not in subset_done:
+                                if tsv_subset not in subset_done and planned:
+                                    feats_subset = '%s.meta' % splitext(qza_subset)[0]
+                                    subset_pd = pd.DataFrame({'Feature ID': subset_feats,
+                                                              'Subset': [subset] * len(subset_feats)})
+                                    subset_pd.to_csv(feats_subset, index=False, sep='\t')
+                                    write_filter_features(tsv_to_subset_pd, subset_feats, qza_to_subset,
+                                                          qza_subset, feats_subset, cur_sh, dropout, True)
+                                    cmd = run_export(qza_subset, tsv_subset, 'FeatureTable[Frequency]')
+                                    cur_sh.write('%s\n\n' % cmd)
+                                    subset_done.add(tsv_subset)
+                                elif tsv_subset not in subset_done:
                                     tsv_subset_pd = tsv_to_subset_pd.loc[
                                         [x for x in subset_feats if x in tsv_to_subset_pd.index], :
                                     ].copy()
@@ -184,12 +269,20 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
                                     cur_sh.write('%s\n\n' % cmd)
                                     subset_done.add(tsv_subset)
                                 out_fp = '%s/%s__%s_DM.qza' % (odir, basename(splitext(qza_subset)[0]), metric)
-                                if force or not isfile(out_fp):
-                                    tree = write_diversity_beta(out_fp, {dat: [1, 0]}, trees,
-                                                                dat, qza_subset, metric,
-                                                                cur_sh, qiime_env,
-                                                                run_params["n_nodes"],
-                                                                run_params["n_procs"], True)
+                                if metric in batched:
+                                    tree = ''
+                                elif is_stale(force, out_fp, (tsv_subset,), (metric, trees.get(dat))):
+                                    if is_beta_batch(metric):
+                                        batched = write_beta_batch(
+                                            metric, beta_metrics[mdx + 1:], qza_subset, out_fp,
+                                            (tsv_subset,), (trees.get(dat),), force, cur_sh, run_params)
+                                        tree = ''
+                                    else:
+                                        tree = write_diversity_beta(out_fp, {dat: [1, 0]}, trees,
+                                                                    dat, qza_subset, metric,
+                                                                    cur_sh, qiime_env,
+                                                                    run_params["n_nodes"],
+                                                                    run_params["n_procs"], True)
                                     written += 1
                                     main_written += 1
                                 else:
@@ -201,6 +294,7 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
 
                                 cases_dict = check_metadata_cases_dict(
                                     meta, meta_pd, dict(main_cases_dict), 'BETA')
+                                dm_subsets = []
                                 for case_var, case_vals_list in cases_dict.items():
                                     if case_var == 'ALL':
                                         continue
@@ -217,15 +311,18 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
                                             os.makedirs(dirname(qza_case_fp))
                                         new_meta = '%s.meta' % os.path.splitext(out_case_fp)[0]
                                         new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
-                                        new_meta_pd.to_csv(new_meta, index=False, sep='\t')
-                                        if force or not os.path.isfile(out_case_fp):
-                                            write_beta_subset(out_fp, out_case_fp, new_meta, cur_sh)
+                                        new_meta = write_case_meta(new_meta, new_meta_pd, False)
+                                        if is_stale(force, out_case_fp, (out_fp, new_meta)):
+                                            dm_subsets.append((new_meta, out_case_fp))
                                             written += 1
                                             main_written += 1
-                                        if force or not isfile(qza_case_fp):
+                                        if is_stale(force, qza_case_fp, (qza, new_meta)):
                                             write_qza_subset(qza, qza_case_fp, new_meta, cur_sh)
                                         divs[metric][''].append((new_meta, qza_case_fp, out_case_fp, tree))
+                                if dm_subsets:
+                                    write_beta_subsets(out_fp, dm_subsets, cur_sh)
                     betas[dat].append(divs)
+            release_read_pds(datasets_read[dat], datasets_read[dat][:1] if read_later else ())
             to_chunk.append(out_sh)
             if not chunkit:
                 run_xpbs(out_sh, out_pbs, '%s.bt%s.%s%s' % (prjct_nm, evaluation, dat, filt_raref), qiime_env,
@@ -237,7 +334,7 @@ def run_beta(i_datasets_folder: str, datasets: dict, datasets_phylo: dict,
         simple_chunks(run_pbs, job_folder2, to_chunk, 'beta',
                       prjct_nm, run_params["time"], run_params["n_nodes"], run_params["n_procs"],
                       run_params["mem_num"], run_params["mem_dim"],
-                      qiime_env, chmod, noloc, jobs, chunkit, None)
+                      qiime_env, chmod, noloc, jobs, chunkit, None, sizes)
 
     if main_written:
         print_message('# Calculate beta diversity indices', 'sh', run_pbs, jobs)
@@ -393,7 +490,8 @@ def export_beta(i_datasets_folder: str, betas: dict, datasets_rarefs: dict,
                 force: bool, prjct_nm: str, qiime_env: str, chmod: str,
                 noloc: bool, run_params: dict, filt_raref: str, jobs: bool, chunkit: int) -> None:
     """
-    Export beta diverity matrices.
+    Export beta diverity matrices (as text files, and to the store of
+    distance matrices read by the downstream steps).
 
     :param i_datasets_folder: Path to the folder containing the data/metadata subfolders.
     :param betas: beta diversity matrices.
@@ -415,16 +513,22 @@ def export_beta(i_datasets_folder: str, betas: dict, datasets_rarefs: dict,
             out_sh = '%s/2x_run_beta_export_%s%s%s.sh' % (job_folder2, prjct_nm, dat, filt_raref)
             out_pbs = '%s.pbs' % splitext(out_sh)[0]
             with open(out_sh, 'w') as cur_sh:
+                to_store = []
                 for idx, metric_group_meta_dms in enumerate(metric_group_meta_dms_):
                     for metric, group_meta_dms in metric_group_meta_dms.items():
                         for group, meta_qza_dm_tree in group_meta_dms.items():
                             for (meta, qza, dm, tree) in meta_qza_dm_tree:
+                                if is_stale(force, '%s.dm.npy' % splitext(dm)[0], (dm,)):
+                                    to_store.append(dm)
+                                    written += 1
                                 mat_export = '%s.tsv' % splitext(dm)[0]
-                                if force or not isfile(mat_export):
+                                if is_stale(force, mat_export, (dm,)):
                                     cmd = run_export(dm, mat_export, '')
                                     cur_sh.write('echo "%s"\n' % cmd)
                                     cur_sh.write('%s\n\n' % cmd)
                                     written += 1
+                if to_store:
+                    write_dm_store(to_store, cur_sh)
             if written:
                 main_written += 1
                 to_chunk.append(out_sh)
@@ -507,7 +611,7 @@ def run_pcoas(i_datasets_folder: str, betas: dict, datasets_rarefs: dict,
                                 if not os.path.isdir(out_dir):
                                     os.makedirs(out_dir)
                                 dat_pcoas.append((meta, out, qza, tree))
-                                if force or not isfile(out) or not isfile(out_tsv):
+                                if is_stale(force, (out, out_tsv), (dm,)):
                                     write_diversity_pcoa(dm, out, out_tsv, cur_sh)
                                     written += 1
                                     main_written += 1
@@ -648,7 +752,7 @@ def run_biplots(i_datasets_folder: str, betas: dict, datasets_rarefs: dict,
                                 if not os.path.isdir(out_dir):
                                     os.makedirs(out_dir)
                                 tsv_tax = '%s_tax.tsv' % splitext(out_biplot)[0]
-                                if force or not isfile(out_biplot) or not isfile(out_biplot2):
+                                if is_stale(force, (out_biplot, out_biplot2), (tsv, out_pcoa, tax_qza)):
                                     write_diversity_biplot(tsv, qza, out_pcoa, out_biplot,
                                                            out_biplot2, tax_qza, tsv_tax, cur_sh)
                                     written += 1
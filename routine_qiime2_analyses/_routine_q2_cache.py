@@ -0,0 +1,218 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import atexit
+import hashlib
+from os.path import basename, dirname, isfile
+
+from routine_qiime2_analyses._routine_q2_runs import (
+    adopt_command, get_recorded_fingerprint, is_done, plan_command)
+
+# files smaller than this are fingerprinted by content (e.g. metadata,
+# that are re-written at each run), larger ones by size and modification time.
+CONTENT_HASH_MAX_SIZE = 10 * 1024 * 1024
+
+MANIFEST = '.fingerprints'
+
+# fingerprints state, only filled once init_fingerprints() is called.
+FINGERPRINTS = {'active': False, 'env': '', 'manifests': {}, 'dirty': set(), 'files': {}, 'journal': None}
+
+
+def init_fingerprints(qiime_env: str) -> None:
+    """
+    Activate the comparison of the fingerprint of each planned command with
+    the fingerprint recorded when its outputs were last planned.
+
+    :param qiime_env: qiime2-xxxx.xx conda environment.
+    """
+    if not FINGERPRINTS['active']:
+        atexit.register(write_fingerprints)
+    FINGERPRINTS['active'] = True
+    FINGERPRINTS['env'] = qiime_env
+
+
+def get_file_fingerprint(path: str) -> str:
+    """
+    :param path: input file.
+    :return: hash of the file content (small files) or size and modification time.
+    """
+    if not isfile(path):
+        return ''
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    if path in FINGERPRINTS['files'] and FINGERPRINTS['files'][path][0] == key:
+        return FINGERPRINTS['files'][path][1]
+    if stat.st_size <= CONTENT_HASH_MAX_SIZE:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+        fingerprint = md5.hexdigest()
+    else:
+        fingerprint = '%s:%s' % key
+    FINGERPRINTS['files'][path] = (key, fingerprint)
+    return fingerprint
+
+
+def get_features_fingerprint(features) -> str:
+    """
+    :param features: features names.
+    :return: hash of the features names (to pass as a command parameter).
+    """
+    return hashlib.md5('\n'.join(map(str, features)).encode()).hexdigest()
+
+
+def get_input_fingerprint(path: str) -> str:
+    """
+    :param path: input file.
+    :return: fingerprint of the command writing the input according to the
+        run manifest (without reading it), or fingerprint of the file.
+    """
+    recorded = get_recorded_fingerprint(path)
+    if recorded:
+        return 'run:%s' % recorded
+    return get_file_fingerprint(path)
+
+
+def get_manifest(folder: str) -> dict:
+    """
+    Read (once) the manifest of fingerprints of the outputs of a folder.
+
+    :param folder: output folder.
+    :return: output file name -> [fingerprint, state], where the state is
+        either "ok" or the modification time of the output when its command
+        was planned (i.e. the output is up-to-date once it has changed).
+    """
+    if folder not in FINGERPRINTS['manifests']:
+        manifest = {}
+        manifest_fp = '%s/%s' % (folder, MANIFEST)
+        if isfile(manifest_fp):
+            with open(manifest_fp) as f:
+                for line in f:
+                    line_split = line.rstrip('\n').split('\t')
+                    if len(line_split) == 3:
+                        manifest[line_split[0]] = line_split[1:]
+        FINGERPRINTS['manifests'][folder] = manifest
+    return FINGERPRINTS['manifests'][folder]
+
+
+def write_fingerprints() -> None:
+    """
+    Write the manifests of fingerprints that were updated during planning.
+    """
+    for folder in sorted(FINGERPRINTS['dirty']):
+        if not os.path.isdir(folder):
+            continue
+        with open('%s/%s' % (folder, MANIFEST), 'w') as o:
+            for output, (fingerprint, state) in sorted(FINGERPRINTS['manifests'][folder].items()):
+                o.write('%s\t%s\t%s\n' % (output, fingerprint, state))
+    FINGERPRINTS['dirty'] = set()
+
+
+def start_fingerprints_journal() -> None:
+    """
+    Start collecting the fingerprints updated by a planning worker.
+    """
+    FINGERPRINTS['journal'] = []
+
+
+def stop_fingerprints_journal() -> list:
+    """
+    :return: the fingerprints updated by a planning worker.
+    """
+    journal = FINGERPRINTS['journal']
+    FINGERPRINTS['journal'] = None
+    return journal
+
+
+def apply_fingerprints_journal(journal: list) -> None:
+    """
+    Merge the fingerprints updated by a planning worker.
+
+    :param journal: (folder, output name, fingerprint state) updates.
+    """
+    for folder, output, state in journal:
+        get_manifest(folder)[output] = state
+        FINGERPRINTS['dirty'].add(folder)
+
+
+def get_mtime(path: str) -> str:
+    """
+    :param path: output file.
+    :return: modification time of the file (or 0 if it does not exist).
+    """
+    if isfile(path):
+        return str(os.stat(path).st_mtime_ns)
+    return '0'
+
+
+def is_stale(force: bool, outputs, inputs: tuple = (), params: tuple = ()) -> bool:
+    """
+    Check whether the command writing the outputs must be planned, i.e. if
+    it is forced, if an output is missing, or if the fingerprint of the
+    command (the content of its input files, its parameters and the qiime2
+    environment) changed since the outputs were computed.
+    Outputs computed before being fingerprinted are adopted as up-to-date,
+    as are outputs whose inputs were not yet computed when it was planned.
+    With the run manifest (--run-manifest), the outputs of commands that
+    succeeded with the same fingerprint are up-to-date without being looked
+    for, and the inputs written by such commands are fingerprinted from the
+    manifest without being read.
+
+    :param force: Force the re-writing of scripts for all commands.
+    :param outputs: output file(s) of the command.
+    :param inputs: input files of the command (empty ones are ignored).
+    :param params: parameters of the command.
+    :return: whether the command must be (re-)planned.
+    """
+    if isinstance(outputs, str):
+        outputs = (outputs,)
+    if not FINGERPRINTS['active']:
+        return force or bool([x for x in outputs if not isfile(x)])
+    inputs = [x for x in inputs if x]
+    inputs_fingerprints = [get_input_fingerprint(x) for x in inputs]
+    md5 = hashlib.md5(FINGERPRINTS['env'].encode())
+    for input_fp, input_fingerprint in zip(inputs, inputs_fingerprints):
+        md5.update(('%s=%s' % (input_fp, input_fingerprint)).encode())
+    for param in params:
+        md5.update(str(param).encode())
+    fingerprint = md5.hexdigest()
+    if '' in inputs_fingerprints:
+        # some inputs are not computed yet: re-checked at the next call
+        fingerprint = 'pending'
+    elif not force and is_done(outputs, fingerprint):
+        return False
+    stale = force or bool([x for x in outputs if not isfile(x)])
+    for output in outputs:
+        if stale:
+            break
+        recorded = get_manifest(dirname(output)).get(basename(output))
+        if recorded is None or recorded[0] == 'pending':
+            continue
+        if recorded[1] != 'ok' and recorded[1] == get_mtime(output):
+            # planned but not re-computed since
+            stale = True
+        elif recorded[0] != fingerprint:
+            stale = True
+    for output in outputs:
+        manifest = get_manifest(dirname(output))
+        if stale:
+            state = [fingerprint, get_mtime(output)]
+        else:
+            state = [fingerprint, 'ok']
+        if manifest.get(basename(output)) != state:
+            manifest[basename(output)] = state
+            FINGERPRINTS['dirty'].add(dirname(output))
+            if FINGERPRINTS['journal'] is not None:
+                FINGERPRINTS['journal'].append((dirname(output), basename(output), state))
+    if stale:
+        plan_command(outputs, inputs, params, fingerprint)
+    elif fingerprint != 'pending':
+        adopt_command(outputs, inputs, params, fingerprint)
+    return stale
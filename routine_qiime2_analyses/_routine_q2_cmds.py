@@ -6,13 +6,68 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import re
+import pkg_resources
+import numpy as np
 import pandas as pd
 from typing import TextIO
 from os.path import dirname, isdir, isfile, splitext
 from skbio.stats.ordination import OrdinationResults
 
+from routine_qiime2_analyses._routine_q2_cache import get_file_fingerprint
+from routine_qiime2_analyses._routine_q2_metadata import get_case_rows
+from routine_qiime2_analyses._routine_q2_sequential import (
+    SEQUENTIAL, get_permutations_increments, get_permutations_stages, sequential_mode
+)
 
-def get_subset(tsv_pd: pd.DataFrame, subset_regex: list) -> list:
+# features matched by the subsets regexes during this run:
+# (table, table fingerprint, regexes) -> features names.
+SUBSETS = {}
+
+# regexes that cannot be searched as part of a single pattern: numbered
+# backreferences and named group references (that would point to another
+# group), and global inline flags (that would apply to all the regexes).
+SINGLE_REGEX = re.compile(r'\\\d|\(\?[Pp]=|\(\?[aiLmsux]+\)')
+
+
+def get_features_subset(features: pd.Index, subset_regex: list, table: str = None) -> list:
+    """
+    Get the features whose (lowercase) name matches one of the subset
+    regexes, searched at once as a single pattern (unless a regex cannot
+    be combined with others, see SINGLE_REGEX). The result is kept for the
+    same table file (e.g. the same table for all the metrics).
+
+    :param features: features names.
+    :param subset_regex: subsetting regex.
+    :param table: file of the features table (to keep the result).
+    :return: names of the features to keep.
+    """
+    regexes = tuple(str(regex).lower() for regex in subset_regex)
+    if not regexes:
+        return []
+    key = None
+    if table:
+        fingerprint = get_file_fingerprint(table)
+        if fingerprint:
+            key = (table, fingerprint, regexes)
+    if key not in SUBSETS:
+        names = features.astype(str).str.lower()
+        to_keep_feats = None
+        if not [x for x in regexes if SINGLE_REGEX.search(x)]:
+            try:
+                to_keep_feats = names.str.contains('|'.join(['(?:%s)' % x for x in regexes]))
+            except re.error:
+                pass
+        if to_keep_feats is None:
+            to_keep_feats = np.any([names.str.contains(x) for x in regexes], axis=0)
+        feats = features[np.asarray(to_keep_feats, dtype=bool)].tolist()
+        if key is None:
+            return feats
+        SUBSETS[key] = feats
+    return list(SUBSETS[key])
+
+
+def get_subset(tsv_pd: pd.DataFrame, subset_regex: list, tsv: str = None) -> list:
     """
     Make a feature metadata from the regex
     to get the names of the features to keep.
@@ -20,22 +75,15 @@ def get_subset(tsv_pd: pd.DataFrame, subset_regex: list) -> list:
     :param tsv_pd: Table containing the features to subset.
     :param feats_subset: Feature metadata to create.
     :param subset_regex: subsetting regex.
+    :param tsv: file of the table.
     """
-    to_keep_feats = {}
-    for regex in subset_regex:
-        # if str(regex).isdigit():
-        #     to_keep_feats[regex] = tsv_pd.index.str.contains()
-        # else:
-        to_keep_feats[str(regex).lower()] = tsv_pd.index.astype(str).str.lower().str.contains(str(regex).lower())
-    to_keep_feats_pd = pd.DataFrame(to_keep_feats)
-    to_keep_feats = to_keep_feats_pd.any(axis=1)
-    feats_subset_list = tsv_pd.index[to_keep_feats].tolist()
-    return feats_subset_list
+    return get_features_subset(tsv_pd.index, subset_regex, tsv)
 
 
 def write_filter_features(tsv_pd: pd.DataFrame, feats: list, qza: str,
                           qza_subset: str, meta_subset: str,
-                          cur_sh: TextIO, dropout: bool) -> None:
+                          cur_sh: TextIO, dropout: bool,
+                          planned: bool = False) -> None:
     """
     filter-features: Filter features from table¶
     https://docs.qiime2.org/2020.2/plugins/available/feature-table/filter-features/
@@ -48,16 +96,20 @@ def write_filter_features(tsv_pd: pd.DataFrame, feats: list, qza: str,
     :param qza_subset: The .
     :param meta_subset: Feature metadata to write.
     :param cur_sh: writing file handle.
+    :param planned: whether the table is only planned (--dag), in which case
+        its counts are not known yet and it is subset by qiime2 once written.
     """
 
-    if dropout:
+    if dropout or planned:
         cmd = 'qiime feature-table filter-features \\\n'
         cmd += '--i-table %s \\\n' % qza
         cmd += '--m-metadata-file %s \\\n' % meta_subset
+        if not dropout:
+            cmd += '--p-no-filter-empty-samples \\\n'
         cmd += '--o-filtered-table %s\n' % qza_subset
     else:
         tsv_subset = '%s.tsv' % splitext(qza_subset)[0]
-        tsv_nodrop = tsv_pd.loc[list(set(tsv_pd.index) & set(feats)), :].copy()
+        tsv_nodrop = tsv_pd.loc[list(set(tsv_pd.index) & set(feats)), :]
         tsv_nodrop.to_csv(tsv_subset, index=True, sep='\t')
         cmd = run_import(tsv_subset, qza_subset, "FeatureTable[Frequency]")
     cur_sh.write('echo "%s"\n' % cmd)
@@ -565,6 +617,28 @@ def write_diversity_beta(out_fp: str, datasets_phylo: dict, trees: dict,
     return tree
 
 
+def write_diversity_beta_batch(qza: str, metrics_outputs: dict, cur_sh: TextIO,
+                               nnodes, nprocs) -> None:
+    """
+    Computes several non-phylogenetic beta diversity metrics for all pairs
+    of samples in a feature table, that is only loaded once
+    (see resources/beta_engine.py).
+
+    :param qza: The feature table containing the samples over which beta diversity should be computed.
+    :param metrics_outputs: The resulting distance matrix per beta diversity metric.
+    :param cur_sh: writing file handle.
+    """
+    RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+    cmd = 'python %s/beta_engine.py \\\n' % RESOURCES
+    cmd += '--i-table %s \\\n' % qza
+    for metric, out_fp in metrics_outputs.items():
+        cmd += '--p-metric %s \\\n' % metric
+        cmd += '--o-distance-matrix %s \\\n' % out_fp
+    cmd += '--p-n-jobs %s\n' % (int(nnodes)*int(nprocs))
+    cur_sh.write('echo "%s"\n' % cmd)
+    cur_sh.write('%s\n' % cmd)
+
+
 def write_beta_subset(out_fp: str, out_case_fp: str, new_meta: str, cur_sh: TextIO):
     cmd = 'qiime diversity filter-distance-matrix \\\n'
     cmd += '--i-distance-matrix %s \\\n' % out_fp
@@ -574,6 +648,55 @@ def write_beta_subset(out_fp: str, out_case_fp: str, new_meta: str, cur_sh: Text
     cur_sh.write('%s\n' % cmd)
 
 
+def get_beta_subsets_cmd(out_fp: str, cases: list) -> str:
+    """
+    :param out_fp: Distance matrix to filter by sample.
+    :param cases: (Sample metadata, filtered distance matrix) per case.
+    :return: the command filtering the samples of a distance matrix for
+        several metadata files, with the distance matrix loaded once (from
+        its store if it is up-to-date, see resources/dm_subsets.py).
+    """
+    RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+    cmd = 'python %s/dm_subsets.py \\\n' % RESOURCES
+    cmd += '--i-distance-matrix %s' % out_fp
+    for new_meta, out_case_fp in cases:
+        cmd += ' \\\n--m-metadata-file %s \\\n' % new_meta
+        cmd += '--o-filtered-distance-matrix %s' % out_case_fp
+    cmd += '\n'
+    return cmd
+
+
+def write_beta_subsets(out_fp: str, cases: list, cur_sh: TextIO) -> None:
+    """
+    Filter the samples of a distance matrix for several metadata files,
+    with the distance matrix loaded once (see resources/dm_subsets.py).
+
+    :param out_fp: Distance matrix to filter by sample.
+    :param cases: (Sample metadata, filtered distance matrix) per case.
+    :param cur_sh: writing file handle.
+    """
+    cmd = get_beta_subsets_cmd(out_fp, cases)
+    cur_sh.write('echo "%s"\n' % cmd)
+    cur_sh.write('%s\n' % cmd)
+
+
+def write_dm_store(dms: list, cur_sh: TextIO) -> None:
+    """
+    Store distance matrices as condensed, memory-mapped binary files
+    with their samples IDs (see resources/dm_store.py).
+
+    :param dms: Distance matrices to store.
+    :param cur_sh: writing file handle.
+    """
+    RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+    cmd = 'python %s/dm_store.py' % RESOURCES
+    for dm in dms:
+        cmd += ' \\\n--i-distance-matrix %s' % dm
+    cmd += '\n'
+    cur_sh.write('echo "%s"\n' % cmd)
+    cur_sh.write('%s\n' % cmd)
+
+
 def write_qza_subset(qza: str, qza_case_fp: str, new_meta: str, cur_sh: TextIO):
     cmd = 'qiime feature-table filter-samples \\\n'
     cmd += '--i-table %s \\\n' % qza
@@ -1225,10 +1348,7 @@ def write_distance_decay(mat_qza: str, mat_qza_filt: str, new_qza: str,
                          n_procs: str, cur_sh: TextIO):
     cmd = ''
     if not isfile(new_qza):
-        cmd += 'qiime diversity filter-distance-matrix \\\n'
-        cmd += '--m-metadata-file %s \\\n' % new_meta
-        cmd += '--i-distance-matrix %s \\\n' % mat_qza
-        cmd += '--o-filtered-distance-matrix %s\n' % mat_qza_filt
+        cmd += get_beta_subsets_cmd(mat_qza, [(new_meta, mat_qza_filt)])
 
         cmd += 'qiime distance-decay %s \\\n' % mode
         cmd += '--i-distance-matrix %s \\\n' % mat_qza_filt
@@ -1262,8 +1382,7 @@ def write_diversity_beta_group_significance(new_meta: str, mat_qza: str, new_mat
     https://docs.qiime2.org/2019.10/plugins/available/diversity/beta-group-significance/
 
     Includes calls to:
-    filter-distance-matrix: Filter samples from a distance matrix
-    https://docs.qiime2.org/2019.10/plugins/available/diversity/filter-distance-matrix/
+    dm_subsets.py: Filter samples from a distance matrix (as filter-distance-matrix)
     filter-samples: Filter samples from table
     https://docs.qiime2.org/2019.10/plugins/available/feature-table/filter-samples/
 
@@ -1278,10 +1397,7 @@ def write_diversity_beta_group_significance(new_meta: str, mat_qza: str, new_mat
     """
     # if not isfile(new_mat_qza):
     if 1:
-        cmd = 'qiime diversity filter-distance-matrix \\\n'
-        cmd += '--m-metadata-file %s \\\n' % new_meta
-        cmd += '--i-distance-matrix %s \\\n' % mat_qza
-        cmd += '--o-filtered-distance-matrix %s\n' % new_mat_qza
+        cmd = get_beta_subsets_cmd(mat_qza, [(new_meta, new_mat_qza)])
         cur_sh.write('echo "%s"\n' % cmd)
         cur_sh.write(cmd)
     if not isfile(new_qzv):
@@ -1301,6 +1417,33 @@ def write_diversity_beta_group_significance(new_meta: str, mat_qza: str, new_mat
     cur_sh.write('rm %s\n' % new_mat_qza)
 
 
+def write_permanova_engine(mat_qza: str, tests: list, npermutations: str,
+                           cur_sh: TextIO, nnodes, nprocs) -> None:
+    """
+    Run all the beta group significance tests of a distance matrix at once,
+    with the distance matrix loaded once (see resources/permanova_engine.py),
+    by stages of permutations for sequential permutation tests.
+
+    :param mat_qza: Distance matrix.
+    :param tests: (Sample metadata, Categorical sample metadata column,
+        test method, output html) per test.
+    :param npermutations: number of permutations.
+    :param cur_sh: writing file handle.
+    """
+    RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+    cmd = 'python %s/permanova_engine.py \\\n' % RESOURCES
+    cmd += '--i-distance-matrix %s \\\n' % mat_qza
+    for new_meta, testing_group, beta_type, new_html in tests:
+        cmd += '--test %s "%s" %s %s \\\n' % (new_meta, testing_group, beta_type, new_html)
+    cmd += '--p-permutations %s \\\n' % npermutations
+    if sequential_mode():
+        cmd += '--p-stages %s \\\n' % ' '.join(map(str, get_permutations_stages()))
+        cmd += '--p-alpha %s \\\n' % SEQUENTIAL['alpha']
+    cmd += '--p-n-jobs %s\n' % (int(nnodes)*int(nprocs))
+    cur_sh.write('echo "%s"\n' % cmd)
+    cur_sh.write('%s\n' % cmd)
+
+
 def write_diversity_adonis(new_meta: str, mat_qza: str, new_mat_qza: str,
                            formula: str, new_qzv: str, cur_sh: TextIO) -> None:
     """
@@ -1315,8 +1458,7 @@ def write_diversity_adonis(new_meta: str, mat_qza: str, new_mat_qza: str,
     https://docs.qiime2.org/2019.10/plugins/available/diversity/adonis/
 
     Includes calls to:
-    * filter-distance-matrix: Filter samples from a distance matrix
-    https://docs.qiime2.org/2019.10/plugins/available/diversity/filter-distance-matrix/
+    * dm_subsets.py: Filter samples from a distance matrix (as filter-distance-matrix)
     * filter-samples: Filter samples from table
     https://docs.qiime2.org/2019.10/plugins/available/feature-table/filter-samples/
 
@@ -1338,10 +1480,7 @@ def write_diversity_adonis(new_meta: str, mat_qza: str, new_mat_qza: str,
     :param new_qzv: VISUALIZATION.
     :param cur_sh: writing file handle.
     """
-    cmd = '\nqiime diversity filter-distance-matrix \\\n'
-    cmd += '--m-metadata-file %s \\\n' % new_meta
-    cmd += '--i-distance-matrix %s \\\n' % mat_qza
-    cmd += '--o-filtered-distance-matrix %s\n' % new_mat_qza
+    cmd = '\n' + get_beta_subsets_cmd(mat_qza, [(new_meta, new_mat_qza)])
     cmd += 'qiime diversity adonis \\\n'
     cmd += '--i-distance-matrix %s \\\n' % new_mat_qza
     cmd += '--m-metadata-file %s \\\n' % new_meta
@@ -1370,16 +1509,10 @@ def write_procrustes_mantel(
 
     cmd = ''
     if not isfile(dm_out1) or not isfile(dm_out_tsv1):
-        cmd += '\nqiime diversity filter-distance-matrix \\\n'
-        cmd += '--m-metadata-file %s \\\n' % common_meta_fp
-        cmd += '--i-distance-matrix %s \\\n' % dm1
-        cmd += '--o-filtered-distance-matrix %s\n' % dm_out1
+        cmd += '\n' + get_beta_subsets_cmd(dm1, [(common_meta_fp, dm_out1)])
         cmd += run_export(dm_out1, dm_out_tsv1, '')
     if not isfile(dm_out2) or not isfile(dm_out_tsv2):
-        cmd += '\nqiime diversity filter-distance-matrix \\\n'
-        cmd += '--m-metadata-file %s \\\n' % common_meta_fp
-        cmd += '--i-distance-matrix %s \\\n' % dm2
-        cmd += '--o-filtered-distance-matrix %s\n' % dm_out2
+        cmd += '\n' + get_beta_subsets_cmd(dm2, [(common_meta_fp, dm_out2)])
         cmd += run_export(dm_out2, dm_out_tsv2, '')
     if procrustes_mantel == 'procrustes':
         if not isfile(pcoa_out1):
@@ -1412,14 +1545,34 @@ def write_procrustes_mantel(
             cmd += 'rm %s\n' % oth_pcoa
     else:
         if not isfile(output):
-            cmd += '\nqiime diversity mantel \\\n'
+            output_html = output.replace('.qzv', '.html')
+            if sequential_mode():
+                # sequential permutation test: run more permutations while the
+                # p-value is not decided, each stage adding its permutations to
+                # those of the previous stages (see resources/sequential_perms.py),
+                # in one block (no empty line) to be run by bash as a whole
+                RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+                output_counts = output.replace('.qzv', '.perms')
+                cmd += '\nrm -f %s\n' % output_counts
+                cmd += 'for perms in %s; do\n' % ' '.join(map(str, get_permutations_increments()))
+            else:
+                cmd += '\n'
+            cmd += 'qiime diversity mantel \\\n'
             cmd += '--i-dm1 %s \\\n' % dm_out1
             cmd += '--i-dm2 %s \\\n' % dm_out2
             cmd += '--p-label1 %s \\\n' % dat1
             cmd += '--p-label2 %s \\\n' % dat2
+            if sequential_mode():
+                cmd += '--p-permutations $perms \\\n'
             cmd += '--o-visualization %s\n' % output
-            output_html = output.replace('.qzv', '.html')
             cmd += run_export(output, output_html, 'mantel')
+            if sequential_mode():
+                # exit code 2: no p-value, the test failed
+                cmd += 'python %s/sequential_perms.py %s $perms %s %s %s; ' % (
+                    RESOURCES, output_html, SEQUENTIAL['alpha'], SEQUENTIAL['max'], output_counts)
+                cmd += 'case $? in 0) break ;; 1) ;; *) exit 1 ;; esac\n'
+                cmd += 'done\n'
+                cmd += 'rm -f %s\n' % output_counts
 
     if isfile(common_meta_fp):
         cmd += 'rm %s\n' % common_meta_fp
@@ -1604,7 +1757,15 @@ def get_new_meta_pd(meta_pd: pd.DataFrame, case: str,
     """
     if 'ALL' in case:
         new_meta_pd = meta_pd.copy()
-    elif len([x for x in case_vals if x[0] == '>' or x[0] == '<']):
+        new_meta_pd.attrs.pop('case', None)
+        return new_meta_pd
+    # answered from the cases index of the metadata file the table was read from
+    rows = get_case_rows(meta_pd, case_var, case_vals)
+    if rows is not None:
+        new_meta_pd = meta_pd.iloc[rows].copy()
+        new_meta_pd.attrs['case'] = (meta_pd.attrs['meta'], case_var, tuple(case_vals))
+        return new_meta_pd
+    if len([x for x in case_vals if x[0] == '>' or x[0] == '<']):
         new_meta_pd = meta_pd.copy()
         for case_val in case_vals:
             if case_val[0] == '>':
@@ -1613,6 +1774,7 @@ def get_new_meta_pd(meta_pd: pd.DataFrame, case: str,
                 new_meta_pd = new_meta_pd[new_meta_pd[case_var].astype(float) <= float(case_val[1:])].copy()
     else:
         new_meta_pd = meta_pd[meta_pd[case_var].isin(case_vals)].copy()
+    new_meta_pd.attrs.pop('case', None)
     return new_meta_pd
 
 
@@ -0,0 +1,228 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import re
+from os.path import exists, isdir, isfile, splitext
+
+# upstream stages of each pipeline stage (names are the run_params.yml keys,
+# plus a few sub-stages that are written by the same run_* function).
+DAG_DEPENDENCIES = {
+    'import': [],
+    'filter': ['import'],
+    'rarefy': ['import', 'filter'],
+    'qemistree': ['import'],
+    'taxonomy': ['import', 'filter', 'qemistree'],
+    'barplot': ['taxonomy'],
+    'edit_taxonomy': ['taxonomy'],
+    'wol': ['import', 'filter', 'rarefy'],
+    'sepp': ['import', 'filter', 'rarefy'],
+    'collapse': ['rarefy', 'edit_taxonomy'],
+    'alpha': ['import', 'filter', 'rarefy', 'collapse', 'wol', 'sepp'],
+    'merge_alpha': ['alpha'],
+    'alpha_correlations': ['alpha'],
+    'volatility': ['merge_alpha'],
+    'beta': ['import', 'filter', 'rarefy', 'collapse', 'wol', 'sepp'],
+    'export_beta': ['beta'],
+    'pcoa': ['beta'],
+    'emperor': ['pcoa'],
+    'empress': ['pcoa', 'edit_taxonomy'],
+    'biplot': ['beta', 'edit_taxonomy'],
+    'emperor_biplot': ['biplot'],
+    'empress_biplot': ['biplot'],
+    'alpha_kw': ['alpha'],
+    'deicode': ['import', 'filter', 'rarefy', 'collapse'],
+    'permanova': ['beta'],
+    'permanova_summarize': ['permanova'],
+    'adonis': ['beta'],
+    'procrustes': ['beta'],
+    'procrustes_R': ['procrustes'],
+    'mantel': ['beta'],
+    'nestedness': ['beta', 'collapse'],
+    'nestedness_figures': ['nestedness'],
+    'decay': ['beta'],
+    'phate': ['import', 'filter', 'rarefy'],
+    'doc': ['import', 'filter', 'rarefy', 'phate'],
+    'doc_R': ['doc'],
+    'sourcetracking': ['import', 'filter', 'rarefy'],
+    'mmvec_imports': ['import', 'filter', 'rarefy'],
+    'mmvec': ['mmvec_imports'],
+    'songbird_imports': ['import', 'filter', 'rarefy'],
+    'songbird': ['songbird_imports', 'mmvec'],
+    'mmbird': ['mmvec', 'songbird'],
+}
+
+# planning state, only filled when the --dag mode is active: the jobs in
+# the order they are written (stage, script, whether it is an array job),
+# the index of each job script, the job writing each file, and the jobs
+# that each job waits for.
+DAG = {'active': False, 'stage': '', 'jobs': [], 'scripts': {},
+       'producers': {}, 'depends': {}, 'planned': set()}
+
+# maximum number of jobs waited for in one -W depend (beyond which the jobs
+# are waited for by intermediate jobs that do nothing).
+DAG_MAX_DEPEND = 50
+
+PATH_RE = re.compile(r'[^\s\'"=]+/[^\s\'";]+')
+
+
+def init_dag() -> None:
+    """
+    Activate the collection of every written job script and of the files
+    that each job writes and reads.
+    """
+    DAG['active'] = True
+    DAG['stage'] = ''
+    DAG['jobs'] = []
+    DAG['scripts'] = {}
+    DAG['producers'] = {}
+    DAG['depends'] = {}
+    DAG['planned'] = set()
+
+
+def dag_planning() -> bool:
+    """
+    :return: whether the dependency graph of the jobs is being collected.
+    """
+    return DAG['active']
+
+
+def set_dag_stage(stage: str) -> None:
+    """
+    Set the pipeline stage to which the next written job scripts belong.
+
+    :param stage: name of the stage (a key of DAG_DEPENDENCIES).
+    """
+    DAG['stage'] = stage
+
+
+def get_dag_paths(sources: list) -> list:
+    """
+    :param sources: bash scripts run by a job.
+    :return: the files paths in the commands of these scripts (including
+        those moved to the commands script of the --q2-worker mode).
+    """
+    paths = []
+    for source in sources:
+        for fp in [source, '%s_commands.sh' % splitext(source)[0]]:
+            if isfile(fp):
+                with open(fp) as f:
+                    paths.extend(PATH_RE.findall(f.read()))
+    return paths
+
+
+def add_dag_job(script: str, array: bool = False, sources: list = None) -> None:
+    """
+    Collect a written job script (.pbs, or .sh if not preparing Torque jobs)
+    and the jobs it waits for: those writing the files that its commands use.
+    A file is written by the first job using it that is planned before the
+    file exists (or before it is re-written at this call, e.g. if stale).
+
+    :param script: path to the job script.
+    :param array: whether the job script is a Torque array job.
+    :param sources: bash scripts run by the job (default: the job script).
+    """
+    if not DAG['active'] or not DAG['stage']:
+        return
+    if script in DAG['scripts']:
+        return
+    jdx = len(DAG['jobs'])
+    DAG['scripts'][script] = jdx
+    DAG['jobs'].append((DAG['stage'], script, array))
+    depends = set()
+    for path in get_dag_paths(sources if sources else [script]):
+        if path in DAG['producers']:
+            if DAG['producers'][path] != jdx:
+                depends.add(DAG['producers'][path])
+        elif path in DAG['planned'] or not exists(path):
+            DAG['producers'][path] = jdx
+    DAG['depends'][jdx] = sorted(depends)
+
+
+def get_dag_ancestors(stage: str) -> set:
+    """
+    :param stage: name of the stage.
+    :return: all the stages upstream of the stage (directly or not).
+    """
+    ancestors = set()
+    to_visit = list(DAG_DEPENDENCIES.get(stage, []))
+    while to_visit:
+        dep = to_visit.pop()
+        if dep not in ancestors:
+            ancestors.add(dep)
+            to_visit.extend(DAG_DEPENDENCIES.get(dep, []))
+    return ancestors
+
+
+def get_dag_depend(depends: list, arrays: set) -> str:
+    """
+    :param depends: variables of the IDs of the jobs to wait for.
+    :param arrays: variables of the IDs of the array jobs.
+    :return: the -W depend value (array jobs are waited for with
+        afterokarray and not afterok).
+    """
+    depend = []
+    jobs = ''.join([':${%s}' % x for x in depends if x not in arrays])
+    if jobs:
+        depend.append('afterok%s' % jobs)
+    jobs = ''.join([':${%s}' % x for x in depends if x in arrays])
+    if jobs:
+        depend.append('afterokarray%s' % jobs)
+    return ','.join(depend)
+
+
+def write_dag_launcher(i_datasets_folder: str, prjct_nm: str,
+                       filt_raref: str, jobs: bool) -> str:
+    """
+    Write the single launcher for all the jobs of all the pipeline stages,
+    in which each job is submitted with a Torque dependency on the jobs
+    writing the files it uses (-W depend=afterok:<job ids>).
+
+    :param i_datasets_folder: Path to the folder containing the data/metadata subfolders.
+    :param prjct_nm: Nick name for your project.
+    :param filt_raref: suffix for the filtered/rarefied launchers.
+    :param jobs: whether to prepare Torque jobs from scripts.
+    :return: the written launcher (or nothing).
+    """
+    if not DAG['jobs']:
+        return ''
+    job_folder = '%s/jobs' % i_datasets_folder
+    if not isdir(job_folder):
+        os.makedirs(job_folder)
+    launcher = '%s/run_all_%s%s.sh' % (job_folder, prjct_nm, filt_raref)
+    arrays = set('j%s' % jdx for jdx, (_, _, array) in enumerate(DAG['jobs']) if array)
+    stage = ''
+    sentinels = 0
+    with open(launcher, 'w') as o:
+        o.write('#!/bin/bash\n')
+        if not jobs:
+            o.write('set -e\n')
+        for jdx, (job_stage, script, array) in enumerate(DAG['jobs']):
+            if job_stage != stage:
+                o.write('\n# %s\n' % job_stage)
+                stage = job_stage
+            if not jobs:
+                # the scripts run one after the other, in the order they were
+                # planned (set -e stops the launcher at the first failure)
+                o.write('sh %s\n' % script)
+                continue
+            depends = ['j%s' % x for x in DAG['depends'][jdx]]
+            while len(depends) > DAG_MAX_DEPEND:
+                # wait for the jobs by groups, each in a job doing nothing
+                grouped = []
+                for gdx in range(0, len(depends), DAG_MAX_DEPEND):
+                    sentinels += 1
+                    o.write('s%s=$(echo "true" | qsub -N %s.dag -l walltime=00:01:00 -W depend=%s)\n' % (
+                        sentinels, prjct_nm, get_dag_depend(depends[gdx:gdx + DAG_MAX_DEPEND], arrays)))
+                    grouped.append('s%s' % sentinels)
+                depends = grouped
+            depend = ''
+            if depends:
+                depend = '-W depend=%s ' % get_dag_depend(depends, arrays)
+            o.write('j%s=$(qsub %s%s)\n' % (jdx, depend, script))
+    return launcher
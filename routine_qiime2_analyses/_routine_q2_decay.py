@@ -13,6 +13,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 from routine_qiime2_analyses._routine_q2_xpbs import print_message
+from routine_qiime2_analyses._routine_q2_pool import run_pool
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -57,7 +58,10 @@ def run_distance_decay(i_datasets_folder: str, betas: dict, p_distance_decay: st
     subsets, modes, params = get_decay_config(decay_config)
 
     all_sh_pbs = {}
+    sizes = {}
     decay_res = {}
+    decay_tasks = []
+    decay_keys = []
     for dat, rarefs_metrics_groups_metas_qzas_dms_trees in betas.items():
         if not split:
             out_sh = '%s/run_decay_%s_%s%s.sh' % (job_folder2, prjct_nm, dat, filt_raref)
@@ -81,19 +85,23 @@ def run_distance_decay(i_datasets_folder: str, betas: dict, p_distance_decay: st
                                 cur_sh = cur_sh.replace(' ', '-')
                                 all_sh_pbs.setdefault((dat, out_sh), []).append(cur_sh)
                                 new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
-                                res = run_single_decay(odir, group, new_meta_pd, cur_sh, mat_qza,
-                                                       case, modes, force, run_params["n_nodes"],
-                                                       run_params["n_procs"], int(params['iteration']),
-                                                       int(params['step']))
-                                decay_raref[(metric, group, case)] = res
+                                sizes[cur_sh] = new_meta_pd.shape[0] ** 2
+                                decay_tasks.append((odir, group, new_meta_pd, cur_sh, mat_qza,
+                                                    case, modes, force, run_params["n_nodes"],
+                                                    run_params["n_procs"], int(params['iteration']),
+                                                    int(params['step'])))
+                                decay_keys.append((decay_raref, (metric, group, case)))
             decay_res[dat].append(decay_raref)
+    decay_results = run_pool(run_single_decay, decay_tasks, [x[3] for x in decay_tasks])
+    for (decay_raref, key), res in zip(decay_keys, decay_results):
+        decay_raref[key] = res
 
     job_folder = get_job_folder(i_datasets_folder, 'decay')
     main_sh = write_main_sh(job_folder, '3_run_decay_%s%s' % (prjct_nm, filt_raref), all_sh_pbs,
                             '%s.prm%s' % (prjct_nm, filt_raref),
                             run_params["time"], run_params["n_nodes"], run_params["n_procs"],
                             run_params["mem_num"], run_params["mem_dim"],
-                            qiime_env, chmod, noloc, jobs, chunkit)
+                            qiime_env, chmod, noloc, jobs, chunkit, None, sizes)
     if main_sh:
         if p_distance_decay:
             print("# decay (config in %s)" % p_distance_decay)
@@ -9,9 +9,10 @@
 import os
 import pandas as pd
 from os.path import basename, isfile, splitext
-import multiprocessing
 
 from routine_qiime2_analyses._routine_q2_xpbs import print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_pool import run_pool
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -19,7 +20,7 @@ from routine_qiime2_analyses._routine_q2_io_utils import (
     write_main_sh,
     read_meta_pd
 )
-from routine_qiime2_analyses._routine_q2_metadata import check_metadata_cases_dict
+from routine_qiime2_analyses._routine_q2_metadata import check_metadata_cases_dict, write_case_meta
 from routine_qiime2_analyses._routine_q2_cmds import (
     write_deicode_biplot,
     get_case, get_new_meta_pd
@@ -54,11 +55,11 @@ def run_single_deicode(odir: str, tsv: str, meta_pd: pd.DataFrame, case_var: str
             new_qza = '%s.qza' % cur_rad
             ordi_qza = '%s_deicode_ordination.qza' % cur_rad
             ordi_qzv = '%s_deicode_ordination_biplot.qzv' % cur_rad
-            if force or not isfile(ordi_qzv):
-                new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
-                if new_meta_pd.shape[0] < 10:
-                    continue
-                new_meta_pd.reset_index().to_csv(new_meta, index=False, sep='\t')
+            new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
+            if new_meta_pd.shape[0] < 10:
+                continue
+            new_meta = write_case_meta(new_meta, new_meta_pd)
+            if is_stale(force, ordi_qzv, (qza, new_meta)):
                 write_deicode_biplot(qza, new_meta, new_qza, ordi_qza,
                                      new_mat_qza, ordi_qzv, cur_sh_o)
                 remove = False
@@ -86,7 +87,7 @@ def run_deicode(i_datasets_folder: str, datasets: dict, datasets_rarefs: dict,
     """
     job_folder2 = get_job_folder(i_datasets_folder, 'deicode/chunks')
     main_cases_dict = get_main_cases_dict(p_perm_groups)
-    # jobs = []
+    deicode_tasks = []
     all_sh_pbs = {}
     for dat, tsv_meta_pds_ in datasets.items():
         out_sh = '%s/run_deicode_%s_%s%s.sh' % (job_folder2, prjct_nm, dat, filt_raref)
@@ -108,8 +109,9 @@ def run_deicode(i_datasets_folder: str, datasets: dict, datasets_rarefs: dict,
                                                                   cur_raref, case_var, filt_raref)
                 cur_sh = cur_sh.replace(' ', '-')
                 all_sh_pbs.setdefault((dat, out_sh), []).append(cur_sh)
-                run_single_deicode(odir, tsv, meta_pd, case_var,
-                                   case_vals_list, cur_sh, force)
+                deicode_tasks.append((odir, tsv, meta_pd, case_var,
+                                      case_vals_list, cur_sh, force))
+    run_pool(run_single_deicode, deicode_tasks, [x[5] for x in deicode_tasks])
 
     job_folder = get_job_folder(i_datasets_folder, 'deicode')
     main_sh = write_main_sh(job_folder, '3_run_beta_deicode_%s%s' % (filt_raref, prjct_nm), all_sh_pbs,
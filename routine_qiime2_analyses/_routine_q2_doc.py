@@ -13,6 +13,8 @@ import pandas as pd
 from os.path import isdir, isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_dag import set_dag_stage
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -20,7 +22,7 @@ from routine_qiime2_analyses._routine_q2_io_utils import (
     write_main_sh,
     read_meta_pd
 )
-from routine_qiime2_analyses._routine_q2_metadata import check_metadata_cases_dict
+from routine_qiime2_analyses._routine_q2_metadata import check_metadata_cases_dict, write_meta_pd
 from routine_qiime2_analyses._routine_q2_cmds import get_case, get_new_meta_pd, write_doc
 
 
@@ -48,9 +50,9 @@ def run_single_doc(i_dataset_folder: str, odir: str, tsv: str,
             new_qza = '%s/tab.qza' % cur_rad
             new_tsv = '%s/tab.tsv' % cur_rad
             new_tsv_token = '%s/tab.tsv' % cur_rad_token
-            if force or not isfile('%s/DO.tsv' % cur_rad):
-                new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
-                new_meta_pd.reset_index().to_csv(new_meta, index=False, sep='\t')
+            new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
+            write_meta_pd(new_meta, new_meta_pd.reset_index())
+            if is_stale(force, '%s/DO.tsv' % cur_rad, (qza, new_meta), (fp, fa, doc_params)):
                 write_doc(qza, fp, fa, new_meta, new_qza, new_tsv,
                           cur_rad, new_tsv_token, cur_rad_token,
                           n_nodes, n_procs, doc_params,
@@ -103,9 +105,9 @@ def run_single_doc(i_dataset_folder: str, odir: str, tsv: str,
                     new_qza = '%s/tab.qza' % cur_rad_phate_clust
                     new_tsv = '%s/tab.tsv' % cur_rad_phate_clust
                     new_tsv_token = '%s/tab.tsv' % cur_rad_phate_clust
-                    if force or not isfile('%s/DO.tsv' % cur_rad_phate_clust):
-                        new_meta_pd_phate = new_meta_pd.loc[samples_phate, :].copy()
-                        new_meta_pd_phate.reset_index().to_csv(new_meta, index=False, sep='\t')
+                    new_meta_pd_phate = new_meta_pd.loc[samples_phate, :].copy()
+                    write_meta_pd(new_meta, new_meta_pd_phate.reset_index())
+                    if is_stale(force, '%s/DO.tsv' % cur_rad_phate_clust, (qza, new_meta), (fp, fa, doc_params)):
                         write_doc(qza, fp, fa, new_meta, new_qza, new_tsv,
                                   cur_rad_phate_clust, new_tsv_token, cur_rad_token,
                                   n_nodes, n_procs, doc_params,
@@ -208,6 +210,7 @@ def run_doc(i_datasets_folder: str, datasets: dict, p_doc_config: str,
 
     do_r = 1
     if do_r:
+        set_dag_stage('doc_R')
         job_folder = get_job_folder(i_datasets_folder, 'doc/R')
         job_folder2 = get_job_folder(i_datasets_folder, 'doc/R/chunks')
         main_written = 0
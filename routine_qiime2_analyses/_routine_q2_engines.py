@@ -0,0 +1,38 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# engines computing several outputs from inputs loaded once (see resources/),
+# used instead of one qiime2 command per output when enabled.
+ENGINES = {'beta': False, 'permanova': False}
+
+
+def init_engines(beta_engine: bool = False, permanova_engine: bool = False) -> None:
+    """
+    Set which engines write the commands of their analyses.
+
+    :param beta_engine: Whether the non-phylogenetic beta diversity metrics
+        of each feature table are computed together by the beta engine.
+    :param permanova_engine: Whether the beta group significance tests of
+        each distance matrix are run together by the PERMANOVA engine.
+    """
+    ENGINES['beta'] = beta_engine
+    ENGINES['permanova'] = permanova_engine
+
+
+def beta_engine_mode() -> bool:
+    """
+    :return: whether the beta engine computes the non-phylogenetic metrics.
+    """
+    return ENGINES['beta']
+
+
+def permanova_engine_mode() -> bool:
+    """
+    :return: whether the PERMANOVA engine runs the beta group significance tests.
+    """
+    return ENGINES['permanova']
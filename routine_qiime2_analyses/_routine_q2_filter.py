@@ -17,9 +17,13 @@ import plotly
 import plotly.graph_objs as go
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder, get_raref_tab_meta_pds, get_raref_table, simple_chunks,
-    get_analysis_folder, filter_mb_table, filter_non_mb_table)
+    get_analysis_folder, get_filtering_grid,
+    get_read_pds, read_table_features, get_table_sums, get_table_matrix,
+    get_matrix_sums, get_matrix_pd, drop_empty_pd)
+from routine_qiime2_analyses._routine_q2_pool import run_pool
 from routine_qiime2_analyses._routine_q2_cmds import run_import
 from routine_qiime2_analyses._routine_q2_mmvec import get_mmvec_dicts
 from routine_qiime2_analyses._routine_q2_songbird import get_songbird_dicts
@@ -59,7 +63,7 @@ def import_datasets(i_datasets_folder: str, datasets: dict, datasets_phylo: dict
                         cur_sh.write('echo "%s"\n' % cmd)
                         cur_sh.write('%s\n' % cmd)
                         written += 1
-                    elif force or not isfile(qza):
+                    elif is_stale(force, qza, (tsv,)):
                         cmd = run_import(tsv, qza, 'FeatureTable[Frequency]')
                         cur_sh.write('echo "%s"\n' % cmd)
                         cur_sh.write('%s\n' % cmd)
@@ -189,51 +193,50 @@ def filter_rare_samples(i_datasets_folder: str, datasets: dict, datasets_read: d
             if isfile(qza) and isfile(meta_filt_fp):
                 # datasets_update[dat_filt] = [tab_filt_fp, meta_filt_fp]
                 datasets_update[dat_filt] = [[tab_filt_fp, meta_filt_fp]]
-                tab_filt_pd = pd.read_csv(tab_filt_fp, index_col=0, header=0, sep='\t')
-                with open(meta_filt_fp) as f:
-                    for line in f:
-                        break
-                meta_filt_pd = pd.read_csv(meta_filt_fp, header=0, sep='\t',
-                                           dtype={line.split('\t')[0]: str},
-                                           low_memory=False)
                 # datasets_read_update[dat_filt] = [tab_filt_pd, meta_filt_pd]
-                datasets_read_update[dat_filt] = [[tab_filt_pd, meta_filt_pd]]
+                datasets_read_update[dat_filt] = [[tab_filt_fp, meta_filt_fp]]
                 datasets_phylo_update[dat_filt] = datasets_phylo[dat]
+                tab_filt_features = set(read_table_features(tab_filt_fp))
                 datasets_features_update[dat_filt] = dict(
-                    gid_feat for gid_feat in datasets_features[dat].items() if gid_feat[1] in tab_filt_pd.index
+                    gid_feat for gid_feat in datasets_features[dat].items() if gid_feat[1] in tab_filt_features
                 )
                 continue
 
-            for (tab_pd, meta_pd) in tab_meta_pds_:
+            for tab_meta_pd in tab_meta_pds_:
+                tab_pd, meta_pd = get_read_pds(tab_meta_pd)
                 meta_pd = meta_pd.set_index('sample_name')
                 dat_filt = []
                 if names:
                     dat_filt.append('%srm' % len(names))
-                    tab_filt_pd = tab_pd[[x for x in tab_pd.columns if x not in names]].copy()
+                    tab_filt_pd = tab_pd[[x for x in tab_pd.columns if x not in names]]
                 else:
-                    tab_filt_pd = tab_pd.copy()
+                    tab_filt_pd = tab_pd
 
                 if thresh_sam:
+                    tab_filt_sums = get_table_sums(tab_filt_pd, 0)
                     if thresh_sam > 1:
-                        tab_filt_pd = tab_filt_pd.loc[:, tab_filt_pd.sum(0) >= thresh_sam]
+                        tab_filt_pd = tab_filt_pd.loc[:, tab_filt_sums >= thresh_sam]
                         dat_filt.append('minSam%s' % thresh_sam)
                     else:
-                        tab_perc_min = tab_filt_pd.sum(0).mean() * thresh_sam
-                        tab_filt_pd = tab_filt_pd.loc[:, tab_filt_pd.sum(0) >= tab_perc_min]
+                        tab_perc_min = tab_filt_sums.mean() * thresh_sam
+                        tab_filt_pd = tab_filt_pd.loc[:, tab_filt_sums >= tab_perc_min]
                         dat_filt.append('minSam%s' % str(thresh_sam).replace('.', ''))
 
                 if thresh_feat:
+                    # counts (or sample proportions) below the threshold are set to 0
+                    mat = get_table_matrix(tab_filt_pd)
                     if thresh_feat > 1:
-                        tab_filt_rm = tab_filt_pd < thresh_feat
+                        feat_data = mat.data
                         dat_filt.append('minFeat%s' % thresh_feat)
                     else:
-                        tab_perc = tab_filt_pd/tab_filt_pd.sum(0)
-                        tab_filt_rm = tab_perc < thresh_feat
+                        cols = np.repeat(np.arange(mat.shape[1]), np.diff(mat.indptr))
+                        feat_data = mat.data / get_matrix_sums(mat, 0)[cols]
                         dat_filt.append('minFeat%s' % str(thresh_feat).replace('.', ''))
-                    tab_filt_pd[tab_filt_rm] = 0
+                    mat.data[feat_data < thresh_feat] = 0
+                    mat.eliminate_zeros()
+                    tab_filt_pd = get_matrix_pd(mat, tab_filt_pd.index, tab_filt_pd.columns)
 
-                tab_filt_pd = tab_filt_pd.loc[tab_filt_pd.sum(1) > 0, :]
-                tab_filt_pd = tab_filt_pd.loc[:, tab_filt_pd.sum(0) > 0]
+                tab_filt_pd = drop_empty_pd(tab_filt_pd)
 
                 dat_filt = '%s_%s' % (dat, '-'.join(dat_filt))
                 if tab_filt_pd.shape[0] < 2 or tab_filt_pd.shape[1] < 2:
@@ -332,6 +335,7 @@ def explore_filtering(i_datasets_folder, datasets, datasets_read,
                 scales[(preval_label, abund_label)][(dat, mb)][0].add(preval)
                 scales[(preval_label, abund_label)][(dat, mb)][1].add(abund)
 
+    filt3d_tasks = []
     for (preval_label, abund_label), dats_d in scales.items():
         out_dir = get_analysis_folder(
             i_datasets_folder, 'filter3D/scale_%s_%s' % (preval_label, abund_label))
@@ -360,68 +364,80 @@ def explore_filtering(i_datasets_folder, datasets, datasets_read,
                     print('Must have run rarefaction to use it further...\nExiting')
                     sys.exit(0)
                 tsv_pd_, meta_pd_ = get_raref_tab_meta_pds(meta, tsv)
-                datasets_read[dat] = [[tsv_pd_, meta_pd_]]
+                datasets_read[dat] = [[tsv, meta]]
             else:
-                tsv_pd_, meta_pd_ = datasets_read[dat][0]
-
-            res = []
-            rdx = 0
-            prevals, abunds = prevals_abunds
-            for (preval, abund) in itertools.product(*[sorted(prevals), sorted(abunds)]):
-                rdx += 1
-                tsv_pd = tsv_pd_.loc[tsv_pd_.sum(1) > 0, :].copy()
-                tsv_pd = tsv_pd.loc[:, tsv_pd.sum(0) > 0]
-                if mb:
-                    tsv_pd, cur_res = filter_mb_table(preval, abund, tsv_pd, True)
-                else:
-                    tsv_pd, cur_res = filter_non_mb_table(preval, abund, tsv_pd, True)
-                if (preval, abund) in currents[(dat, mb)]:
-                    cur_res.append(1)
-                else:
-                    cur_res.append(0)
-                res.append(cur_res)
-            res_pd = pd.DataFrame(res, columns=['preval_filt', 'abund_filt', 'features',
-                                                'samples', 'data'])
-            res_pd['features'] = np.log10(res_pd['features']+1)
-            x = res_pd.preval_filt.unique()
-            y = res_pd.abund_filt.unique()
-            X, Y = np.meshgrid(x, y)
-            Z = res_pd.features.values.reshape(X.shape, order='f')
-
-            layout = go.Layout(
-                scene=dict(
-                    xaxis=dict(title=abund_label),
-                    yaxis=dict(title=preval_label),
-                    zaxis=dict(title='log10(features)')),
-                autosize=True,
-                width=700, height=700,
-                title="Filtering process",
-                margin=dict(l=65, r=50, b=65, t=90))
-            fig = go.Figure(
-                data=[
-                    go.Surface(
-                        x=Y, y=X, z=Z,
-                        colorscale='Viridis',
-                        reversescale=True)
-                ],
-                layout=layout
-            )
-            fig.update_traces(contours_z=dict(show=True, usecolormap=True,
-                                              highlightcolor="limegreen", project_z=True))
-            fig.add_scatter3d(
-                y=X.flatten(), x=Y.flatten(), z=Z.flatten(),
-                mode='markers', marker=dict(size=4, color='black'))
-            res_data_pd = res_pd.loc[(res_pd.data == 1)].copy()
-            x = res_data_pd.preval_filt.unique()
-            y = res_data_pd.abund_filt.unique()
-            X, Y = np.meshgrid(x, y)
-            Z = res_data_pd.features.values.reshape(X.shape, order='f')
-            fig.add_scatter3d(
-                y=X.flatten(), x=Y.flatten(), z=Z.flatten(),
-                mode='markers', marker=dict(size=6, color='red'))
+                tsv_pd_, meta_pd_ = get_read_pds(datasets_read[dat][0])
             html_fo = '%s/%s_%s.html' % (out_dir, dat, mb)
-            print(' -> Written:', html_fo)
-            plotly.offline.plot(fig, filename=html_fo, auto_open=False)
+            filt3d_tasks.append((tsv_pd_, prevals_abunds, currents[(dat, mb)],
+                                 mb, preval_label, abund_label, html_fo))
+    # the tables are only read by the workers, that each plot a dataset
+    run_pool(write_filtering_grid, filt3d_tasks)
+
+
+def write_filtering_grid(tsv_pd_: pd.DataFrame, prevals_abunds: tuple,
+                         currents: list, mb: bool, preval_label: str,
+                         abund_label: str, html_fo: str) -> None:
+    """
+    Plot the number of features left in a table after filtering for each
+    point of a grid of prevalence and abundance thresholds.
+
+    :param tsv_pd_: feature table.
+    :param prevals_abunds: prevalence and abundance thresholds of the grid.
+    :param currents: thresholds used for the dataset.
+    :param mb: whether the table is a metabolomics table.
+    :param preval_label: prevalence thresholds scale.
+    :param abund_label: abundance thresholds scale.
+    :param html_fo: output html plot.
+    """
+    prevals, abunds = prevals_abunds
+    tsv_pd_ = drop_empty_pd(tsv_pd_)
+    res = get_filtering_grid(tsv_pd_, prevals, abunds, mb)
+    for cur_res, (preval, abund) in zip(res, itertools.product(*[sorted(prevals), sorted(abunds)])):
+        if (preval, abund) in currents:
+            cur_res.append(1)
+        else:
+            cur_res.append(0)
+    res_pd = pd.DataFrame(res, columns=['preval_filt', 'abund_filt', 'features',
+                                        'samples', 'data'])
+    res_pd['features'] = np.log10(res_pd['features']+1)
+    x = res_pd.preval_filt.unique()
+    y = res_pd.abund_filt.unique()
+    X, Y = np.meshgrid(x, y)
+    Z = res_pd.features.values.reshape(X.shape, order='f')
+
+    layout = go.Layout(
+        scene=dict(
+            xaxis=dict(title=abund_label),
+            yaxis=dict(title=preval_label),
+            zaxis=dict(title='log10(features)')),
+        autosize=True,
+        width=700, height=700,
+        title="Filtering process",
+        margin=dict(l=65, r=50, b=65, t=90))
+    fig = go.Figure(
+        data=[
+            go.Surface(
+                x=Y, y=X, z=Z,
+                colorscale='Viridis',
+                reversescale=True)
+        ],
+        layout=layout
+    )
+    fig.update_traces(contours_z=dict(show=True, usecolormap=True,
+                                      highlightcolor="limegreen", project_z=True))
+    fig.add_scatter3d(
+        y=X.flatten(), x=Y.flatten(), z=Z.flatten(),
+        mode='markers', marker=dict(size=4, color='black'))
+    res_data_pd = res_pd.loc[(res_pd.data == 1)].copy()
+    x = res_data_pd.preval_filt.unique()
+    y = res_data_pd.abund_filt.unique()
+    X, Y = np.meshgrid(x, y)
+    Z = res_data_pd.features.values.reshape(X.shape, order='f')
+    fig.add_scatter3d(
+        y=X.flatten(), x=Y.flatten(), z=Z.flatten(),
+        mode='markers', marker=dict(size=6, color='red'))
+    print(' -> Written:', html_fo)
+    plotly.offline.plot(fig, filename=html_fo, auto_open=False)
 
 
 # def clear_poor_datasets(
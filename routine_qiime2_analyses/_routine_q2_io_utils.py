@@ -11,20 +11,33 @@ import re
 import sys
 import yaml
 import glob
+import json
+import itertools
 import pkg_resources
-import pandas as pd
 import numpy as np
+import pandas as pd
+from scipy import sparse
 from biom import load_table
 
 from pandas.util import hash_pandas_object
 from os.path import basename, dirname, splitext, isfile, isdir, abspath
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_runs import get_script_statements
+from routine_qiime2_analyses._routine_q2_arrays import arrays_mode, write_array_job
 from routine_qiime2_analyses._routine_q2_cmds import run_import, run_export, get_case, get_new_meta_pd
-from routine_qiime2_analyses._routine_q2_metadata import check_metadata_cases_dict
+from routine_qiime2_analyses._routine_q2_metadata import (
+    check_metadata_cases_dict, get_stored_meta_pd, write_meta_pd)
 
 RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
 
+# feature tables and metadata tables read on demand (file path -> table).
+READ_PDS = {}
+
+# number of permutations costing as much as one command without permutations.
+PERMUTATIONS_COST = 100.
+
 
 def summarize_songbirds(i_datasets_folder) -> pd.DataFrame:
     q2s = []
@@ -594,21 +607,36 @@ def get_raref_tab_meta_pds(meta: str, tsv: str) -> (pd.DataFrame, pd.DataFrame):
                 # path_pd : indexed with feature name
                 # meta_pd : not indexed -> "sample_name" as first column
 
+    The rarefied table is read on demand (see get_read_pds), so that the
+    callers can keep the files paths in datasets_read instead of the tables.
+
     :param meta: metadata for non-rarefied data.
     :param tsv: rarefied table.
     :return:
     """
-    tsv_pd = pd.read_csv(tsv, header=0, index_col=0, sep='\t', low_memory=False)
+    tsv_pd = get_read_pds([tsv, None])[0]
     meta_pd = read_meta_pd(meta)
     meta_raref_pd = meta_pd.loc[meta_pd.sample_name.isin(tsv_pd.columns.tolist()), :].copy()
-    meta_raref_pd.to_csv(meta, index=False, sep='\t')
+    write_meta_pd(meta, meta_raref_pd)
+    READ_PDS.pop(meta, None)
     return tsv_pd, meta_raref_pd
 
 
 def read_meta_pd(meta_tab: str, rep_col ='sample_name') -> pd.DataFrame:
     """
-    Read metadata wit first column as index.
+    Read metadata wit first column as index
+    (the file is parsed once per run, unless it changes).
+    :param meta: file path to the metadata file.
+    :return: metadata table.
+    """
+    return get_stored_meta_pd(meta_tab, rep_col, parse_meta_pd)
+
+
+def parse_meta_pd(meta_tab: str, rep_col: str) -> pd.DataFrame:
+    """
+    Parse metadata with the first column renamed.
     :param meta: file path to the metadata file.
+    :param rep_col: name for the first column.
     :return: metadata table.
     """
     meta_tab_sam_col = get_feature_sample_col(meta_tab)
@@ -617,19 +645,403 @@ def read_meta_pd(meta_tab: str, rep_col ='sample_name') -> pd.DataFrame:
     return meta_tab_pd
 
 
+def read_table_pd(path: str, chunksize: int = 10000) -> pd.DataFrame:
+    """
+    Read a feature table (.biom or .tsv) with the features as index,
+    as a sparse table (the .tsv is read by chunks of features, so that
+    the whole table is never held densely in memory).
+    The table is read from its binary copy if it is still valid, or
+    the binary copy is (re-)written for the next reads.
+
+    :param path: feature table file path.
+    :param chunksize: number of features per chunk.
+    :return: feature table.
+    """
+    stamp = get_table_stamp(path)
+    tab_pd = read_table_cache(path, stamp)
+    if tab_pd is not None:
+        return tab_pd
+    if path.endswith('.biom'):
+        tab_pd = to_sparse_pd(load_table(path).to_dataframe())
+    else:
+        feat_col = get_feature_sample_col(path)
+        tab_pds = [to_sparse_pd(tab_pd) for tab_pd in pd.read_csv(
+            path, header=0, sep='\t', dtype={feat_col: str}, index_col=0,
+            chunksize=chunksize, low_memory=False)]
+        tab_pd = pd.concat(tab_pds) if len(tab_pds) > 1 else tab_pds[0]
+        tab_pd.index.name = '#OTU ID'
+    write_table_cache(path, stamp, tab_pd)
+    return tab_pd
+
+
+def get_table_cache(path: str) -> str:
+    """
+    :param path: feature table file path.
+    :return: file path of the binary copy of the table (hidden, alongside it).
+    """
+    return os.path.join(dirname(path), '.%s.npz' % basename(path))
+
+
+def get_table_stamp(path: str) -> np.ndarray:
+    """
+    :param path: feature table file path.
+    :return: size and modification time of the table file.
+    """
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def encode_ids(ids) -> np.ndarray:
+    """
+    :param ids: features or samples names.
+    :return: names joined in one array of bytes.
+    """
+    return np.frombuffer('\n'.join(map(str, ids)).encode(), dtype=np.uint8)
+
+
+def decode_ids(ids_array: np.ndarray, n_ids: int) -> list:
+    """
+    :param ids_array: names joined in one array of bytes.
+    :param n_ids: number of names.
+    :return: features or samples names.
+    """
+    if not n_ids:
+        return []
+    return ids_array.tobytes().decode().split('\n')
+
+
+def read_table_cache(path: str, stamp: np.ndarray, ids_only: bool = False):
+    """
+    Read the binary copy of a feature table, if it was written for the
+    current version of the table file (same size and modification time).
+
+    :param path: feature table file path.
+    :param stamp: size and modification time of the table file.
+    :param ids_only: only read the features names.
+    :return: sparse feature table (or features names), or None if no valid copy.
+    """
+    cache = get_table_cache(path)
+    if not isfile(cache):
+        return None
+    try:
+        with np.load(cache) as npz:
+            if not np.array_equal(npz['stamp'], stamp):
+                return None
+            shape = tuple(npz['shape'])
+            index_name = npz['index_name'].tobytes().decode() or None
+            features = pd.Index(decode_ids(npz['features'], shape[0]), name=index_name, dtype=object)
+            if ids_only:
+                return features
+            samples = pd.Index(decode_ids(npz['samples'], shape[1]), dtype=object)
+            mat = sparse.csc_matrix((npz['data'], npz['indices'], npz['indptr']), shape=shape)
+    except (OSError, ValueError, KeyError, UnicodeDecodeError):
+        return None
+    return get_matrix_pd(mat, features, samples)
+
+
+def write_table_cache(path: str, stamp: np.ndarray, tab_pd: pd.DataFrame) -> None:
+    """
+    Write the binary copy of a feature table (sparse matrix and names),
+    stamped with the size and modification time of the table file.
+
+    :param path: feature table file path.
+    :param stamp: size and modification time of the table file (before reading).
+    :param tab_pd: feature table.
+    """
+    cache = get_table_cache(path)
+    mat = get_table_matrix(tab_pd)
+    try:
+        with open('%s.tmp' % cache, 'wb') as o:
+            np.savez(o, stamp=stamp, shape=np.array(mat.shape),
+                     data=mat.data, indices=mat.indices, indptr=mat.indptr,
+                     features=encode_ids(tab_pd.index), samples=encode_ids(tab_pd.columns),
+                     index_name=encode_ids([tab_pd.index.name or '']))
+        os.replace('%s.tmp' % cache, cache)
+    except OSError:
+        # the tables folder is not writable: read the table again next time
+        if isfile('%s.tmp' % cache):
+            os.remove('%s.tmp' % cache)
+
+
+def is_sparse_pd(tab_pd: pd.DataFrame) -> bool:
+    """
+    :param tab_pd: feature table.
+    :return: whether all the columns of the table are sparse.
+    """
+    return bool(tab_pd.shape[1]) and all(isinstance(x, pd.SparseDtype) for x in tab_pd.dtypes)
+
+
+def to_sparse_pd(tab_pd: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert a feature table to a sparse table (only non-zero counts stored).
+
+    :param tab_pd: feature table.
+    :return: sparse feature table.
+    """
+    if not tab_pd.shape[1] or is_sparse_pd(tab_pd):
+        return tab_pd
+    return get_matrix_pd(sparse.csc_matrix(tab_pd.values), tab_pd.index, tab_pd.columns)
+
+
+def get_table_matrix(tab_pd: pd.DataFrame) -> sparse.csc_matrix:
+    """
+    :param tab_pd: feature table (sparse or dense).
+    :return: features x samples sparse matrix of the table.
+    """
+    if is_sparse_pd(tab_pd):
+        mat = tab_pd.sparse.to_coo().tocsc()
+    else:
+        mat = sparse.csc_matrix(tab_pd.values)
+    mat.eliminate_zeros()
+    return mat
+
+
+def get_matrix_pd(mat: sparse.spmatrix, index: pd.Index, columns: pd.Index) -> pd.DataFrame:
+    """
+    :param mat: features x samples sparse matrix.
+    :param index: features names.
+    :param columns: samples names.
+    :return: sparse feature table.
+    """
+    tab_pd = pd.DataFrame.sparse.from_spmatrix(mat, index=index, columns=columns)
+    # the missing counts are zeros (pandas>=3 fills them with NaN)
+    return tab_pd.astype(pd.SparseDtype(mat.dtype, 0))
+
+
+def get_matrix_sums(mat: sparse.spmatrix, axis: int) -> np.ndarray:
+    """
+    :param mat: features x samples sparse matrix.
+    :param axis: 0 for the sums per sample, 1 for the sums per feature.
+    :return: sums.
+    """
+    return np.asarray(mat.sum(axis)).ravel()
+
+
+def get_table_sums(tab_pd: pd.DataFrame, axis: int) -> pd.Series:
+    """
+    :param tab_pd: feature table (sparse or dense).
+    :param axis: 0 for the sums per sample, 1 for the sums per feature.
+    :return: sums.
+    """
+    if not is_sparse_pd(tab_pd):
+        return tab_pd.sum(axis)
+    index = tab_pd.columns if axis == 0 else tab_pd.index
+    return pd.Series(get_matrix_sums(get_table_matrix(tab_pd), axis), index=index)
+
+
+def get_table_prevalences(tab_pd: pd.DataFrame) -> pd.Series:
+    """
+    :param tab_pd: feature table (sparse or dense).
+    :return: number of samples in which each feature is present.
+    """
+    if not is_sparse_pd(tab_pd):
+        return tab_pd.astype(bool).sum(1)
+    return pd.Series(get_table_matrix(tab_pd).getnnz(1), index=tab_pd.index)
+
+
+def drop_empty_pd(tab_pd: pd.DataFrame) -> pd.DataFrame:
+    """
+    Remove the features, then the samples, that have no counts.
+
+    :param tab_pd: feature table (sparse or dense).
+    :return: feature table without empty features and samples.
+    """
+    if not is_sparse_pd(tab_pd):
+        tab_pd = tab_pd.loc[tab_pd.sum(1) > 0, :]
+        return tab_pd.loc[:, tab_pd.sum(0) > 0]
+    mat = get_table_matrix(tab_pd)
+    rows = get_matrix_sums(mat, 1) > 0
+    mat = mat[rows, :]
+    cols = get_matrix_sums(mat, 0) > 0
+    return get_matrix_pd(mat[:, cols], tab_pd.index[rows], tab_pd.columns[cols])
+
+
+def get_expected_raref_pd(tab_pd: pd.DataFrame, samples: list) -> pd.DataFrame:
+    """
+    Get the table expected from a rarefaction that is not yet computed,
+    to plan its downstream analyses in the same call (--dag): the samples
+    kept at the rarefaction depth, with their (non-rarefied) counts and
+    features, i.e. a superset of the features of the rarefied table.
+    Only its samples and features IDs may be used: its counts are not
+    the rarefied counts (see write_filter_features).
+
+    :param tab_pd: feature table (sparse or dense) to rarefy.
+    :param samples: samples kept at the rarefaction depth.
+    :return: sparse feature table.
+    """
+    mat = get_table_matrix(tab_pd)
+    cols = tab_pd.columns.isin(samples)
+    mat = mat[:, cols]
+    rows = get_matrix_sums(mat, 1) > 0
+    return get_matrix_pd(mat[rows, :], tab_pd.index[rows], tab_pd.columns[cols])
+
+
+def get_collapsed_taxon(taxon: str, level: int) -> str:
+    """
+    :param taxon: taxonomic path of a feature.
+    :param level: taxonomic level to collapse to.
+    :return: name of the feature collapsed at this level (as qiime taxa collapse).
+    """
+    taxon = [x.strip() for x in taxon.split(';')]
+    return ';'.join(taxon[:level])
+
+
+def get_expected_collapsed_pd(tab_pd: pd.DataFrame, tax_fp: str,
+                              level: int, remove_empty: set) -> pd.DataFrame:
+    """
+    Get the table expected from a taxonomic collapse that is not yet
+    computed, to plan its downstream analyses in the same call (--dag).
+
+    :param tab_pd: feature table (sparse or dense) to collapse.
+    :param tax_fp: taxonomy of the features (Feature ID, Taxon).
+    :param level: taxonomic level to collapse to.
+    :param remove_empty: collapsed features to remove.
+    :return: sparse feature table.
+    """
+    tax_pd = pd.read_csv(tax_fp, header=0, sep='\t', dtype=str)
+    taxa = dict(zip(tax_pd.iloc[:, 0], tax_pd.iloc[:, 1].fillna('Unassigned')))
+    collapsed = [get_collapsed_taxon(taxa.get(x, 'Unassigned'), level) for x in tab_pd.index]
+    ids, inverse = np.unique(collapsed, return_inverse=True)
+    members = sparse.csr_matrix((np.ones(len(inverse)), (inverse, np.arange(len(inverse)))),
+                                shape=(len(ids), len(inverse)))
+    mat = members.dot(get_table_matrix(tab_pd)).tocsc()
+    rows = ~np.isin(ids, list(remove_empty))
+    mat = mat[rows, :]
+    cols = get_matrix_sums(mat, 0) > 0
+    return get_matrix_pd(mat[:, cols], pd.Index(ids[rows], name='#OTU ID'), tab_pd.columns[cols])
+
+
+def read_table_features(path: str) -> pd.Index:
+    """
+    Read only the features names of a feature table (.biom or .tsv).
+
+    :param path: feature table file path.
+    :return: features names.
+    """
+    if path in READ_PDS:
+        return READ_PDS[path].index
+    features = read_table_cache(path, get_table_stamp(path), True)
+    if features is not None:
+        return features
+    if path.endswith('.biom'):
+        return pd.Index(load_table(path).ids(axis='observation'))
+    feat_col = get_feature_sample_col(path)
+    return pd.Index(pd.read_csv(path, header=0, sep='\t', usecols=[0],
+                                dtype={feat_col: str}, low_memory=False)[feat_col])
+
+
+def get_read_pds(tab_meta: list) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Get the feature table and metadata table of a datasets_read entry,
+    reading them at first use if the entry holds their files paths.
+
+    :param tab_meta: [tsv table, meta table] or [tsv path, meta path].
+    :return: feature table and metadata table.
+    """
+    tab_pd, meta_pd = tab_meta
+    if isinstance(tab_pd, str):
+        if tab_pd not in READ_PDS:
+            READ_PDS[tab_pd] = read_table_pd(tab_pd)
+        tab_pd = READ_PDS[tab_pd]
+    if isinstance(meta_pd, str):
+        if meta_pd not in READ_PDS:
+            READ_PDS[meta_pd] = read_meta_pd(meta_pd)
+        meta_pd = READ_PDS[meta_pd]
+    return tab_pd, meta_pd
+
+
+def release_read_pds(tab_metas: list, keep: list = ()) -> None:
+    """
+    Release the tables of datasets_read entries that were read on demand
+    (they will be read again if needed).
+
+    :param tab_metas: datasets_read entries whose tables are released.
+    :param keep: datasets_read entries whose tables are still read later.
+    """
+    kept = set(path for tab_meta in keep for path in tab_meta if isinstance(path, str))
+    for tab_meta in tab_metas:
+        for path in tab_meta:
+            if isinstance(path, str) and path not in kept:
+                READ_PDS.pop(path, None)
+
+
+def get_script_cost(script: str, size: float = 1.) -> float:
+    """
+    Estimate the computing cost of a bash script as its number of commands,
+    each weighted by its number of permutations (if any, in units of
+    PERMUTATIONS_COST permutations), times the size of its input data (e.g.
+    samples x features of the table).
+
+    :param script: bash script file.
+    :param size: size of the input data of the script.
+    :return: estimated cost.
+    """
+    if not isfile(script):
+        return 0.
+    cost = 0.
+    with open(script) as f:
+        for statement in get_script_statements(f.readlines()):
+            command = ''.join(statement).strip()
+            if not command or command.startswith(('#', 'echo ')):
+                continue
+            weight = 1.
+            permutations = re.search(r'--p-permutations\s+(\d+)', command)
+            if permutations:
+                weight = max(1., int(permutations.group(1)) / PERMUTATIONS_COST)
+            cost += weight
+    return cost * size
+
+
+def get_lpt_chunks(costs: dict, chunkit: int) -> list:
+    """
+    Pack items into chunks of balanced total cost using the
+    longest-processing-time-first heuristic: items are taken by decreasing
+    cost and each is added to the chunk that has the lowest cost so far.
+
+    :param costs: estimated cost per item.
+    :param chunkit: number of chunks.
+    :return: list of (chunk cost, chunk items) for each chunk.
+    """
+    chunks = [[0., []] for _ in range(chunkit)]
+    for item in sorted(costs, key=lambda x: (-costs[x], str(x))):
+        chunk = min(chunks, key=lambda x: x[0])
+        chunk[0] += costs[item]
+        chunk[1].append(item)
+    return [(cost, items) for cost, items in chunks if items]
+
+
+def write_chunk_cost(out_sh: str, cost: float, n_items: int) -> None:
+    """
+    Write the predicted cost of a chunk next to its job script.
+
+    :param out_sh: chunk bash script file.
+    :param cost: predicted cost of the chunk.
+    :param n_items: number of scripts packed into the chunk.
+    """
+    with open('%s.cost' % splitext(out_sh)[0], 'w') as o:
+        o.write('predicted_cost\t%s\nscripts\t%s\n' % (round(cost, 2), n_items))
+
+
 def simple_chunks(run_pbs, job_folder2, to_chunk, analysis: str,
                   prjct_nm: str, time: str, n_nodes: str, n_procs: str,
                   mem_num: str, mem_dim: str, qiime_env: str, chmod: str,
-                  noloc: bool, jobs: bool, chunkit: int, tmp: str = None) -> None:
+                  noloc: bool, jobs: bool, chunkit: int, tmp: str = None,
+                  sizes: dict = None) -> None:
 
     warning = 0
+    array_scripts = []
     with open(run_pbs, 'w') as main_o:
 
         chunks = {}
+        chunks_costs = {}
         if chunkit and len(to_chunk) > chunkit:
-            for idx, keys in enumerate(np.array_split(to_chunk, chunkit)):
+            if sizes is None:
+                sizes = {}
+            costs = dict((x, get_script_cost(x, sizes.get(x, 1.))) for x in to_chunk)
+            for idx, (cost, keys) in enumerate(get_lpt_chunks(costs, chunkit)):
                 head_sh = '%s/%s_chunk%s.sh' % (job_folder2, analysis, idx)
                 chunks[(idx, head_sh)] = sorted(keys)
+                chunks_costs[head_sh] = (cost, len(keys))
         else:
             chunks = dict(
                 ((idx, '%s/%s_chunk%s.sh' % (job_folder2, analysis, idx)), [x]) for idx, x in enumerate(to_chunk))
@@ -644,9 +1056,13 @@ def simple_chunks(run_pbs, job_folder2, to_chunk, analysis: str,
                                 sh.write(line)
                                 cur_written = True
                         os.remove(cur_sh)
+            if cur_written and out_sh in chunks_costs:
+                write_chunk_cost(out_sh, *chunks_costs[out_sh])
+            out_pbs = '%s.pbs' % splitext(out_sh)[0]
             if jobs:
-                if cur_written:
-                    out_pbs = '%s.pbs' % splitext(out_sh)[0]
+                if cur_written and arrays_mode():
+                    array_scripts.append(out_sh)
+                elif cur_written:
                     run_xpbs(out_sh, out_pbs, '%s.%s.%s' % (prjct_nm, dat, analysis),
                              qiime_env, time, n_nodes, n_procs, mem_num, mem_dim,
                              chmod, 1, '', None, noloc, jobs, tmp)
@@ -658,14 +1074,26 @@ def simple_chunks(run_pbs, job_folder2, to_chunk, analysis: str,
                     os.remove(out_sh)
             else:
                 if cur_written:
+                    # written for the local runs, with the resources of the chunk
+                    run_xpbs(out_sh, out_pbs, '%s.%s.%s' % (prjct_nm, dat, analysis),
+                             qiime_env, time, n_nodes, n_procs, mem_num, mem_dim,
+                             chmod, 1, '', None, noloc, jobs, tmp)
                     main_o.write('sh %s\n' % out_sh)
                     warning += 1
 
+        if array_scripts:
+            array_pbs = write_array_job(
+                '%s/%s_array.sh' % (job_folder2, analysis), array_scripts,
+                '%s.%s' % (prjct_nm, analysis), qiime_env, time, n_nodes, n_procs,
+                mem_num, mem_dim, chmod, noloc, tmp)
+            main_o.write('qsub %s\n' % array_pbs)
+
 
 def write_main_sh(job_folder: str, analysis: str, all_sh_pbs: dict,
                   prjct_nm: str, time: str, n_nodes: str, n_procs: str,
                   mem_num: str, mem_dim: str, qiime_env: str, chmod: str,
-                  noloc: bool, jobs: bool, chunkit: int, tmp: str = None) -> str:
+                  noloc: bool, jobs: bool, chunkit: int, tmp: str = None,
+                  sizes: dict = None) -> str:
     """
     Write the main launcher of pbs scripts, written during using multiprocessing.
 
@@ -680,17 +1108,25 @@ def write_main_sh(job_folder: str, analysis: str, all_sh_pbs: dict,
     :param mem_dim: memory dimension to the number.
     :param qiime_env: qiime2-xxxx.xx conda environment.
     :param chmod: whether to change permission of output files (defalt: 775).
+    :param sizes: size of the input data of each sh script (to balance the chunks).
     :return: either the written launcher or nothing.
     """
     main_sh = '%s/%s.sh' % (job_folder, analysis)
     out_main_sh = ''
     warning = 0
+    array_scripts = []
     with open(main_sh, 'w') as main_o:
         chunks = {}
+        chunks_costs = {}
         if chunkit and len(all_sh_pbs) > chunkit:
-            for idx, keys in enumerate(np.array_split(list(all_sh_pbs.keys()), chunkit)):
+            if sizes is None:
+                sizes = {}
+            costs = dict((key, sum([get_script_cost(x, sizes.get(x, 1.)) for x in cur_shs]))
+                         for key, cur_shs in all_sh_pbs.items())
+            for idx, (cost, keys) in enumerate(get_lpt_chunks(costs, chunkit)):
                 head_sh = '%s/chunks/%s_chunk%s_%s.sh' % (job_folder, analysis, idx, prjct_nm)
-                chunks[(idx, head_sh)] = [x for key in keys for x in all_sh_pbs[tuple(key)]]
+                chunks[(idx, head_sh)] = [x for key in keys for x in all_sh_pbs[key]]
+                chunks_costs[head_sh] = (cost, len(chunks[(idx, head_sh)]))
         else:
             chunks = all_sh_pbs.copy()
 
@@ -704,9 +1140,13 @@ def write_main_sh(job_folder: str, analysis: str, all_sh_pbs: dict,
                                 sh.write(line)
                                 cur_written = True
                         os.remove(cur_sh)
+            if cur_written and out_sh in chunks_costs:
+                write_chunk_cost(out_sh, *chunks_costs[out_sh])
+            out_pbs = '%s.pbs' % splitext(out_sh)[0]
             if jobs:
-                if cur_written:
-                    out_pbs = '%s.pbs' % splitext(out_sh)[0]
+                if cur_written and arrays_mode():
+                    array_scripts.append(out_sh)
+                elif cur_written:
                     run_xpbs(out_sh, out_pbs, '%s.%s' % (prjct_nm, dat), qiime_env,
                              time, n_nodes, n_procs, mem_num, mem_dim, chmod, 1,
                              '', None, noloc, jobs, tmp)
@@ -719,9 +1159,21 @@ def write_main_sh(job_folder: str, analysis: str, all_sh_pbs: dict,
                     os.remove(out_sh)
             else:
                 if cur_written:
+                    # written for the local runs, with the resources of the chunk
+                    run_xpbs(out_sh, out_pbs, '%s.%s' % (prjct_nm, dat), qiime_env,
+                             time, n_nodes, n_procs, mem_num, mem_dim, chmod, 1,
+                             '', None, noloc, jobs, tmp)
                     main_o.write('sh %s\n' % out_sh)
                     out_main_sh = main_sh
                     warning += 1
+
+        if array_scripts:
+            array_pbs = write_array_job(
+                '%s/chunks/%s_array.sh' % (job_folder, analysis), array_scripts,
+                prjct_nm, qiime_env, time, n_nodes, n_procs,
+                mem_num, mem_dim, chmod, noloc, tmp)
+            main_o.write('qsub %s\n' % array_pbs)
+            out_main_sh = main_sh
     if warning > 40:
         print(' -> [WARNING] >40 jobs here: please check before running!')
     return out_main_sh
@@ -775,45 +1227,116 @@ def get_paths(i_datasets: tuple, i_datasets_folder: str) -> dict:
     return paths
 
 
-def gID_or_DNA(dat: str, path: str, path_pd: pd.DataFrame, datasets_read: dict,
+def get_features_cache(path: str) -> str:
+    """
+    :param path: feature table file path.
+    :return: file path of the features type detected for the table (hidden, alongside it).
+    """
+    return os.path.join(dirname(path), '.%s.features.json' % basename(path))
+
+
+def read_features_cache(path: str, stamp: np.ndarray) -> dict:
+    """
+    Read the features type detected for a feature table, if it was detected
+    for the current version of the table file (same size and modification time).
+
+    :param path: feature table file path.
+    :param stamp: size and modification time of the table file.
+    :return: detected features type, or None if no valid detection.
+    """
+    cache = get_features_cache(path)
+    if not isfile(cache):
+        return None
+    try:
+        with open(cache) as f:
+            detected = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if detected.get('stamp') != stamp.tolist():
+        return None
+    return detected
+
+
+def write_features_cache(path: str, stamp: np.ndarray, detected: dict) -> None:
+    """
+    Write the features type detected for a feature table, stamped with
+    the size and modification time of the table file.
+
+    :param path: feature table file path.
+    :param stamp: size and modification time of the table file (before reading).
+    :param detected: detected features type.
+    """
+    cache = get_features_cache(path)
+    try:
+        with open('%s.tmp' % cache, 'w') as o:
+            json.dump(dict(detected, stamp=stamp.tolist()), o)
+        os.replace('%s.tmp' % cache, cache)
+    except OSError:
+        # the tables folder is not writable: detect again next time
+        if isfile('%s.tmp' % cache):
+            os.remove('%s.tmp' % cache)
+
+
+def detect_features(features: pd.Index) -> dict:
+    """
+    Detect whether the features names are all genome IDs (with the gID ->
+    corrected feature name, i.e. no ';' or ' ') and/or DNA sequences.
+
+    :param features: features names of the feature table.
+    :return: the gIDs (or None), whether the names need correction, and
+        whether they are DNA sequences (None if the names are not strings).
+    """
+    if str(features.dtype) != 'object':
+        return {'gids': None, 'correction': False, 'dna': None}
+    names = features.astype(str)
+    # DNA sequences only have the [ACGTN] characters
+    dna = not names.str.contains('[^ACGTN]').any()
+    gids = names.str.extract(r'(G\d{9})', expand=False)
+    if gids.isna().any():
+        return {'gids': None, 'correction': False, 'dna': bool(dna)}
+    with_semicolons = names.str.contains(';', regex=False)
+    corrected = np.where(with_semicolons, names.str.replace(';', '|', regex=False).str.replace(
+        ' ', '', regex=False), names)
+    found_gids = dict(zip(gids.tolist(), corrected.tolist()))
+    if len(found_gids) != len(names):
+        found_gids = None
+    return {'gids': found_gids, 'correction': bool(with_semicolons.any()), 'dna': bool(dna)}
+
+
+def gID_or_DNA(dat: str, path: str, features: pd.Index,
                datasets_features: dict, datasets_phylo: dict) -> None:
     """
     Check whether the features of the current dataset are or contain:
     - genome IDs: then collect the gID -> corrected feature names for Web of Life tree shearing.
     - DNA sequences (e.g. typically deblur): then have a flag for sepp/phylo placement.
     (- to be developed for non-DNA OTU IDs associated with fasta sequences for sepp/phylo placement.)
+    The detection is kept alongside the table for the next runs.
 
     :param dat: name of the current dataset.
-    :param path: feature table file path in the ./data folder.
-    :param path_pd: feature table cotaining the features names in index.
-    :param datasets_read: dataset -> [tsv table, meta table] (here it updates tsv table after features correction)
+    :param path: feature table file path in the ./data folder (re-written after features correction).
+    :param features: features names of the feature table (None: read if not detected already).
     :param datasets_features: to be updated with {gID: corrected feature name (no ';' or ' ')} per dataset.
     :param datasets_phylo: to be updated with ('tree_to_use', 'corrected_or_not') per dataset.
     """
-    # regex to find the fist non-DNA character
-    not_dna = re.compile('[^ACGTN].*?')
-    if str(path_pd.index.dtype) == 'object':
-        features_names = path_pd.index.tolist()
-        # check if that's genome IDs
-        found_gids = {}
-        dna = True
-        correction_needed = False
-        for features_name in features_names:
-            if dna and bool(not_dna.search(features_name)):
-                dna = False
-            if re.search('G\d{9}', features_name):
-                if ';' in features_name:
-                    correction_needed = True
-                    features_name_corr = features_name.replace(';', '|').replace(' ', '')
-                else:
-                    features_name_corr = features_name
-                found_gids[re.search('G\d{9}', features_name).group(0)] = features_name_corr
-        if len(found_gids) == len(features_names):
+    stamp = get_table_stamp(path)
+    detected = read_features_cache(path, stamp)
+    if detected is None:
+        if features is None:
+            features = read_table_features(path)
+        detected = detect_features(features)
+        if not detected['correction']:
+            write_features_cache(path, stamp, detected)
+    if detected['dna'] is not None:
+        found_gids = detected['gids']
+        correction_needed = detected['correction']
+        dna = detected['dna']
+        if found_gids is not None:
             datasets_features[dat] = found_gids
             if correction_needed:
+                path_pd = read_table_pd(path)
                 path_pd.index = path_pd.index.str.replace(r'[; ]+', '|')
                 path_pd.reset_index().to_csv(path, index=False, sep='\t')
-                datasets_read[dat][0] = path_pd
+                READ_PDS[path] = path_pd
                 datasets_phylo[dat] = ('wol', 1)
             else:
                 datasets_phylo[dat] = ('wol', 0)
@@ -854,21 +1377,13 @@ def get_datasets(i_datasets: tuple, i_datasets_folder: str) -> (dict, dict, dict
         if not isfile(meta):
             print(meta, 'does not exist\n Skipping', dat)
             continue
-        if path.endswith('.biom'):
-            path_pd = load_table(path).to_dataframe()
-        else:
-            path_pd = read_meta_pd(path, '#OTU ID').set_index('#OTU ID')
-            # tab_feat_col = get_feature_sample_col(path)
-            # path_pd = pd.read_csv(path, header=0, index_col=0, sep='\t')
-        meta_sam_col = get_feature_sample_col(meta)
-        meta_pd = pd.read_csv(meta, header=0, sep='\t', dtype={meta_sam_col: str}, low_memory=False)
-        meta_pd.rename(columns={meta_sam_col: 'sample_name'}, inplace=True)
         datasets[dat] = [[path, meta]]
-        datasets_read[dat] = [[path_pd, meta_pd]]
+        # tables are read at first use (see get_read_pds)
+        datasets_read[dat] = [[path, meta]]
         datasets_features[dat] = {}
         datasets_phylo[dat] = ('', 0)
         datasets_rarefs[dat] = ['']
-        gID_or_DNA(dat, path, path_pd, datasets_read, datasets_features, datasets_phylo)
+        gID_or_DNA(dat, path, None, datasets_features, datasets_phylo)
     return datasets, datasets_read, datasets_features, datasets_phylo, datasets_rarefs
 
 
@@ -1052,30 +1567,58 @@ def get_run_params(p_run_params: str) -> dict:
 def filter_mb_table(preval: str, abund: str,
                     tsv_pd: pd.DataFrame,
                     do_res: bool=False) -> (pd.DataFrame, list):
-    preval = float(preval)
-    abund = float(abund)
-    if abund:
-        new_cols = {}
-        cur_index = tsv_pd.index.tolist()
-        cur_columns = tsv_pd.columns.tolist()
-        for col in cur_columns:
-            cur_col = tsv_pd[col]
-            min_thresh = min([x for x in cur_col if x > 0]) * abund
-            new_col = [x if x > min_thresh else 0 for x in cur_col]
-            new_cols[col] = new_col
-        tsv_pd = pd.DataFrame(new_cols, index=cur_index, columns = cur_columns)
-        tsv_pd = tsv_pd[tsv_pd.sum(1) > 1]
-    if preval:
-        if preval < 1:
-            n_perc = tsv_pd.shape[1] * preval
-        else:
-            n_perc = preval
-        tsv_pd = tsv_pd.loc[tsv_pd.astype(bool).sum(1) >= n_perc, :]
-    tsv_pd = tsv_pd.loc[:, tsv_pd.sum(0) > 0]
-    res = []
-    if do_res:
-        res = [preval, abund, tsv_pd.shape[0], tsv_pd.shape[1]]
-    return tsv_pd, res
+    return next(filter_mb_tables([(preval, abund)], tsv_pd, do_res))
+
+
+def filter_mb_tables(prevals_abunds: list, tsv_pd: pd.DataFrame,
+                     do_res: bool = False, tables: bool = True):
+    """
+    Filter a metabolomics table for several prevalence and abundance
+    thresholds in one pass: the matrix and the min count per sample are
+    computed once, and the abundance filtering once per abundance threshold.
+
+    :param prevals_abunds: (prevalence, abundance) thresholds.
+    :param tsv_pd: feature table.
+    :param do_res: whether to give the thresholds and the filtered table shape.
+    :param tables: whether to give the filtered tables (None otherwise).
+    :return: filtered table and results, per (prevalence, abundance) thresholds.
+    """
+    mat = get_table_matrix(tsv_pd)
+    index, columns = tsv_pd.index, tsv_pd.columns
+    coo = mat.tocoo()
+    # per sample, only keep the counts above its min (non-zero) count times abund
+    min_threshs = np.full(mat.shape[1], np.inf)
+    positive = coo.data > 0
+    np.minimum.at(min_threshs, coo.col[positive], coo.data[positive])
+    abund_mats = {}
+    for preval, abund in prevals_abunds:
+        preval = float(preval)
+        abund = float(abund)
+        if abund not in abund_mats:
+            abund_mat, abund_rows = mat, np.arange(mat.shape[0])
+            if abund:
+                data = np.where(coo.data > min_threshs[coo.col] * abund, coo.data, 0)
+                abund_mat = sparse.csc_matrix((data, (coo.row, coo.col)), shape=mat.shape, dtype=mat.dtype)
+                abund_mat.eliminate_zeros()
+                abund_rows = np.flatnonzero(get_matrix_sums(abund_mat, 1) > 1)
+                abund_mat = abund_mat[abund_rows, :]
+            abund_mats[abund] = (abund_mat, abund_rows, abund_mat.getnnz(1))
+        cur_mat, cur_rows, n_samples = abund_mats[abund]
+        if preval:
+            if preval < 1:
+                n_perc = mat.shape[1] * preval
+            else:
+                n_perc = preval
+            rows = n_samples >= n_perc
+            cur_mat, cur_rows = cur_mat[rows, :], cur_rows[rows]
+        cols = get_matrix_sums(cur_mat, 0) > 0
+        cur_pd = None
+        if tables:
+            cur_pd = get_matrix_pd(cur_mat[:, cols], index[cur_rows], columns[cols])
+        res = []
+        if do_res:
+            res = [preval, abund, cur_mat.shape[0], int(cols.sum())]
+        yield cur_pd, res
 
 
 def filter_non_mb_table(preval: str, abund: str,
@@ -1088,39 +1631,136 @@ def filter_non_mb_table(preval: str, abund: str,
         if do_res:
             res = [0, 0, tsv_pd.shape[0], tsv_pd.shape[1]]
         return tsv_pd, res
-    tsv_filt_pd = tsv_pd.copy()
+    mat = get_table_matrix(tsv_pd)
     # get the min number of samples based on prevalence percent
     if preval < 1:
-        n_perc = tsv_pd.shape[1] * preval
+        n_perc = mat.shape[1] * preval
     else:
         n_perc = preval
     # abundance filter in terms of min reads counts
-    tsv_pd_perc = tsv_filt_pd.copy()
-    tsv_pd_perc_sum = tsv_filt_pd.sum(1)
+    mat_perc = mat.tocoo()
+    perc_data = mat_perc.data
+    mat_perc_sum = get_matrix_sums(mat, 1)
     if abund < 1:
-        tsv_pd_perc = tsv_filt_pd / tsv_filt_pd.sum()
-        tsv_pd_perc_sum = tsv_filt_pd.sum(1) / tsv_filt_pd.sum(1).sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            perc_data = perc_data / get_matrix_sums(mat, 0)[mat_perc.col]
+        mat_perc_sum = mat_perc_sum / mat_perc_sum.sum()
     abund_mode = 'sample'
     # remove features from feature table that are not present
     # in enough samples with the minimum number/percent of reads in these samples
+    n_abund = np.bincount(mat_perc.row[perc_data > abund], minlength=mat.shape[0])
     if abund_mode == 'sample':
-        tsv_filt_pd = tsv_filt_pd.loc[(tsv_pd_perc > abund).sum(1) > n_perc, :]
+        rows = n_abund > n_perc
     elif abund_mode == 'dataset':
-        tsv_filt_pd = tsv_filt_pd.loc[tsv_pd_perc_sum > abund, :]
+        rows = mat_perc_sum > abund
     elif abund_mode == 'both':
-        tsv_filt_pd = tsv_filt_pd.loc[(tsv_pd_perc > abund).sum(1) > n_perc, :]
-        fil_pd_perc_sum = tsv_filt_pd.sum(1)
+        rows = n_abund > n_perc
+        fil_perc_sum = np.where(rows, get_matrix_sums(mat, 1), 0)
         if abund < 1:
-            fil_pd_perc_sum = tsv_filt_pd.sum(1) / tsv_filt_pd.sum(1).sum()
-        tsv_filt_pd = tsv_filt_pd.loc[fil_pd_perc_sum > abund, :]
+            fil_perc_sum = fil_perc_sum / fil_perc_sum.sum()
+        rows &= fil_perc_sum > abund
     else:
         raise Exception('"%s" mode not recognized' % abund_mode)
-    tsv_filt_pd = tsv_filt_pd.loc[tsv_filt_pd.sum(1) > 0, tsv_filt_pd.sum(0) > 0]
+    mat, index = mat[rows, :], tsv_pd.index[rows]
+    rows = get_matrix_sums(mat, 1) > 0
+    cols = get_matrix_sums(mat, 0) > 0
+    tsv_filt_pd = get_matrix_pd(mat[rows, :][:, cols], index[rows], tsv_pd.columns[cols])
     if do_res:
         res = [preval, abund, tsv_filt_pd.shape[0], tsv_filt_pd.shape[1]]
     return tsv_filt_pd, res
 
 
+def get_filtering_stats(coo, mb: bool, abund: float, min_threshs: np.ndarray,
+                        col_sums: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Get the statistics of the features and samples of a table that decide
+    whether they are kept after filtering for an abundance threshold and
+    any prevalence threshold (see get_filtering_grid).
+
+    :param coo: feature table matrix (COO format).
+    :param mb: whether the table is a metabolomics table.
+    :param abund: abundance threshold.
+    :param min_threshs: min non-zero count per sample (metabolomics).
+    :param col_sums: reads per sample (non metabolomics).
+    :return: sorted statistics of the features and of the samples.
+    """
+    n_feats, n_samples = coo.shape
+    if mb:
+        # number of samples left per feature after the abundance filter,
+        # or -1 if the feature is removed by the abundance filter
+        keep = coo.data > 0
+        if abund:
+            keep &= coo.data > min_threshs[coo.col] * abund
+        rows, cols = coo.row[keep], coo.col[keep]
+        feats = np.bincount(rows, minlength=n_feats)
+        if abund:
+            row_sums = np.bincount(rows, weights=coo.data[keep], minlength=n_feats)
+            feats = np.where(row_sums > 1, feats, -1)
+    else:
+        # number of samples with the min number/percent of reads per feature
+        perc_data = coo.data
+        if abund < 1:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                perc_data = perc_data / col_sums[coo.col]
+        feats = np.bincount(coo.row[perc_data > abund], minlength=n_feats)
+        keep = coo.data > 0
+        rows, cols = coo.row[keep], coo.col[keep]
+    # a sample is kept if one of its features is kept
+    samples = np.full(n_samples, -1)
+    np.maximum.at(samples, cols, feats[rows])
+    return np.sort(feats), np.sort(samples)
+
+
+def get_filtering_grid(tsv_pd: pd.DataFrame, prevals: set,
+                       abunds: set, mb: bool) -> list:
+    """
+    Get the number of features and samples left after filtering a table
+    for each point of a grid of prevalence and abundance thresholds, without
+    filtering the table: the statistics that decide whether the features and
+    samples are kept are computed once per abundance threshold and sorted, so
+    that those left for each prevalence threshold are counted by bisection.
+    The numbers are those of the tables filtered by filter_mb_table (or
+    filter_non_mb_table) for counts tables.
+
+    :param tsv_pd: feature table.
+    :param prevals: prevalence thresholds.
+    :param abunds: abundance thresholds.
+    :param mb: whether the table is a metabolomics table.
+    :return: thresholds and filtered table shape, per point of the grid
+        (in the order of the product of the sorted thresholds).
+    """
+    mat = get_table_matrix(tsv_pd)
+    coo = mat.tocoo()
+    min_threshs, col_sums = None, None
+    if mb:
+        min_threshs = np.full(mat.shape[1], np.inf)
+        positive = coo.data > 0
+        np.minimum.at(min_threshs, coo.col[positive], coo.data[positive])
+    else:
+        col_sums = get_matrix_sums(mat, 0)
+    stats = {}
+    res = []
+    for preval, abund in itertools.product(sorted(prevals), sorted(abunds)):
+        preval = float(preval)
+        abund = float(abund)
+        if not mb and preval + abund == 0:
+            res.append([0, 0, mat.shape[0], mat.shape[1]])
+            continue
+        if abund not in stats:
+            stats[abund] = get_filtering_stats(coo, mb, abund, min_threshs, col_sums)
+        feats, samples = stats[abund]
+        if preval < 1:
+            n_perc = mat.shape[1] * preval
+        else:
+            n_perc = preval
+        # metabolomics: present in at least, others: in more than n_perc samples
+        side = 'left' if mb else 'right'
+        n_feats = feats.size - np.searchsorted(feats, n_perc, side)
+        n_samples = samples.size - np.searchsorted(samples, n_perc, side)
+        res.append([preval, abund, int(n_feats), int(n_samples)])
+    return res
+
+
 def get_meta_alpha(raref_dir, dat_rt, raref):
     meta_rgx = '%s/meta_%s%s*_alphas_full.tsv' % (raref_dir, dat_rt, raref)
     meta = glob.glob(meta_rgx)
@@ -1222,18 +1862,17 @@ def get_datasets_filtered(
                 print(analysis, 'Must have run rarefaction to use it further...\nExiting')
                 sys.exit(0)
             tsv_pd_, meta_pd_ = get_raref_tab_meta_pds(meta, tsv)
-            datasets_read[dat] = [tsv_pd_, meta_pd_]
+            datasets_read[dat] = [[tsv, meta]]
             input_to_filtered[dat_] = dat
         else:
-            tsv_pd_, meta_pd_ = datasets_read[dat][0]
+            tsv_pd_, meta_pd_ = get_read_pds(datasets_read[dat][0])
             tsv, meta = datasets[dat][0]
             meta_alphas = get_meta_alpha(dirname(meta), dat, '')
             if meta_alphas and meta_alphas != meta:
                 meta_pd_ = read_meta_pd(meta_alphas)
             input_to_filtered[dat_] = dat
 
-        tsv_pd_ = tsv_pd_.loc[tsv_pd_.sum(1) > 0, :]
-        tsv_pd_ = tsv_pd_.loc[:, tsv_pd_.sum(0) > 0]
+        tsv_pd_ = drop_empty_pd(tsv_pd_)
         dat_filts = {}
         cases_dict = check_metadata_cases_dict(meta, meta_pd_, dict(subsets), 'songbird')
         for case_var, case_vals_list in cases_dict.items():
@@ -1242,11 +1881,14 @@ def get_datasets_filtered(
                 case_meta_pd = get_new_meta_pd(meta_pd_, case, case_var, case_vals)
                 case_tsv_pd = tsv_pd_[case_meta_pd.sample_name.tolist()]
                 dat_dir = get_analysis_folder(i_datasets_folder, '%s/datasets/%s/%s' % (analysis, dat, case))
-                prevals_abunds = filtering[(dat_, mb)]
-                for (preval_abund, preval, abund) in sorted(prevals_abunds):
+                prevals_abunds = sorted(filtering[(dat_, mb)])
+                if mb:
+                    # all the thresholds of the case in one pass
+                    mb_filtered = filter_mb_tables([x[1:] for x in prevals_abunds], case_tsv_pd)
+                for (preval_abund, preval, abund) in prevals_abunds:
                     # make sure there's no empty row / column
                     if mb:
-                        tsv_pd, res = filter_mb_table(preval, abund, case_tsv_pd)
+                        tsv_pd, res = next(mb_filtered)
                     else:
                         tsv_pd, res = filter_non_mb_table(preval, abund, case_tsv_pd)
                     rad_out = '%s_%s_%ss' % (dat, preval_abund, tsv_pd.shape[1])
@@ -1302,7 +1944,7 @@ def get_datasets_filtered(
                                     # print('USE MMVECs tsv')
                                     # print(' - - -', tsv_out_mmvec)
                                     tsv_out = tsv_out_mmvec
-                                elif force or not isfile(tsv_out):
+                                elif is_stale(force, tsv_out, (), (tsv_hash,)):
                                     # print(analysis, 'write: tsv_out', tsv_out)
                                     write_filtered_tsv(tsv_out, tsv_pd)
 
@@ -1311,7 +1953,7 @@ def get_datasets_filtered(
                                     # print(' - - -', tsv_qza_mmvec)
                                     # print(analysis, 'is file: tsv_qza_mmvec', tsv_qza_mmvec)
                                     tsv_qza = tsv_qza_mmvec
-                                elif force or not isfile(tsv_qza):
+                                elif is_stale(force, tsv_qza, (tsv_out,)):
                                     cmd = run_import(tsv_out, tsv_qza, 'FeatureTable[Frequency]')
                                     filt_jobs.append(cmd)
                                     # print(analysis, 'write (job): tsv_qza', tsv_qza)
@@ -1337,9 +1979,9 @@ def get_datasets_filtered(
                                 #     cmd = '\nrm %s\nln -s %s %s\n' % (meta_out, meta_out_src, meta_out)
                                 #     filt_jobs.append(cmd)
                             else:
-                                if force or not isfile(tsv_out):
+                                if is_stale(force, tsv_out, (), (tsv_hash,)):
                                     write_filtered_tsv(tsv_out, tsv_pd)
-                                if force or not isfile(tsv_qza):
+                                if is_stale(force, tsv_qza, (tsv_out,)):
                                     cmd = run_import(tsv_out, tsv_qza, 'FeatureTable[Frequency]')
                                     filt_jobs.append(cmd)
                                 already_computed[tsv_hash] = [[tsv_out, tsv_qza, meta_out]]
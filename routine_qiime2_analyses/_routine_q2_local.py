@@ -0,0 +1,221 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import re
+import time
+import subprocess
+import threading
+from os.path import abspath, basename, dirname, isdir, isfile, splitext
+
+LOCAL_HEADER = '# local resources: env=%s nodes=%s procs=%s mem=%s%s time=%s\n'
+LOCAL_HEADER_RE = re.compile(
+    r'^# local resources: env=(\S*) nodes=(\d+) procs=(\d+) mem=([\d.]+)([a-zA-Z]*) time=(\S*)$')
+
+
+def write_local_header(out_sh: str, qiime_env: str, n_nodes: str, n_procs: str,
+                       mem_num: str, mem_dim: str, time: str) -> None:
+    """
+    Add the resources of the job in the first line of a bash script
+    written for local runs (i.e. not prepared as a Torque job).
+
+    :param out_sh: bash script file.
+    :param qiime_env: qiime2-xxxx.xx conda environment.
+    :param n_nodes: number of nodes to use.
+    :param n_procs: number of processors to use.
+    :param mem_num: memory in number.
+    :param mem_dim: memory dimension to the number.
+    :param time: walltime in hours.
+    """
+    with open(out_sh) as f:
+        out_sh_lines = [x for x in f if not LOCAL_HEADER_RE.match(x.strip())]
+    with open(out_sh, 'w') as sh:
+        sh.write(LOCAL_HEADER % (qiime_env, n_nodes, n_procs, mem_num, mem_dim, time))
+        for out_sh_line in out_sh_lines:
+            sh.write(out_sh_line)
+
+
+def get_mem_mb(mem_num: str, mem_dim: str) -> float:
+    """
+    :param mem_num: memory in number.
+    :param mem_dim: memory dimension to the number.
+    :return: memory in megabytes.
+    """
+    dims = {'kb': 1 / 1024., 'mb': 1., 'gb': 1024., 'tb': 1024. * 1024}
+    return float(mem_num) * dims.get(mem_dim.lower(), 1.)
+
+
+def get_local_resources(out_sh: str) -> dict:
+    """
+    Read the resources of a bash script written for local runs.
+
+    :param out_sh: bash script file.
+    :return: resources (conda env, number of processors and memory in mb).
+    """
+    resources = {'env': '', 'procs': 1, 'mem': 0.}
+    with open(out_sh) as f:
+        for line in f:
+            header = LOCAL_HEADER_RE.match(line.strip())
+            if header:
+                env, n_nodes, n_procs, mem_num, mem_dim, walltime = header.groups()
+                resources['env'] = env
+                resources['procs'] = int(n_nodes) * int(n_procs)
+                resources['mem'] = get_mem_mb(mem_num, mem_dim)
+            break
+    return resources
+
+
+def get_machine_mem() -> float:
+    """
+    :return: total physical memory of the machine in megabytes.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024. * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 0.
+
+
+def get_launchers_scripts(launchers: tuple) -> list:
+    """
+    Parse the launchers written with --no-jobs into groups of bash scripts
+    that can run concurrently: each launcher is a group, as are the scripts
+    between two "wait" lines within a launcher.
+
+    :param launchers: launchers written with --no-jobs.
+    :return: groups of bash scripts.
+    """
+    groups = []
+    for launcher in launchers:
+        if not isfile(launcher):
+            print('Launcher %s do not exist: skipping...' % launcher)
+            continue
+        group = []
+        with open(launcher) as f:
+            for line in f:
+                line_split = line.strip().split()
+                if line_split == ['wait']:
+                    if group:
+                        groups.append(group)
+                    group = []
+                elif len(line_split) == 2 and line_split[0] == 'sh':
+                    script = line_split[1]
+                    if not isfile(script) and isfile('%s%s' % (os.getcwd(), script)):
+                        script = '%s%s' % (os.getcwd(), script)
+                    group.append(script)
+        if group:
+            groups.append(group)
+    return groups
+
+
+def get_local_log(script: str, logs: str) -> str:
+    """
+    Get the log file of a script, named after the job folder of the script
+    (e.g. jobs/beta/chunks) so that the scripts of the different analyses
+    that have the same name do not write to the same log.
+
+    :param script: bash script to run.
+    :param logs: folder where to write the log of the script.
+    :return: log file.
+    """
+    folders = abspath(dirname(script)).split(os.sep)
+    if 'jobs' in folders:
+        folders = folders[len(folders) - folders[::-1].index('jobs'):]
+    else:
+        folders = folders[-1:]
+    return '%s/%s.log' % (logs, '_'.join(folders + [splitext(basename(script))[0]]))
+
+
+def run_local_job(script: str, resources: dict, logs: str, exit_codes: dict,
+                  tokens: dict, tokens_lock: threading.Condition) -> None:
+    """
+    Run one bash script with its output streamed to a log file,
+    and give back its resource tokens when it is done.
+
+    :param script: bash script to run.
+    :param resources: conda env, processors and memory of the script.
+    :param logs: folder where to write the log of the script.
+    :param exit_codes: to be updated with the script exit code.
+    :param tokens: processors and memory available.
+    :param tokens_lock: lock on the available processors and memory
+        (notified when the script is done).
+    """
+    log = get_local_log(script, logs)
+    cmd = 'sh %s' % script
+    if resources['env']:
+        cmd = 'eval "$(conda shell.bash hook)" && conda activate %s && %s' % (resources['env'], cmd)
+    start = time.time()
+    print('[RUNNING] %s (log: %s)' % (script, log))
+    with open(log, 'w') as log_o:
+        ret = subprocess.call(['bash', '-c', cmd], stdout=log_o, stderr=subprocess.STDOUT)
+    print('[%s] %s (exit code %s, %ss)' % ('DONE' if not ret else 'FAILED', script,
+                                           ret, round(time.time() - start)))
+    with tokens_lock:
+        exit_codes[script] = ret
+        tokens['procs'] += resources['procs']
+        tokens['mem'] += resources['mem']
+        tokens_lock.notify_all()
+
+
+def run_local(launchers: tuple, p_cpus: int, p_mem: float, logs: str) -> dict:
+    """
+    Run the bash scripts of launchers written with --no-jobs in parallel on
+    the current machine, with the processors and memory of each script
+    (from run_params.yml) taken as tokens from the machine's total, so that
+    concurrent scripts never oversubscribe it.
+    The main thread is woken up by whichever script finishes first, to
+    start the next scripts or, as soon as a script failed, to stop starting
+    new ones and wait for the running ones before exiting.
+
+    :param launchers: launchers written with --no-jobs.
+    :param p_cpus: number of processors available.
+    :param p_mem: memory available in gigabytes.
+    :param logs: folder where to write the logs (default to next to the scripts).
+    :return: exit code per script.
+    """
+    if not p_cpus:
+        p_cpus = os.cpu_count()
+    mem_total = p_mem * 1024. if p_mem else get_machine_mem()
+    tokens = {'procs': p_cpus, 'mem': mem_total}
+    tokens_lock = threading.Condition()
+    exit_codes = {}
+    for group in get_launchers_scripts(launchers):
+        started = []
+        for script in group:
+            resources = get_local_resources(script)
+            # a script asking for more than the machine has runs alone
+            resources['procs'] = min(resources['procs'], p_cpus)
+            if mem_total:
+                resources['mem'] = min(resources['mem'], mem_total)
+            else:
+                resources['mem'] = 0.
+            script_logs = logs if logs else dirname(abspath(script))
+            if not isdir(script_logs):
+                os.makedirs(script_logs)
+            with tokens_lock:
+                while not [x for x in started if exit_codes.get(x)] and (
+                        tokens['procs'] < resources['procs'] or tokens['mem'] < resources['mem']):
+                    tokens_lock.wait()
+                if [x for x in started if exit_codes.get(x)]:
+                    break
+                tokens['procs'] -= resources['procs']
+                tokens['mem'] -= resources['mem']
+                started.append(script)
+            threading.Thread(
+                target=run_local_job,
+                args=(script, resources, script_logs, exit_codes, tokens, tokens_lock)).start()
+        with tokens_lock:
+            while [x for x in started if x not in exit_codes]:
+                tokens_lock.wait()
+        if [x for x in started if exit_codes[x]]:
+            print('Some scripts failed: not running the next scripts')
+            break
+    failed = sorted(x for x, ret in exit_codes.items() if ret)
+    print('\n%s scripts run, %s failed' % (len(exit_codes), len(failed)))
+    for script in failed:
+        print(' - %s (exit code %s)' % (script, exit_codes[script]))
+    return exit_codes
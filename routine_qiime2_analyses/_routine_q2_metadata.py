@@ -6,9 +6,186 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
 import re
+import hashlib
+import numpy as np
 import pandas as pd
-from os.path import basename
+from os.path import basename, dirname, isdir, isfile, splitext
+
+# metadata tables read during this run: (file, samples column) -> file stamp,
+# table and index of its columns. The tables read from a file keep their
+# entry key in their attrs (also after copy, set_index, etc).
+METAS = {}
+
+# samples of the cases of these metadata tables: (entry key, case variable,
+# case values) -> rows, and the metadata files written for these cases
+# (in the "cases" folder of the output tree, once set by init_cases).
+CASES = {'rows': {}, 'metas': {}, 'folder': ''}
+
+
+def init_cases(i_datasets_folder: str) -> None:
+    """
+    Set the folder of the shared metadata files of the cases.
+
+    :param i_datasets_folder: Path to the folder containing the data/metadata subfolders.
+    """
+    CASES['folder'] = '%s/qiime/cases' % i_datasets_folder
+
+
+def get_meta_stamp(meta: str) -> tuple:
+    """
+    :param meta: metadata file name.
+    :return: size and modification time of the file.
+    """
+    stat = os.stat(meta)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def get_stored_meta_pd(meta: str, rep_col: str, parser) -> pd.DataFrame:
+    """
+    Get a metadata table, parsed only once per run unless the file changed.
+
+    :param meta: metadata file name.
+    :param rep_col: name for the samples column.
+    :param parser: function parsing the file into a table.
+    :return: metadata table (a copy, free to be modified).
+    """
+    key = (meta, rep_col)
+    stamp = get_meta_stamp(meta)
+    if key not in METAS or METAS[key]['stamp'] != stamp:
+        meta_pd = parser(meta, rep_col)
+        meta_pd.attrs['meta'] = key + (stamp,)
+        METAS[key] = {'stamp': stamp, 'pd': meta_pd, 'columns': {}}
+    return METAS[key]['pd'].copy()
+
+
+def get_meta_column_index(meta_pd: pd.DataFrame, variable: str) -> dict:
+    """
+    Get the index of a metadata column (computed once per file and column):
+    its factors (as strings), number of unique values, the rows of each
+    value and the values as floats (if numeric).
+    Only given for tables with the rows of the file they were read from
+    (same index, or the samples as index) and the values of the column in
+    this file.
+
+    :param meta_pd: metadata table.
+    :param variable: metadata column.
+    :return: column index, or None if the table is not indexed.
+    """
+    key = meta_pd.attrs.get('meta')
+    if not key or variable not in meta_pd.columns:
+        return None
+    entry = METAS.get(key[:2])
+    if entry is None or entry['stamp'] != key[2]:
+        return None
+    if entry['pd'].shape[0] != meta_pd.shape[0] or variable not in entry['pd'].columns:
+        return None
+    # e.g. tables that were filtered, re-ordered or edited after being read
+    stored_pd = entry['pd']
+    if not meta_pd.index.equals(stored_pd.index) and not (
+            key[1] in stored_pd.columns and meta_pd.index.equals(pd.Index(stored_pd[key[1]]))):
+        return None
+    if not meta_pd[variable].reset_index(drop=True).equals(stored_pd[variable].reset_index(drop=True)):
+        return None
+    if variable not in entry['columns']:
+        column = entry['pd'][variable]
+        try:
+            floats = column.astype(float).values
+        except (ValueError, TypeError):
+            floats = None
+        uniques = column.unique()
+        entry['columns'][variable] = {
+            'factors': set(uniques.astype(str).tolist()),
+            'n_unique': uniques.size,
+            'rows': column.groupby(column, sort=False).indices,
+            'floats': floats
+        }
+    return entry['columns'][variable]
+
+
+def get_case_rows(meta_pd: pd.DataFrame, case_var: str, case_vals: list):
+    """
+    Get the rows of the samples of a case (computed once per metadata
+    file and case), for tables with the rows of the file they were read from.
+
+    :param meta_pd: metadata table.
+    :param case_var: metadata variable to make the case.
+    :param case_vals: values of the variable ('>' and '<' for numeric ranges).
+    :return: sorted rows of the case samples, or None if the table is not indexed.
+    """
+    column_index = get_meta_column_index(meta_pd, case_var)
+    if column_index is None:
+        return None
+    case_key = (meta_pd.attrs['meta'], case_var, tuple(case_vals))
+    if case_key not in CASES['rows']:
+        if len([x for x in case_vals if x[0] == '>' or x[0] == '<']):
+            if column_index['floats'] is None:
+                return None
+            keep = np.ones(meta_pd.shape[0], dtype=bool)
+            for case_val in case_vals:
+                if case_val[0] == '>':
+                    keep &= column_index['floats'] >= float(case_val[1:])
+                elif case_val[0] == '<':
+                    keep &= column_index['floats'] <= float(case_val[1:])
+            rows = np.flatnonzero(keep)
+        else:
+            rows = [column_index['rows'][x] for x in set(case_vals) if x in column_index['rows']]
+            rows = np.sort(np.concatenate(rows)) if rows else np.array([], dtype=int)
+        CASES['rows'][case_key] = rows
+    return CASES['rows'][case_key]
+
+
+def write_meta_pd(meta_fp: str, meta_pd: pd.DataFrame, index: bool = False) -> None:
+    """
+    Write a metadata table only if its content changed, so that the file
+    keeps its fingerprint for the commands that take it as input.
+
+    :param meta_fp: metadata file.
+    :param meta_pd: metadata table.
+    :param index: whether to write the index as first column.
+    """
+    content = meta_pd.to_csv(index=index, sep='\t')
+    if isfile(meta_fp):
+        with open(meta_fp) as f:
+            if f.read() == content:
+                return
+    if not isdir(dirname(meta_fp)):
+        os.makedirs(dirname(meta_fp))
+    with open(meta_fp, 'w') as o:
+        o.write(content)
+
+
+def write_case_meta(new_meta: str, new_meta_pd: pd.DataFrame, index: bool = True) -> str:
+    """
+    Write the metadata of a case. The case tables made from a metadata file
+    are written once per run in a single file (in the "cases" folder of the
+    output tree) that all the metrics and analyses share, and this file is
+    only re-written if its content changed.
+
+    :param new_meta: metadata file of the case, for tables not made from a file.
+    :param new_meta_pd: metadata table of the case (from get_new_meta_pd).
+    :param index: whether to write the index as first column.
+    :return: metadata file of the case.
+    """
+    out_pd = new_meta_pd.reset_index() if index else new_meta_pd
+    case_key = new_meta_pd.attrs.get('case')
+    if not CASES['folder'] or not case_key or len(CASES['rows'].get(case_key, ())) != out_pd.shape[0]:
+        write_meta_pd(new_meta, out_pd)
+        return new_meta
+    (meta, rep_col, stamp), case_var, case_vals = case_key
+    columns = tuple(out_pd.columns.tolist())
+    entry = METAS.get((meta, rep_col))
+    if entry is None or entry['stamp'] != stamp or columns != tuple(entry['pd'].columns.tolist()):
+        write_meta_pd(new_meta, out_pd)
+        return new_meta
+    meta_key = case_key + (columns,)
+    if meta_key not in CASES['metas']:
+        case_hash = hashlib.md5(str((rep_col, case_var, case_vals, columns)).encode()).hexdigest()
+        case_meta = '%s/%s_%s.meta' % (CASES['folder'], splitext(basename(meta))[0], case_hash)
+        write_meta_pd(case_meta, out_pd)
+        CASES['metas'][meta_key] = case_meta
+    return CASES['metas'][meta_key]
 
 
 def check_metadata_cases_dict(meta: str, meta_pd: pd.DataFrame,
@@ -29,7 +206,11 @@ def check_metadata_cases_dict(meta: str, meta_pd: pd.DataFrame,
             print('  [%s] variable %s not in %s' % (analysis, variable, basename(meta)))
             to_pop.add(variable)
         else:
-            factors = set(meta_pd[variable].unique().astype(str).tolist())
+            column_index = get_meta_column_index(meta_pd, variable)
+            if column_index:
+                factors = column_index['factors']
+            else:
+                factors = set(meta_pd[variable].unique().astype(str).tolist())
             for factors_list in factors_lists:
                 if factors_list[0][0] in ['>', '<']:
                     continue
@@ -157,7 +338,12 @@ def check_metadata_testing_groups(meta: str, meta_pd: pd.DataFrame,
         if variable not in meta_pd_vars:
             print('  [%s] variable %s not in %s' % (analysis, variable, basename(meta)))
             continue
-        if meta_pd[variable].unique().size > (meta_pd.shape[0] * .8):
+        column_index = get_meta_column_index(meta_pd, variable)
+        if column_index:
+            n_unique = column_index['n_unique']
+        else:
+            n_unique = meta_pd[variable].unique().size
+        if n_unique > (meta_pd.shape[0] * .8):
             print('  [%s] variable %s from %s not suitable for permanova' % (analysis, variable, basename(meta)))
             continue
         main_testing.append(variable)
@@ -19,6 +19,7 @@ from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder, get_analysis_folder, get_highlights_mmbird, get_songbird_outputs)
 from routine_qiime2_analyses._routine_q2_taxonomy import get_split_taxonomy
+from routine_qiime2_analyses._routine_q2_cmds import get_features_subset
 
 
 def get_mmvec_outputs(mmvec_outputs: list):
@@ -329,12 +330,7 @@ def get_heatmap_commands(
 
 def edit_ordi_qzv(ordi, ordi_fp, highlight, regexes_list, meta, meta_pd):
 
-    to_keep_feats = {}
-    for regex in regexes_list:
-        to_keep_feats[regex.lower()] = ordi.features.index.str.lower().str.contains(regex.lower())
-    to_keep_feats_pd = pd.DataFrame(to_keep_feats)
-    to_keep_feats = to_keep_feats_pd.any(axis=1)
-    feats_subset_list = ordi.features.index[to_keep_feats].tolist()
+    feats_subset_list = get_features_subset(ordi.features.index, regexes_list, ordi_fp)
 
     if feats_subset_list:
         ordi_edit = '%s_%s%s' % (
@@ -12,6 +12,8 @@ import pandas as pd
 from os.path import isdir, isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_dag import set_dag_stage
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -152,16 +154,16 @@ def get_common_datasets(i_datasets_folder: str, mmvec_pairs: dict, filtering: di
                     if meta_fp in common_datasets_done[pair]:
                         print('\t\t\t* [DONE]', pair, ':', omic1, filt1, omic2, filt2)
                         continue
-                    if force or not isfile(new_qza1):
+                    if is_stale(force, new_qza1, (qza1, meta_fp)):
                         cmd = filter_feature_table(qza1, new_qza1, meta_fp)
                         common_jobs.append(cmd)
-                    if force or not isfile(new_tsv1):
+                    if is_stale(force, new_tsv1, (new_qza1,)):
                         cmd = run_export(new_qza1, new_tsv1, 'FeatureTable')
                         common_jobs.append(cmd)
-                    if force or not isfile(new_qza2):
+                    if is_stale(force, new_qza2, (qza2, meta_fp)):
                         cmd = filter_feature_table(qza2, new_qza2, meta_fp)
                         common_jobs.append(cmd)
-                    if force or not isfile(new_tsv2):
+                    if is_stale(force, new_tsv2, (new_qza2,)):
                         cmd = run_export(new_qza2, new_tsv2, 'FeatureTable')
                         common_jobs.append(cmd)
                     print(
@@ -273,7 +275,8 @@ def run_single_mmvec(odir: str, meta_fp: str, qza1: str, qza2: str, res_dir: str
 
         summary = '%s/paired-summary.qzv' % odir
 
-        if force or not isfile(summary):
+        if is_stale(force, summary, (meta_fp, qza1, qza2),
+                    (batch, learn, epoch, prior, thresh_feat, latent_dim, train_column, n_example)):
             write_mmvec_cmd(meta_fp, qza1, qza2, res_dir, model_odir, null_odir,
                             ranks_tsv, ordination_tsv, stats,
                             ranks_null_tsv, ordination_null_tsv, stats_null,
@@ -378,9 +381,11 @@ def make_filtered_and_common_dataset(
             for cmd in pre_jobs:
                 import_o.write('\necho "%s"\n' % cmd)
                 import_o.write('%s\n' % cmd)
+        set_dag_stage('%s_imports' % analysis)
         run_xpbs(import_sh, import_pbs, '%s.mprt.mmsb.%s%s' % (prjct_nm, analysis, filt_raref),
                  qiime_env, '2', '1', '1', '150', 'mb', chmod, 1,
                  '# Import datasets for %s' % analysis, None, noloc, jobs)
+        set_dag_stage(analysis)
 
     return filt_datasets, common_datasets
 
@@ -14,6 +14,7 @@ import pkg_resources
 from os.path import basename, isdir, isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import print_message
+from routine_qiime2_analyses._routine_q2_pool import run_pool
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -98,6 +99,8 @@ def run_nestedness(i_datasets_folder: str, betas: dict, datasets_collapsed_map:
     nodfs_fps = {}
     all_sh_pbs = {}
     nestedness_res = {}
+    nestedness_tasks = []
+    nestedness_keys = []
     for dat, rarefs_metrics_groups_metas_qzas_dms_trees in betas.items():
         if not split:
             out_sh = '%s/run_nestedness_%s_%s%s.sh' % (job_folder2, prjct_nm, dat, filt_raref)
@@ -125,14 +128,18 @@ def run_nestedness(i_datasets_folder: str, betas: dict, datasets_collapsed_map:
                             cur_sh = cur_sh.replace(' ', '-')
                             # print("case", case)
                             all_sh_pbs.setdefault((dat, out_sh), []).append(cur_sh)
-                            res, group_case_nodfs = run_single_nestedness(odir, cur_raref, level,
-                                                        group, meta_pd, nodfs, nulls, modes,
-                                                        cur_sh, qza, case, case_var, case_vals,
-                                                        binary, params, force)
-                            nodfs_fps.setdefault(stats_tax_dat, []).extend(group_case_nodfs)
-                            nestedness_raref[(group, case)] = res
+                            nestedness_tasks.append((odir, cur_raref, level, group, meta_pd,
+                                                     nodfs, nulls, modes, cur_sh, qza, case,
+                                                     case_var, case_vals, binary, params, force))
+                            nestedness_keys.append((stats_tax_dat, nestedness_raref, (group, case)))
                 break
             nestedness_res[dat].append(nestedness_raref)
+    nestedness_results = run_pool(run_single_nestedness, nestedness_tasks,
+                                  [x[8] for x in nestedness_tasks])
+    for (stats_tax_dat, nestedness_raref, key), (res, group_case_nodfs) in zip(
+            nestedness_keys, nestedness_results):
+        nodfs_fps.setdefault(stats_tax_dat, []).extend(group_case_nodfs)
+        nestedness_raref[key] = res
 
     job_folder = get_job_folder(i_datasets_folder, 'nestedness')
     main_sh = write_main_sh(job_folder, '3_run_nestedness_%s%s' % (prjct_nm, filt_raref), all_sh_pbs,
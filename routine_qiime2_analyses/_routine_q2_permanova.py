@@ -12,6 +12,12 @@ import pkg_resources
 from os.path import basename, isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import print_message
+from routine_qiime2_analyses._routine_q2_pool import run_pool
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_dag import dag_planning
+from routine_qiime2_analyses._routine_q2_runs import is_planned
+from routine_qiime2_analyses._routine_q2_engines import permanova_engine_mode
+from routine_qiime2_analyses._routine_q2_sequential import SEQUENTIAL, sequential_mode
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -26,6 +32,7 @@ from routine_qiime2_analyses._routine_q2_metadata import (
 from routine_qiime2_analyses._routine_q2_cmds import (
     get_new_meta_pd, get_case,
     write_diversity_beta_group_significance,
+    write_permanova_engine,
     add_q2_types_to_meta
 )
 
@@ -33,11 +40,13 @@ from routine_qiime2_analyses._routine_q2_cmds import (
 def run_single_perm(odir: str, subset: str, meta_pd: pd.DataFrame,
                     cur_sh: str, metric: str, case_: str, testing_group: str,
                     p_beta_type: tuple, qza: str, mat_qza: str, case_var: str,
-                    case_vals: list, npermutations: str, force: bool) -> None:
+                    case_vals: list, npermutations: str, force: bool) -> list:
     """
     Run beta-group-significance: Beta diversity group significance.
     https://docs.qiime2.org/2019.10/plugins/available/diversity/beta-group-significance/
-    (in-loop function).
+    (in-loop function). With the PERMANOVA engine (and for sequential
+    permutation tests), the tests are returned to be run together with the
+    other tests of the same distance matrix.
 
     :param odir: output analysis directory.
     :param tsv: features table input to the beta diversity matrix.
@@ -49,7 +58,9 @@ def run_single_perm(odir: str, subset: str, meta_pd: pd.DataFrame,
     :param case_var:
     :param case_vals:
     :param force: Force the re-writing of scripts for all commands.
+    :return: (metadata, testing group, beta type, html) of the tests to run.
     """
+    tests = []
     remove = True
     with open(cur_sh, 'w') as cur_sh_o:
         case = '%s__%s__%s' % (metric, case_, testing_group)
@@ -59,22 +70,56 @@ def run_single_perm(odir: str, subset: str, meta_pd: pd.DataFrame,
         else:
             cur_rad = '%s/%s_%s' % (odir, splitext(basename(qza))[0], case)
         new_meta = '%s.meta' % cur_rad
+        new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
         for beta_type in p_beta_type:
             new_qzv = '%s_%s.qzv' % (cur_rad, beta_type)
             new_html = '%s_%s.html' % (cur_rad, beta_type)
             new_cv = '%s_%s.cv' % (cur_rad, beta_type)
             new_mat_qza = odir + '/' + basename(mat_qza).replace('.qza', '_%s_DM.qza' % case)
-            new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
             if add_q2_types_to_meta(new_meta_pd, new_meta, testing_group, new_cv):
                 continue
-            if force or not isfile(new_html):
+            if is_stale(force, new_html, (new_meta, mat_qza), (testing_group, beta_type, npermutations)):
                 if len([x for x in new_meta_pd[testing_group].unique() if str(x) != 'nan']) > 1:
+                    if permanova_engine_mode() or sequential_mode():
+                        tests.append((new_meta, testing_group, beta_type, new_html))
+                        continue
                     write_diversity_beta_group_significance(new_meta, mat_qza, new_mat_qza, testing_group,
                                                             beta_type, new_qzv, new_html, npermutations,
                                                             cur_sh_o)
                     remove = False
     if remove:
         os.remove(cur_sh)
+    return tests
+
+
+def write_permanova_engines(job_folder2: str, perm_tasks: list, perm_keys: list,
+                            perm_tests: list, all_sh_pbs: dict, sizes: dict,
+                            npermutations: int, run_params: dict) -> None:
+    """
+    Write, per distance matrix, a single script running all its tests.
+
+    :param job_folder2: folder of the scripts.
+    :param perm_tasks: arguments of run_single_perm() per task.
+    :param perm_keys: (dataset, launcher script) per task.
+    :param perm_tests: tests to run per task.
+    :param all_sh_pbs: collection of all the sh scripts transformed to pbs.
+    :param sizes: size of the input data of each sh script.
+    :param npermutations: number of permutations.
+    :param run_params: run parameters.
+    """
+    mat_tests = {}
+    for task, key, tests in zip(perm_tasks, perm_keys, perm_tests):
+        if tests:
+            mat_tests.setdefault((key, task[9]), []).append((task[3], tests))
+    for mdx, ((key, mat_qza), tasks_tests) in enumerate(mat_tests.items()):
+        cur_sh = '%s/run_beta_group_significance_%s_%s.sh' % (
+            job_folder2, mdx, splitext(basename(mat_qza))[0])
+        with open(cur_sh, 'w') as cur_sh_o:
+            write_permanova_engine(mat_qza, [x for _, tests in tasks_tests for x in tests],
+                                   npermutations, cur_sh_o,
+                                   run_params["n_nodes"], run_params["n_procs"])
+        all_sh_pbs.setdefault(key, []).append(cur_sh)
+        sizes[cur_sh] = sum([sizes.get(task_sh, 1.) for task_sh, _ in tasks_tests])
 
 
 def run_permanova(i_datasets_folder: str, betas: dict, main_testing_groups: tuple,
@@ -102,9 +147,14 @@ def run_permanova(i_datasets_folder: str, betas: dict, main_testing_groups: tupl
     main_cases_dict = get_main_cases_dict(p_perm_groups)
 
     npermutations = 999
+    if sequential_mode():
+        npermutations = SEQUENTIAL['max']
 
     metric_check = set()
     all_sh_pbs = {}
+    sizes = {}
+    perm_tasks = []
+    perm_keys = []
     first_print = 0
     for dat, metric_groups_metas_qzas_dms_trees_ in betas.items():
         permanovas[dat] = []
@@ -120,7 +170,7 @@ def run_permanova(i_datasets_folder: str, betas: dict, main_testing_groups: tupl
                                                                                dat, metric, filt_raref)
                 for subset, metas_qzas_mat_qzas_trees in subset_files.items():
                     (meta, qza, mat_qza, tree) = metas_qzas_mat_qzas_trees[0]
-                    if not isfile(mat_qza):
+                    if not isfile(mat_qza) and not (dag_planning() and is_planned(mat_qza)):
                         if not first_print:
                             print('Beta diversity, distances matrices must be generated already to automatise PERMANOVA\n'
                                   '\t(re-run this after steps "2_run_beta.sh" and "2x_run_beta_export.pbs" are done)')
@@ -137,6 +187,7 @@ def run_permanova(i_datasets_folder: str, betas: dict, main_testing_groups: tupl
                         testing_groups_case_var = list(set(testing_groups + [case_var]))
                         for case_vals in case_vals_list:
                             case = get_case(case_vals, case_var).replace(' ', '_')
+                            case_size = get_new_meta_pd(meta_pd, case, case_var, case_vals).shape[0]
                             for testing_group in testing_groups_case_var:
                                 if testing_group == 'ALL':
                                     continue
@@ -144,16 +195,22 @@ def run_permanova(i_datasets_folder: str, betas: dict, main_testing_groups: tupl
                                     job_folder2, dat, cur_depth, metric, subset, case, testing_group, filt_raref)
                                 cur_sh = cur_sh.replace(' ', '-')
                                 all_sh_pbs.setdefault((dat, out_sh), []).append(cur_sh)
-                                run_single_perm(odir, subset, meta_pd, cur_sh, metric, case,
-                                                testing_group, p_beta_type, qza, mat_qza,
-                                                case_var, case_vals, npermutations, force)
+                                sizes[cur_sh] = case_size ** 2
+                                perm_tasks.append((odir, subset, meta_pd, cur_sh, metric, case,
+                                                   testing_group, p_beta_type, qza, mat_qza,
+                                                   case_var, case_vals, npermutations, force))
+                                perm_keys.append((dat, out_sh))
+    perm_tests = run_pool(run_single_perm, perm_tasks, [x[3] for x in perm_tasks])
+    if permanova_engine_mode() or sequential_mode():
+        write_permanova_engines(job_folder2, perm_tasks, perm_keys, perm_tests,
+                                all_sh_pbs, sizes, npermutations, run_params)
 
     job_folder = get_job_folder(i_datasets_folder, 'permanova')
     main_sh = write_main_sh(job_folder, '3_run_beta_group_significance_%s%s' % (prjct_nm, filt_raref), all_sh_pbs,
                             '%s.prm%s' % (prjct_nm, filt_raref),
                             run_params["time"], run_params["n_nodes"], run_params["n_procs"],
                             run_params["mem_num"], run_params["mem_dim"],
-                            qiime_env, chmod, noloc, jobs, chunkit)
+                            qiime_env, chmod, noloc, jobs, chunkit, None, sizes)
     if main_sh:
         if p_perm_groups:
             print("# PERMANOVA (groups config in %s)" % p_perm_groups)
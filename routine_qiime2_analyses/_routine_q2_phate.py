@@ -9,9 +9,10 @@
 import os
 import glob
 import pandas as pd
-from os.path import isdir, isfile, splitext
+from os.path import isdir, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -20,7 +21,7 @@ from routine_qiime2_analyses._routine_q2_io_utils import (
     read_meta_pd,
 )
 from routine_qiime2_analyses._routine_q2_metadata import (
-    check_metadata_cases_dict
+    check_metadata_cases_dict, write_meta_pd
 )
 from routine_qiime2_analyses._routine_q2_cmds import (
     get_new_meta_pd, get_case, write_phate_cmd
@@ -49,9 +50,9 @@ def run_single_phate(dat: str, odir: str, tsv: str, meta_pd: pd.DataFrame, case_
             if len(glob.glob('%s/TOO_FEW.*' % cur_rad)):
                 continue
             cases[case] = phate_tsv
-            if force or not isfile(phate_html) or not isfile(phate_tsv):
-                new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
-                new_meta_pd.reset_index().to_csv(new_meta, index=False, sep='\t')
+            new_meta_pd = get_new_meta_pd(meta_pd, case, case_var, case_vals)
+            write_meta_pd(new_meta, new_meta_pd.reset_index())
+            if is_stale(force, (phate_html, phate_tsv), (qza, new_meta), (fp, fa, phate_labels, phate_params)):
                 write_phate_cmd(qza, new_qza, new_tsv, new_meta, fp, fa,
                                 phate_html, phate_labels, phate_params,
                                 run_params["n_nodes"], run_params["n_procs"],
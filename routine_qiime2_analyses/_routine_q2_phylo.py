@@ -12,12 +12,16 @@ from os.path import isfile, splitext
 import pandas as pd
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_dag import dag_planning
+from routine_qiime2_analyses._routine_q2_runs import is_planned
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
     get_wol_tree,
     get_sepp_tree,
-    get_raref_tab_meta_pds
+    get_raref_tab_meta_pds,
+    get_read_pds
 )
 from routine_qiime2_analyses._routine_q2_cmds import (
     write_fragment_insertion, write_seqs_fasta)
@@ -80,12 +84,12 @@ def run_sepp(i_datasets_folder: str, datasets: dict, datasets_read: dict,
                                 print('Must have run rarefaction to use it further...\nExiting')
                                 sys.exit(0)
                             tsv_pd, meta_pd = get_raref_tab_meta_pds(meta, tsv)
-                            datasets_read[dat][idx] = [tsv_pd, meta_pd]
+                            datasets_read[dat][idx] = [tsv, meta]
                         else:
-                            tsv_pd, meta_pd = datasets_read[dat][idx]
+                            tsv_pd, meta_pd = get_read_pds(datasets_read[dat][idx])
 
                         qza = '%s.qza' % splitext(tsv)[0]
-                        if not isfile(qza):
+                        if not isfile(qza) and not (dag_planning() and is_planned(qza)):
                             print('Need to first import %s to .qza to do reads placement '
                                   '(see "# Import tables to qiime2")\nExiting...' % tsv)
                             sys.exit(0)
@@ -111,12 +115,12 @@ def run_sepp(i_datasets_folder: str, datasets: dict, datasets_read: dict,
                         out_fp_sepp_plac = '%s/plac_%s%s.qza' % (odir_sepp, dat, cur_raref)
 
                         written = 0
-                        if force or not isfile(out_fp_seqs_qza):
+                        if is_stale(force, out_fp_seqs_qza, (tsv,)):
                             cmd = write_seqs_fasta(out_fp_seqs_fasta, out_fp_seqs_qza, tsv_pd)
                             cur_sh.write('echo "%s"\n' % cmd)
                             cur_sh.write('%s\n\n' % cmd)
                             written += 1
-                        if force or not isfile(out_fp_sepp_tree):
+                        if is_stale(force, out_fp_sepp_tree, (qza, out_fp_seqs_qza, ref_tree_qza)):
                             write_fragment_insertion(out_fp_seqs_qza, ref_tree_qza,
                                                      out_fp_sepp_tree, out_fp_sepp_plac,
                                                      qza, qza_in, qza_out, cur_sh)
@@ -174,9 +178,9 @@ def shear_tree(i_datasets_folder: str, datasets: dict, datasets_read: dict, data
                                 print('Must have run rarefaction to use it further...\nExiting')
                                 sys.exit(0)
                             tsv_pd, meta_pd = get_raref_tab_meta_pds(meta, tsv)
-                            datasets_read[dat][idx] = [tsv_pd, meta_pd]
+                            datasets_read[dat][idx] = [tsv, meta]
                         else:
-                            tsv_pd, meta_pd = datasets_read[dat][idx]
+                            tsv_pd, meta_pd = get_read_pds(datasets_read[dat][idx])
                         cur_raref = datasets_rarefs[dat][idx]
                         cur_datasets_features = dict(
                             gid_feat for gid_feat in datasets_features[dat].items() if gid_feat[1] in tsv_pd.index)
@@ -192,7 +196,7 @@ def shear_tree(i_datasets_folder: str, datasets: dict, datasets_read: dict, data
                         if not idx:
                             trees[dat] = ('', wol_features_qza)
 
-                        if force or not isfile(wol_features_qza):
+                        if is_stale(force, wol_features_qza, (tsv,)):
                             wol_features = wol.shear(list(cur_datasets_features.keys()))
                             # rename the tip per the features names associated with each gID
                             for tip in wol_features.tips():
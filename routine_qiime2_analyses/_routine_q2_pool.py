@@ -0,0 +1,109 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import sys
+import multiprocessing
+from contextlib import redirect_stdout
+
+from routine_qiime2_analyses._routine_q2_cache import (
+    start_fingerprints_journal, stop_fingerprints_journal, apply_fingerprints_journal
+)
+from routine_qiime2_analyses._routine_q2_runs import (
+    start_runs_journal, stop_runs_journal, apply_runs_journal
+)
+from routine_qiime2_analyses._routine_q2_xpbs import write_pbs_batch
+
+# planning workers state: the tasks are set before forking the workers,
+# so that only their index (and not their data) is sent to the workers.
+POOL = {'workers': 1, 'function': None, 'args': [], 'tasks': []}
+
+
+def init_pool(workers: int = None) -> None:
+    """
+    Set the number of processes used to plan independent tasks.
+
+    :param workers: number of processes.
+    """
+    POOL['workers'] = workers if workers else 1
+
+
+def pool_call(gdx: int) -> list:
+    """
+    Run one group of planning tasks in a worker, capturing for each task
+    what it prints and the fingerprints and commands it planned, to be
+    merged in the main process.
+
+    :param gdx: index of the group of tasks.
+    :return: per task: its index, result, exit code (if it exited), printed
+        text, updated fingerprints and planned commands.
+    """
+    calls = []
+    for tdx in POOL['tasks'][gdx]:
+        start_fingerprints_journal()
+        start_runs_journal()
+        result, code = None, None
+        out = io.StringIO()
+        with redirect_stdout(out):
+            try:
+                result = POOL['function'](*POOL['args'][tdx])
+            except SystemExit as e:
+                code = e.code
+        # the torque scripts of the task are rendered by the worker
+        write_pbs_batch()
+        calls.append((tdx, result, code, out.getvalue(),
+                      stop_fingerprints_journal(), stop_runs_journal()))
+        if code is not None:
+            break
+    return calls
+
+
+def run_pool(function, tasks: list, keys: list = None) -> list:
+    """
+    Run planning tasks (that each write their own scripts) across the
+    planning processes, and merge what they print and plan in the order of
+    the tasks so that the written scripts and launchers are those of a
+    serial run.
+
+    :param function: planning function.
+    :param tasks: arguments of each call to the planning function.
+    :param keys: key of each task (e.g. the script it writes): the tasks
+        sharing a key are run in order by the same process.
+    :return: results of each call, in the order of the tasks.
+    """
+    if POOL['workers'] <= 1 or len(tasks) < 2:
+        return [function(*task) for task in tasks]
+    if keys is None:
+        keys = range(len(tasks))
+    groups = {}
+    for tdx, key in enumerate(keys):
+        groups.setdefault(key, []).append(tdx)
+    # the torque scripts planned so far are rendered before forking
+    write_pbs_batch()
+    POOL['function'] = function
+    POOL['args'] = tasks
+    POOL['tasks'] = list(groups.values())
+    calls = {}
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(POOL['workers'], len(POOL['tasks']))) as pool:
+        for group_calls in pool.imap_unordered(pool_call, range(len(POOL['tasks']))):
+            for call in group_calls:
+                calls[call[0]] = call[1:]
+    POOL['function'] = None
+    POOL['args'] = []
+    POOL['tasks'] = []
+    results = []
+    for tdx in range(len(tasks)):
+        result, code, out, fingerprints, planned = calls[tdx]
+        sys.stdout.write(out)
+        apply_fingerprints_journal(fingerprints)
+        apply_runs_journal(planned)
+        if code is not None:
+            sys.exit(code)
+        results.append(result)
+    return results
@@ -2,9 +2,15 @@ import os
 import glob
 import itertools
 import pandas as pd
-from os.path import dirname, isfile, splitext
+from os.path import dirname, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_dag import set_dag_stage
+from routine_qiime2_analyses._routine_q2_pool import run_pool
+from routine_qiime2_analyses._routine_q2_sequential import (
+    SEQUENTIAL, get_permutations_increments, sequential_mode
+)
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -13,7 +19,7 @@ from routine_qiime2_analyses._routine_q2_io_utils import (
     read_meta_pd
 )
 from routine_qiime2_analyses._routine_q2_metadata import (
-    check_metadata_cases_dict
+    check_metadata_cases_dict, write_meta_pd
 )
 from routine_qiime2_analyses._routine_q2_cmds import (
     get_new_meta_pd, get_case,
@@ -27,10 +33,10 @@ def run_single_procrustes_mantel(procrustes_mantel: str, odir: str, dm1: str, dm
                                  case_vals: list, force: bool) -> None:
     remove = True
     with open(cur_sh, 'w') as cur_sh_o:
-        if force or not isfile(output):
-            new_meta_pd = get_new_meta_pd(meta_pd, cur, case_var, case_vals)
-            common_meta_fp = '%s/meta_%s.tsv' % (odir, cur)
-            new_meta_pd.to_csv(common_meta_fp, index=False, sep='\t')
+        new_meta_pd = get_new_meta_pd(meta_pd, cur, case_var, case_vals)
+        common_meta_fp = '%s/meta_%s.tsv' % (odir, cur)
+        write_meta_pd(common_meta_fp, new_meta_pd)
+        if is_stale(force, output, (dm1, dm2, common_meta_fp), (procrustes_mantel,)):
             if new_meta_pd.shape[0]:
                 write_procrustes_mantel(
                     procrustes_mantel, common_meta_fp, dm1, dm2,
@@ -127,6 +133,7 @@ def run_procrustes(i_datasets_folder: str, datasets_filt: dict, p_procrustes: st
     get_job_folder(i_datasets_folder, 'procrustes%s' % evaluation)
     dms_tab = []
     all_sh_pbs = {}
+    pm_tasks = []
     missing_dats = set()
     for pair, (dat1_, dat2_) in procrustes_pairs.items():
 
@@ -210,11 +217,12 @@ def run_procrustes(i_datasets_folder: str, datasets_filt: dict, p_procrustes: st
                         dm_out1_tsv = '%s.tsv' % splitext(dm_out1)[0]
                         dm_out2_tsv = '%s.tsv' % splitext(dm_out2)[0]
                         biplot = '%s/procrustes%s_%s__%s__%s.qzv' % (odir, evaluation, dat1_, dat2_, cur)
-                        run_single_procrustes_mantel('procrustes', odir, dm1, dm2, meta_pd, dm_out1, dm_out2,
-                                                     biplot, cur_sh, cur, case_var, case_vals, force)
+                        pm_tasks.append(('procrustes', odir, dm1, dm2, meta_pd, dm_out1, dm_out2,
+                                         biplot, cur_sh, cur, case_var, case_vals, force))
                         dms_tab.append([pair, dat1_, dat2_,
                                         group1, group2, case_, metric,
                                         dm_out1_tsv, dm_out2_tsv])
+    run_pool(run_single_procrustes_mantel, pm_tasks, [x[8] for x in pm_tasks])
 
     job_folder = get_job_folder(i_datasets_folder, 'procrustes%s' % evaluation)
     main_sh = write_main_sh(job_folder, '4_run_procrustes_%s%s%s' % (prjct_nm, evaluation, filt_raref), all_sh_pbs,
@@ -283,9 +291,28 @@ def run_procrustes(i_datasets_folder: str, datasets_filt: dict, p_procrustes: st
             o.write("        filin_tsv_pd2 <- data.matrix(filin_tsv_pd2)\n")
             o.write("        filin_tsv_pd1 <- filin_tsv_pd1[rownames(filin_tsv_pd2), rownames(filin_tsv_pd2)]\n")
             o.write("        # procrustes12 <- procrustes(filin_tsv_pd1, filin_tsv_pd2, kind=2, permutations=999)\n")
-            o.write("        prtst <- protest(filin_tsv_pd1, filin_tsv_pd2, permutations = 999)\n")
+            if sequential_mode():
+                # sequential permutation test: more permutations while the 99%
+                # (Wilson) interval of the p-value contains alpha (as in sequential_perms.py),
+                # each stage adding its permutations to those of the previous stages
+                o.write("        greater <- 0\n")
+                o.write("        done <- 0\n")
+                o.write("        for (perms in c(%s)) {\n" % ', '.join(map(str, get_permutations_increments())))
+                o.write("            prtst <- protest(filin_tsv_pd1, filin_tsv_pd2, permutations = perms)\n")
+                o.write("            greater <- greater + round(prtst$signif * (perms + 1)) - 1\n")
+                o.write("            done <- done + perms\n")
+                o.write("            p <- (greater + 1) / (done + 1)\n")
+                o.write("            z2n <- 2.5758^2 / (done + 1)\n")
+                o.write("            centre <- (p + z2n / 2) / (1 + z2n)\n")
+                o.write("            half <- sqrt(z2n * p * (1 - p) + z2n^2 / 4) / (1 + z2n)\n")
+                o.write("            if (centre + half < %s | centre - half > %s) break\n" % (
+                    SEQUENTIAL['alpha'], SEQUENTIAL['alpha']))
+                o.write("        }\n")
+            else:
+                o.write("        prtst <- protest(filin_tsv_pd1, filin_tsv_pd2, permutations = 999)\n")
+                o.write("        p <- prtst$signif\n")
             o.write("        n <- dim(filin_tsv_pd1)[1]\n")
-            o.write("        res[i,] <- c(pair, d1, d2, group1, group2, case, metric, f1, f2, n, prtst$ss, prtst$signif)\n")
+            o.write("        res[i,] <- c(pair, d1, d2, group1, group2, case, metric, f1, f2, n, prtst$ss, p)\n")
             o.write("    }\n")
             o.write("}\n")
             o.write("write.table(x = res, file = '%s')\n" % out_R)
@@ -295,6 +322,7 @@ def run_procrustes(i_datasets_folder: str, datasets_filt: dict, p_procrustes: st
         with open(out_sh, 'w') as o:
             o.write('R -f %s --vanilla\n' % R_script)
 
+        set_dag_stage('procrustes_R')
         run_xpbs(out_sh, out_pbs, '%s.prcrt%s.R%s' % (prjct_nm, evaluation, filt_raref), 'renv',
                  run_params["time"], run_params["n_nodes"], run_params["n_procs"],
                  run_params["mem_num"], run_params["mem_dim"], chmod, 1,
@@ -326,6 +354,7 @@ def run_mantel(i_datasets_folder: str, datasets_filt: dict, p_mantel: str,
     get_job_folder(i_datasets_folder, 'mantel%s' % evaluation)
 
     all_sh_pbs = {}
+    pm_tasks = []
     missing_dats = set()
     for pair, (dat1_, dat2_) in mantel_pairs.items():
 
@@ -406,8 +435,9 @@ def run_mantel(i_datasets_folder: str, datasets_filt: dict, p_mantel: str,
                         dm_out1 = '%s/dm_%s__%s_DM.qza' % (odir, dat1_, cur)
                         dm_out2 = '%s/dm_%s__%s_DM.qza' % (odir, dat2_, cur)
                         mantel_out = '%s/mantel%s_%s__%s__%s.qzv' % (odir, evaluation, dat1_, dat2_, cur)
-                        run_single_procrustes_mantel('mantel', odir, dm1, dm2, meta_pd, dm_out1, dm_out2,
-                                                     mantel_out, cur_sh, cur, case_var, case_vals, force)
+                        pm_tasks.append(('mantel', odir, dm1, dm2, meta_pd, dm_out1, dm_out2,
+                                         mantel_out, cur_sh, cur, case_var, case_vals, force))
+    run_pool(run_single_procrustes_mantel, pm_tasks, [x[8] for x in pm_tasks])
 
     job_folder = get_job_folder(i_datasets_folder, 'mantel%s' % evaluation)
     main_sh = write_main_sh(job_folder, '4_run_mantel_%s%s%s' % (prjct_nm, evaluation, filt_raref), all_sh_pbs,
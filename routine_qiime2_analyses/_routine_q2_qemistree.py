@@ -10,6 +10,7 @@ import pandas as pd
 from os.path import isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
 from routine_qiime2_analyses._routine_q2_cmds import write_qemistree, run_export
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
@@ -50,7 +51,7 @@ def run_qemistree(i_datasets_folder: str, datasets: dict, prjct_nm: str,
             classyfire_qza = '%s/%s-classyfire.qza' % (odir, dat)
             classyfire_tsv = '%s.tsv' % splitext(classyfire_qza)[0]
             with open(out_sh, 'w') as cur_sh:
-                if force or not isfile(classyfire_tsv):
+                if is_stale(force, classyfire_tsv, (feature_data, qemistree)):
                     write_qemistree(feature_data, classyfire_qza,
                                     classyfire_tsv, qemistree,
                                     cur_sh)
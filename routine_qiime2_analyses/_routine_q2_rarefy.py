@@ -7,16 +7,19 @@
 # ----------------------------------------------------------------------------
 
 import yaml
-import os, sys, glob
+import sys, glob
 import subprocess
 import numpy as np
-import pandas as pd
 from scipy.stats import skew
 from os.path import isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
-from routine_qiime2_analyses._routine_q2_io_utils import get_job_folder, get_analysis_folder, simple_chunks
+from routine_qiime2_analyses._routine_q2_dag import dag_planning
+from routine_qiime2_analyses._routine_q2_cache import is_stale
+from routine_qiime2_analyses._routine_q2_io_utils import (
+    get_job_folder, get_analysis_folder, get_read_pds, get_expected_raref_pd, simple_chunks)
 from routine_qiime2_analyses._routine_q2_cmds import write_rarefy, run_export
+from routine_qiime2_analyses._routine_q2_metadata import write_meta_pd
 np.set_printoptions(precision=2, suppress=True)
 
 
@@ -97,7 +100,7 @@ def run_rarefy(i_datasets_folder: str, datasets: dict, datasets_read: dict,
                 if eval_rarefs:
                     depths = datasets_raref_evals[dat]
 
-                tsv_pd, meta_pd = datasets_read[dat][0]
+                tsv_pd, meta_pd = get_read_pds(datasets_read[dat][0])
                 tsv_sums = tsv_pd.sum()
                 for tsv_meta_pds in tsv_meta_pds_:
                     tsv, meta = tsv_meta_pds
@@ -111,16 +114,16 @@ def run_rarefy(i_datasets_folder: str, datasets: dict, datasets_read: dict,
                         # depth_keeps = depths_keeps[dat]
                         remaining_samples = tsv_sums[tsv_sums >= depth].index.tolist()
                         meta_raref_pd = meta_pd.loc[meta_pd.sample_name.isin(remaining_samples), :]
-                        meta_raref_pd.to_csv(meta_out, index=False, sep='\t')
+                        write_meta_pd(meta_out, meta_raref_pd)
 
                         qza = tsv.replace('.tsv', '.qza')
                         qza_out = '%s/tab_%s.qza' % (odir, dat_raref)
                         tsv_out = '%s.tsv' % splitext(qza_out)[0]
-                        if force or not os.path.isfile(qza_out):
+                        if is_stale(force, qza_out, (qza,), (depth,)):
                             write_rarefy(qza, qza_out, str(depth), cur_sh)
                             main_written += 1
                             written += 1
-                        if force or not os.path.isfile(tsv_out):
+                        if is_stale(force, tsv_out, (qza_out,)):
                             cmd = run_export(qza_out, tsv_out, 'FeatureTable[Frequency]')
                             cur_sh.write('echo "%s"\n' % cmd)
                             cur_sh.write('%s\n\n' % cmd)
@@ -131,20 +134,22 @@ def run_rarefy(i_datasets_folder: str, datasets: dict, datasets_read: dict,
                             eval_depths.setdefault(dat, []).append('%s_%s' % (dat, str(depth)))
                             datasets_update['%s_%s' % (dat, str(depth))] = [[tsv_out, meta_out]]
                             # datasets_eval['%s_%s' % (dat, str(depth))] = [[tsv_out, meta_out]]
-                            datasets_read_update['%s_%s' % (dat, str(depth))] = ('raref', str(depth))
+                            if dag_planning() and not isfile(tsv_out):
+                                datasets_read_update['%s_%s' % (dat, str(depth))] = [[
+                                    get_expected_raref_pd(tsv_pd, remaining_samples), meta_raref_pd]]
+                            else:
+                                datasets_read_update['%s_%s' % (dat, str(depth))] = ('raref', str(depth))
                             datasets_phylo_update['%s_%s' % (dat, str(depth))] = datasets_phylo[dat]
                         else:
                             datasets_append.setdefault(dat, []).append([tsv_out, meta_out])
 
                             if isfile(tsv_out) and isfile(meta_out):
-                                tab_filt_pd = pd.read_csv(tsv_out, index_col=0, header=0, sep='\t')
-                                with open(meta_out) as f:
-                                    for line in f:
-                                        break
-                                meta_filt_pd = pd.read_csv(meta_out, header=0, sep='\t',
-                                                           dtype={line.split('\t')[0]: str},
-                                                           low_memory=False)
-                                datasets_read[dat].append([tab_filt_pd, meta_filt_pd])
+                                # read on demand (get_read_pds)
+                                datasets_read[dat].append([tsv_out, meta_out])
+                            elif dag_planning():
+                                # plan the downstream analyses against the table to come
+                                datasets_read[dat].append([
+                                    get_expected_raref_pd(tsv_pd, remaining_samples), meta_raref_pd])
                             else:
                                 datasets_read[dat].append(('raref', str(depth)))
                             datasets_rarefs.setdefault(dat, []).append('_raref%s%s' % (evaluation, str(depth)))
@@ -201,7 +206,8 @@ def check_rarefy_need(i_datasets_folder: str, datasets_read: dict,
     depths_keeps = {}
     for dat, tsv_meta_pds in datasets_read.items():
         depths_keeps[dat] = {}
-        for (tsv_pd, meta_pd) in tsv_meta_pds:
+        for tsv_meta_pd in tsv_meta_pds:
+            tsv_pd, meta_pd = get_read_pds(tsv_meta_pd)
             tsv_sam_sum = tsv_pd.sum()
             datasets_raref_evals[dat] = set([int(x) for x in tsv_sam_sum.describe(
                 percentiles=[x / 100 for x in range(10, 101, 10)])[4:-1]])
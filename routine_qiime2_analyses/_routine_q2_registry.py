@@ -0,0 +1,81 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+
+from routine_qiime2_analyses._routine_q2_dag import DAG, dag_planning, get_dag_ancestors
+from routine_qiime2_analyses._routine_q2_runs import get_open_quote
+
+# options of the commands that write artifacts (qiime2 outputs, imports/exports)
+OUTPUT_RE = re.compile(r'--o-[\w-]+|--output-path')
+
+# artifact-producing commands written during this run:
+# normalized command -> (job script, pipeline stage of the job).
+REGISTRY = {'commands': {}}
+
+
+def normalize_command(command: str) -> str:
+    """
+    :param command: command text (possibly over several lines).
+    :return: command text with the line continuations and spaces normalized.
+    """
+    return ' '.join(command.replace('\\\n', ' ').split())
+
+
+def get_script_commands(lines: list) -> list:
+    """
+    :param lines: lines of a bash script.
+    :return: blocks of lines, each with its following empty lines
+        (the commands are separated by empty lines, which do not count
+        when within quotes, e.g. in the echo of a command).
+    """
+    blocks = [[]]
+    quote = ''
+    for line in lines:
+        blocks[-1].append(line)
+        if not quote and not line.strip():
+            blocks.append([])
+        quote = get_open_quote(line, quote)
+    return [x for x in blocks if x]
+
+
+def register_script(out_sh: str) -> None:
+    """
+    Register the artifact-producing commands of a job script, and remove
+    from it those that are already written during this run, either earlier
+    in this script or (in --dag mode only) in the job of an upstream stage
+    that this job waits for: each artifact is made once, by the first job
+    that needs it. The commands written by jobs that this job does not wait
+    for (e.g. the same case subset tables of alpha and beta, or any job
+    when the stages are not chained) are kept.
+
+    :param out_sh: bash script file.
+    """
+    with open(out_sh) as f:
+        blocks = get_script_commands(f.readlines())
+    ancestors = get_dag_ancestors(DAG['stage'])
+    script_commands = set()
+    kept = []
+    for block in blocks:
+        command = normalize_command(''.join(block))
+        if command and OUTPUT_RE.search(command):
+            if command in script_commands:
+                continue
+            script_commands.add(command)
+            if command in REGISTRY['commands']:
+                script, stage = REGISTRY['commands'][command]
+                if script != out_sh and dag_planning() and stage in ancestors:
+                    continue
+            else:
+                REGISTRY['commands'][command] = (out_sh, DAG['stage'])
+        kept.append(block)
+    if len(kept) < len(blocks):
+        with open(out_sh, 'w') as sh:
+            for block in kept:
+                for line in block:
+                    sh.write(line)
@@ -0,0 +1,407 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import glob
+import time
+import atexit
+import hashlib
+import sqlite3
+from os.path import basename, isfile, splitext
+
+from routine_qiime2_analyses._routine_q2_dag import DAG, PATH_RE
+
+RUNS_SCHEMA = '''CREATE TABLE IF NOT EXISTS commands (
+    output TEXT PRIMARY KEY,
+    analysis TEXT,
+    dataset TEXT,
+    rarefaction TEXT,
+    subset TEXT,
+    name TEXT,
+    command_id TEXT,
+    command TEXT,
+    inputs TEXT,
+    params TEXT,
+    fingerprint TEXT,
+    script TEXT,
+    nodes TEXT,
+    procs TEXT,
+    mem TEXT,
+    time TEXT,
+    status TEXT,
+    exit_code INTEGER,
+    planned_at REAL,
+    updated_at REAL
+)'''
+
+# bash function written in the job scripts to record the status of their
+# commands in the status file of the job (merged in the run manifest at the
+# next call: the jobs never write the manifest itself).
+RUNS_STATUS = '''q2_status() {
+    local status=$1
+    shift
+    for command_id in "$@"; do
+        printf '%%s\\t%%s\\t%%s\\n' "$command_id" "$status" "$(date +%%s)" >> %s || true
+    done
+}
+'''
+RUNS_STATUS_END = '# q2_status end\n'
+
+# runs state, only filled once init_runs() is called (--run-manifest).
+RUNS = {'active': False, 'db': '', 'status': '', 'recorded': {},
+        'planned': {}, 'to_write': {}, 'adopted': {}}
+
+RAREF_RE = re.compile(r'^(.*?)(_raref(?:_eval)?\d+)?$')
+
+
+def init_runs(i_datasets_folder: str, prjct_nm: str) -> None:
+    """
+    Open the project's run manifest, update it with the status files of
+    the jobs, and load the fingerprint and status of every command it recorded.
+
+    :param i_datasets_folder: Path to the folder containing the data/metadata subfolders.
+    :param prjct_nm: Nick name for your project.
+    """
+    RUNS['db'] = '%s/runs_%s.sqlite' % (i_datasets_folder, prjct_nm)
+    RUNS['status'] = '%s/runs_%s_status' % (i_datasets_folder, prjct_nm)
+    os.makedirs(RUNS['status'], exist_ok=True)
+    try:
+        with sqlite3.connect(RUNS['db'], timeout=600) as con:
+            con.execute(RUNS_SCHEMA)
+            con.executemany('UPDATE commands SET status=?, exit_code=?, updated_at=? WHERE command_id=?',
+                            read_runs_status())
+            RUNS['recorded'] = dict(
+                (output, (fingerprint, status)) for output, fingerprint, status in
+                con.execute('SELECT output, fingerprint, status FROM commands'))
+    except sqlite3.OperationalError as e:
+        # e.g. no file locking on this (shared) file system
+        print('Run manifest %s not usable (%s)\nExiting...' % (RUNS['db'], e))
+        sys.exit(1)
+    if not RUNS['active']:
+        atexit.register(write_runs)
+    RUNS['active'] = True
+
+
+def get_status_fp(out_sh: str) -> str:
+    """
+    :param out_sh: bash script file.
+    :return: status file of the job running the script.
+    """
+    return '%s/%s.status' % (RUNS['status'], hashlib.md5(out_sh.encode()).hexdigest())
+
+
+def read_runs_status() -> list:
+    """
+    Read the status of the commands written by the jobs in their status
+    files (the lines of each file are in the order of the status changes).
+
+    :return: (status, exit code, time, command id) per status change.
+    """
+    updates = []
+    for status_fp in sorted(glob.glob('%s/*.status' % RUNS['status'])):
+        with open(status_fp) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 3:
+                    # line being written by a running job
+                    continue
+                command_id, status, updated_at = fields
+                code = None
+                try:
+                    if status != 'running':
+                        code = int(status)
+                        status = 'failed' if code else 'succeeded'
+                    updates.append((status, code, float(updated_at), command_id))
+                except ValueError:
+                    continue
+    return updates
+
+
+def is_done(outputs: tuple, fingerprint: str) -> bool:
+    """
+    Check in the run manifest that the commands writing the outputs
+    succeeded with the same fingerprint (the outputs are not looked for
+    on disk: those removed since must be re-planned with --force).
+
+    :param outputs: output files of the command.
+    :param fingerprint: fingerprint of the command.
+    :return: whether all the outputs are done.
+    """
+    if not RUNS['active']:
+        return False
+    for output in outputs:
+        if RUNS['recorded'].get(output) != (fingerprint, 'succeeded'):
+            return False
+    return True
+
+
+def is_planned(output: str) -> bool:
+    """
+    :param output: output file of a command.
+    :return: whether a command writing the output is planned at this call
+        (i.e. the output will exist once the jobs of this call are done).
+    """
+    return output in RUNS['to_write'] or output in RUNS['planned']
+
+
+def get_recorded_fingerprint(output: str) -> str:
+    """
+    :param output: output file of a command.
+    :return: fingerprint of the command writing the output if it is planned
+        at this call or if it succeeded (or nothing), i.e. the fingerprint
+        of its content that is known without reading it.
+    """
+    if not RUNS['active']:
+        return ''
+    for planned in [RUNS['planned'], RUNS['to_write']]:
+        if output in planned:
+            return planned[output]['fingerprint']
+    fingerprint, status = RUNS['recorded'].get(output, ('', ''))
+    if status == 'succeeded':
+        return fingerprint
+    return ''
+
+
+def get_output_context(output: str) -> tuple:
+    """
+    Get the dataset, rarefaction, subset and name of an output from its
+    path (i.e. <folder>/qiime/<analysis>/<dataset><raref>/<subset>/<name>).
+
+    :param output: output file.
+    :return: dataset, rarefaction, subset and name (that encodes the case).
+    """
+    name = splitext(basename(output))[0]
+    if '/qiime/' not in output:
+        return RAREF_RE.match(name.replace('tab_', '', 1)).groups('') + ('', name)
+    folders = output.split('/qiime/')[-1].split('/')[1:-1]
+    if not folders:
+        return '', '', '', name
+    dataset, raref = RAREF_RE.match(folders[0]).groups('')
+    return dataset, raref, '/'.join(folders[1:]), name
+
+
+def plan_command(outputs: tuple, inputs: list, params: tuple, fingerprint: str) -> None:
+    """
+    Record the outputs of a command that is planned at this call
+    (the command text and script are filled when its script is written).
+
+    :param outputs: output files of the command.
+    :param inputs: input files of the command.
+    :param params: parameters of the command.
+    :param fingerprint: fingerprint of the command.
+    """
+    if not RUNS['active'] and not DAG['active']:
+        # the planned outputs are only needed by the run manifest,
+        # and in --dag mode to plan downstream of the outputs to come
+        return
+    if DAG['active']:
+        DAG['planned'].update(outputs)
+    for output in outputs:
+        RUNS['planned'][output] = get_command_row(output, inputs, params, fingerprint, 'planned')
+
+
+def adopt_command(outputs: tuple, inputs: list, params: tuple, fingerprint: str) -> None:
+    """
+    Record the outputs of a command that are up-to-date on disk but not (or
+    not with this fingerprint) in the run manifest, as if the command had
+    succeeded: the next calls do not need to look for them.
+
+    :param outputs: output files of the command.
+    :param inputs: input files of the command.
+    :param params: parameters of the command.
+    :param fingerprint: fingerprint of the command.
+    """
+    if not RUNS['active']:
+        return
+    for output in outputs:
+        if RUNS['recorded'].get(output) != (fingerprint, 'succeeded'):
+            RUNS['adopted'][output] = get_command_row(output, inputs, params, fingerprint, 'succeeded')
+
+
+def get_command_row(output: str, inputs: list, params: tuple,
+                    fingerprint: str, status: str) -> dict:
+    """
+    :param output: output file of the command.
+    :param inputs: input files of the command.
+    :param params: parameters of the command.
+    :param fingerprint: fingerprint of the command.
+    :param status: status of the command.
+    :return: row of the output in the run manifest.
+    """
+    dataset, raref, subset, name = get_output_context(output)
+    return {
+        'output': output, 'analysis': DAG['stage'], 'dataset': dataset,
+        'rarefaction': raref, 'subset': subset, 'name': name,
+        'command_id': None, 'command': None, 'inputs': '\n'.join(inputs),
+        'params': '\n'.join(map(str, params)), 'fingerprint': fingerprint,
+        'script': None, 'nodes': None, 'procs': None, 'mem': None,
+        'time': None, 'status': status, 'exit_code': None,
+        'planned_at': time.time(), 'updated_at': time.time()}
+
+
+def start_runs_journal() -> None:
+    """
+    Start collecting the commands planned by a planning worker (that still
+    sees those planned before it started).
+    """
+    RUNS['journal'] = [dict(RUNS[x]) for x in ['planned', 'to_write', 'adopted']]
+
+
+def stop_runs_journal() -> list:
+    """
+    :return: the commands planned (not attached or attached to a script)
+        and adopted by a planning worker.
+    """
+    journal = []
+    for key, before in zip(['planned', 'to_write', 'adopted'], RUNS.pop('journal')):
+        journal.append(dict((output, row) for output, row in RUNS[key].items()
+                            if before.get(output) is not row))
+    return journal
+
+
+def apply_runs_journal(journal: list) -> None:
+    """
+    Merge the commands planned by a planning worker.
+
+    :param journal: planned, attached and adopted commands per output.
+    """
+    planned, to_write, adopted = journal
+    if DAG['active']:
+        DAG['planned'].update(planned)
+        DAG['planned'].update(to_write)
+    RUNS['planned'].update(planned)
+    for output in to_write:
+        RUNS['planned'].pop(output, None)
+    RUNS['to_write'].update(to_write)
+    RUNS['adopted'].update(adopted)
+
+
+def get_open_quote(line: str, quote: str = '') -> str:
+    """
+    :param line: line of a bash script.
+    :param quote: quote still opened before the line ('' if none).
+    :return: quote still opened at the end of the line ('' if none).
+    """
+    escaped = False
+    previous = ' '
+    for char in line:
+        if escaped:
+            escaped = False
+        elif char == '\\' and quote != "'":
+            escaped = True
+        elif quote:
+            if char == quote:
+                quote = ''
+        elif char in '"\'':
+            quote = char
+        elif char == '#' and previous.isspace():
+            break
+        previous = char
+    return quote
+
+
+def get_script_statements(lines: list) -> list:
+    """
+    :param lines: lines of a bash script.
+    :return: statements, i.e. lines joined until the end of a line that is
+        not continued (trailing backslash) nor within quotes (echo of commands).
+    """
+    statements = [[]]
+    quote = ''
+    for line in lines:
+        statements[-1].append(line)
+        quote = get_open_quote(line, quote)
+        if not quote and not line.rstrip('\n').endswith('\\'):
+            statements.append([])
+    return [x for x in statements if x]
+
+
+def record_script(out_sh: str, n_nodes: str, n_procs: str,
+                  mem_num: str, mem_dim: str, time_: str) -> None:
+    """
+    Attach the commands of a job script to their planned outputs, and add
+    the status updates of these commands (running, then succeeded/failed
+    from the exit code of the command writing each output) to the script.
+    The status file of the job is reset, as the script is (re-)written.
+
+    :param out_sh: bash script file.
+    :param n_nodes: number of nodes to use.
+    :param n_procs: number of processors to use.
+    :param mem_num: memory in number.
+    :param mem_dim: memory dimension to the number.
+    :param time_: walltime in hours.
+    """
+    if not RUNS['active'] or not RUNS['planned']:
+        return
+    with open(out_sh) as f:
+        lines = f.readlines()
+    if RUNS_STATUS_END in lines:
+        lines = lines[lines.index(RUNS_STATUS_END) + 1:]
+        lines = [x for x in lines if not x.startswith('q2_status ')]
+    script_lines = []
+    command_ids = []
+    for sdx, statement in enumerate(get_script_statements(lines)):
+        script_lines.extend(statement)
+        command = ''.join(statement)
+        if command.startswith(('echo ', 'rm ')):
+            continue
+        outputs = [x for x in PATH_RE.findall(command) if x in RUNS['planned']]
+        if outputs:
+            # status of the statement writing the outputs (first one to use them)
+            command_id = hashlib.md5(('%s:%s' % (out_sh, sdx)).encode()).hexdigest()
+            for output in outputs:
+                row = RUNS['planned'].pop(output)
+                row.update({'command_id': command_id, 'command': command.strip(),
+                            'script': out_sh, 'nodes': n_nodes, 'procs': n_procs,
+                            'mem': '%s%s' % (mem_num, mem_dim), 'time': time_})
+                RUNS['to_write'][output] = row
+            command_ids.append(command_id)
+            script_lines.append('q2_status $? %s\n' % command_id)
+    if not command_ids:
+        return
+    status_fp = get_status_fp(out_sh)
+    if isfile(status_fp):
+        os.remove(status_fp)
+    with open(out_sh, 'w') as sh:
+        sh.write(RUNS_STATUS % status_fp)
+        sh.write(RUNS_STATUS_END)
+        sh.write('q2_status running %s\n\n' % ' '.join(command_ids))
+        for line in script_lines:
+            sh.write(line)
+
+
+def write_runs() -> None:
+    """
+    Write the commands planned during this call in the run manifest
+    (outputs that were not attached to a script keep their planned status).
+    """
+    if not RUNS['active']:
+        return
+    rows = list(RUNS['to_write'].values()) + list(RUNS['planned'].values())
+    # the adopted outputs already in the manifest keep their command
+    updates = [row for output, row in RUNS['adopted'].items() if output in RUNS['recorded']]
+    rows.extend([row for output, row in RUNS['adopted'].items() if output not in RUNS['recorded']])
+    if not rows and not updates:
+        return
+    with sqlite3.connect(RUNS['db'], timeout=600) as con:
+        if rows:
+            columns = list(rows[0].keys())
+            con.executemany(
+                'INSERT OR REPLACE INTO commands (%s) VALUES (%s)' % (
+                    ', '.join(columns), ', '.join(['?'] * len(columns))),
+                [[row[x] for x in columns] for row in rows])
+        con.executemany(
+            'UPDATE commands SET fingerprint=?, status=?, updated_at=? WHERE output=?',
+            [(row['fingerprint'], row['status'], row['updated_at'], row['output']) for row in updates])
+    for row in rows + updates:
+        RUNS['recorded'][row['output']] = (row['fingerprint'], row['status'])
+    RUNS['to_write'] = {}
+    RUNS['planned'] = {}
+    RUNS['adopted'] = {}
@@ -0,0 +1,51 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# sequential permutation tests state, only active once a maximum
+# number of permutations is given (--p-max-permutations).
+SEQUENTIAL = {'max': 0, 'alpha': 0.05, 'first': 99}
+
+
+def init_sequential(max_permutations: int = None) -> None:
+    """
+    Activate the sequential permutation tests (PERMANOVA, Mantel and
+    Procrustes): the permutations are run in increasing stages (99, 999,
+    ...) up to the maximum number of permutations, and stop once the
+    p-value is clearly below or above alpha.
+
+    :param max_permutations: maximum number of permutations.
+    """
+    SEQUENTIAL['max'] = max_permutations if max_permutations else 0
+
+
+def sequential_mode() -> bool:
+    """
+    :return: whether the permutation tests are sequential.
+    """
+    return bool(SEQUENTIAL['max'])
+
+
+def get_permutations_stages() -> list:
+    """
+    :return: number of permutations (in total) at each stage.
+    """
+    stages = []
+    permutations = SEQUENTIAL['first']
+    while permutations * 2 < SEQUENTIAL['max']:
+        stages.append(permutations)
+        permutations = permutations * 10 + 9
+    return stages + [SEQUENTIAL['max']]
+
+
+def get_permutations_increments() -> list:
+    """
+    :return: number of permutations added at each stage (to be run by the
+        tests that accumulate the permutations of the previous stages).
+    """
+    stages = get_permutations_stages()
+    return [stage - previous for stage, previous in zip(stages, [0] + stages[:-1])]
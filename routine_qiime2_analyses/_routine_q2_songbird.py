@@ -15,6 +15,7 @@ from sklearn.model_selection import train_test_split
 from os.path import isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_job_folder,
     get_analysis_folder,
@@ -175,7 +176,9 @@ def run_single_songbird(odir: str, odir_base: str, qza: str, new_qza: str,
     tensor = '%s/tensorboard.qzv' % odir_base
     tensor_html = '%s/tensorboard.html' % odir_base
     with open(cur_sh, 'w') as cur_sh_o:
-        if force or not isfile(tensor_html):
+        if is_stale(force, tensor_html, (qza, new_meta),
+                    (formula, epoch, batch, diff_prior, learn, thresh_sample,
+                     thresh_feat, train_column, baseline_formula)):
             write_songbird_cmd(
                 qza, new_qza, new_meta, formula, epoch, batch, diff_prior,
                 learn, thresh_sample, thresh_feat, train_column, metadatas,
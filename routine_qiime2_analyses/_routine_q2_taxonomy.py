@@ -11,15 +11,22 @@ import re
 import pandas as pd
 import numpy as np
 import seaborn as sns
-from os.path import isfile, splitext
+from os.path import basename, dirname, isfile, splitext
 
 from routine_qiime2_analyses._routine_q2_xpbs import run_xpbs, print_message
+from routine_qiime2_analyses._routine_q2_cache import is_stale, get_file_fingerprint, get_features_fingerprint
+from routine_qiime2_analyses._routine_q2_dag import dag_planning
 from routine_qiime2_analyses._routine_q2_io_utils import (
     get_taxonomy_classifier,
     get_job_folder,
     get_analysis_folder,
     parse_g2lineage,
     get_raref_tab_meta_pds,
+    get_read_pds,
+    read_table_pd,
+    get_expected_collapsed_pd,
+    get_table_sums,
+    get_table_prevalences,
     get_collapse_taxo,
     simple_chunks
 )
@@ -62,8 +69,9 @@ def add_alpha_level_label(taxa, padded_new_rows_list, max_new_rows):
 
 def extend_split_taxonomy(split_taxa_pd: pd.DataFrame):
     to_concat = []
+    n_uniques = split_taxa_pd.nunique(dropna=False)
     for col in split_taxa_pd.columns.tolist():
-        if split_taxa_pd[col].unique().size > 50:
+        if n_uniques[col] > 50:
             continue
         split_taxa_dummy = split_taxa_pd[col].str.get_dummies()
         split_taxa_dummy.columns = ['%s__%s' % (x, col) for x in split_taxa_dummy.columns]
@@ -74,28 +82,54 @@ def extend_split_taxonomy(split_taxa_pd: pd.DataFrame):
         return pd.DataFrame()
 
 
+def compact_rows(values: np.ndarray, keep: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Move the kept values of each row in its first columns (the rest is NaN).
+
+    :param values: 2D array of values.
+    :param keep: 2D array of whether each value is kept.
+    :return: compacted values and number of kept values per row.
+    """
+    lens = keep.sum(axis=1)
+    n_cols = int(lens.max()) if lens.size else 0
+    compact = np.full((values.shape[0], n_cols), np.nan, dtype=object)
+    rows = np.nonzero(keep)[0]
+    cols = (np.cumsum(keep, axis=1) - 1)[keep]
+    compact[rows, cols] = values[keep]
+    return compact, lens
+
+
+def join_taxa(split_taxa_pd: pd.DataFrame) -> np.ndarray:
+    """
+    :param split_taxa_pd: split taxonomy.
+    :return: taxonomic levels (not NaN) joined with ';' per feature.
+    """
+    joined = np.full(split_taxa_pd.shape[0], '', dtype=object)
+    started = np.zeros(split_taxa_pd.shape[0], dtype=bool)
+    for col in split_taxa_pd.columns:
+        values = split_taxa_pd[col].astype(str).values.astype(object)
+        present = values != 'nan'
+        joined = np.where(present & started, joined + ';' + values, np.where(present, values, joined))
+        started |= present
+    return joined
+
+
 def get_split_taxonomy(taxa, extended=False, taxo_sep=';'):
 
-    split_lens = set()
-    split_taxa = []
-    for taxon in taxa:
-        if str(taxon) == 'nan':
-            split_lens.add(1)
-            split_taxa.append(pd.Series(['Unassigned']))
-        else:
-            taxon_split = [x.strip() for x in str(taxon).split(taxo_sep)
-                           if len(x.strip()) and not x.startswith('x__')]
-            # set_taxon_split = set(taxon_split)
-            # set_taxon_split_no_rank = set(['__'.join(x.split('__')[1:]) for x in taxon_split])
-            # if set_taxon_split == {'unclassified'} or set_taxon_split == {'unassigned'}:
-            #     split_lens.add(1)
-            #     split_taxa.append(pd.Series(['Unassigned']))
-            # elif set_taxon_split_no_rank == {'unclassified'} or set_taxon_split_no_rank == {'unassigned'}:
-            #     split_lens.add(1)
-            #     split_taxa.append(pd.Series(['Unassigned']))
-            # else:
-            split_lens.add(len(taxon_split))
-            split_taxa.append(pd.Series(taxon_split))
+    taxa_pd = pd.Series(list(taxa), dtype=object).astype(str)
+    unassigned = (taxa_pd == 'nan').values
+    # split all the taxa at once, and only keep the non-empty, non-"x__" levels
+    pieces = taxa_pd.str.split(taxo_sep, expand=True)
+    stripped = pieces.apply(lambda x: x.str.strip())
+    keep = (stripped.fillna('').apply(lambda x: x.str.len()) > 0).values
+    keep &= ~pieces.fillna('').apply(lambda x: x.str.startswith('x__')).values
+    values = stripped.values.astype(object)
+    if values.shape[1]:
+        keep[unassigned] = False
+        values[unassigned, 0] = 'Unassigned'
+        keep[unassigned, 0] = True
+    split_taxa, lens = compact_rows(values, keep)
+    split_lens = set(lens.tolist())
 
     # if the parsed and split taxonomies have
     # very variable number of fields or very long split results
@@ -119,18 +153,55 @@ def get_split_taxonomy(taxa, extended=False, taxo_sep=';'):
 
 
 def get_ranks_from_split_taxonomy(split_taxa_pd, col):
-    rank = [x.split('__')[0] for x in split_taxa_pd[col]
-            if str(x) not in ['nan', 'None', 'Unassigned']]
-    if len(set(rank)) == 1:
-        return rank[0]
-    else:
-        rank = [x.split('_')[0] for x in split_taxa_pd[col]
-                if str(x) not in ['nan', 'None', 'Unassigned']]
-        if len(set(rank)) == 1:
+    values = split_taxa_pd[col].astype(str)
+    values = values[~values.isin(['nan', 'None', 'Unassigned'])]
+    for rank_sep in ['__', '_']:
+        rank = values.str.split(rank_sep, n=1).str[0].unique()
+        if rank.size == 1:
             return rank[0]
     return ''
 
 
+def get_split_taxonomy_fingerprint(tax_fpo: str) -> str:
+    """
+    :param tax_fpo: split taxonomy file.
+    :return: file keeping the fingerprint of the taxonomy it was split from (hidden, alongside it).
+    """
+    return '%s/.%s.fingerprint' % (dirname(tax_fpo), basename(tax_fpo))
+
+
+def read_split_taxonomy(tax_fpo: str, fingerprint: str):
+    """
+    Read the split taxonomy written at a previous run, if it was split
+    from the current version of the taxonomy (same fingerprint).
+
+    :param tax_fpo: split taxonomy file.
+    :param fingerprint: fingerprint of the taxonomy file.
+    :return: split taxonomy, or None if it must be split again.
+    """
+    fingerprint_fp = get_split_taxonomy_fingerprint(tax_fpo)
+    if not isfile(tax_fpo) or not isfile(fingerprint_fp):
+        return None
+    with open(fingerprint_fp) as f:
+        if f.read().strip() != fingerprint:
+            return None
+    return pd.read_csv(tax_fpo, header=0, sep='\t', index_col=0, dtype=str,
+                       keep_default_na=False, na_values=[''])
+
+
+def write_split_taxonomy_fingerprint(tax_fpo: str, fingerprint: str) -> None:
+    """
+    :param tax_fpo: split taxonomy file.
+    :param fingerprint: fingerprint of the taxonomy file it was split from.
+    """
+    try:
+        with open(get_split_taxonomy_fingerprint(tax_fpo), 'w') as o:
+            o.write('%s\n' % fingerprint)
+    except OSError:
+        # the taxonomy folder is not writable: split again next time
+        pass
+
+
 def get_taxo_levels(taxonomies: dict) -> dict:
 
     split_taxa_pds = {}
@@ -141,10 +212,16 @@ def get_taxo_levels(taxonomies: dict) -> dict:
         # skip if the taxonomic file does not exist
         if not isfile(tax_fp[-1]):
             continue
+        # the taxonomy is only split again if it changed since the last split
+        tax_fpo = '%s_splitaxa.tsv' % splitext(tax_fp[-1])[0]
+        fingerprint = get_file_fingerprint(tax_fp[-1])
+        split_taxa_pd = read_split_taxonomy(tax_fpo, fingerprint)
+        if split_taxa_pd is not None:
+            split_taxa_pds[dat] = (split_taxa_pd, tax_fpo)
+            continue
         # read taxonomy with features as index, format and collect features IDs list
         tax_pd = pd.read_csv(tax_fp[-1], header=0, sep='\t', dtype=str)
         tax_pd.rename(columns={tax_pd.columns[0]: 'Feature ID'}, inplace=True)
-        tax_fpo = '%s_splitaxa.tsv' % splitext(tax_fp[-1])[0]
         features = tax_pd['Feature ID'].tolist()
 
         # perform the taxonomic split on the Taxon list and give the Feature as index
@@ -155,6 +232,7 @@ def get_taxo_levels(taxonomies: dict) -> dict:
         if split_taxa_pd.shape[1] == 1:
             split_taxa_pds[dat] = (split_taxa_pd, tax_fpo)
             split_taxa_pd.to_csv(tax_fpo, index=True, sep='\t')
+            write_split_taxonomy_fingerprint(tax_fpo, fingerprint)
             continue
 
         torm = []
@@ -202,24 +280,25 @@ def get_taxo_levels(taxonomies: dict) -> dict:
             rewrite = True
             alpha = 'ABCDEFGHIJKLMNOPQRST'
             cols = [alpha[x] for x in range(split_taxa_pd.shape[1])]
-            split_taxa_pd = pd.DataFrame(
-                [pd.Series([
-                    '%s__%s' % (cols[idx], str(x).replace(' ', '_'))
-                    for idx, x in enumerate(row) if str(x) != 'nan'
-                ]) for row in split_taxa_pd.values]
-            )
-            split_taxa_pd.columns = cols
+            # label the levels with their column letter, as a rank
+            labelled = np.empty(split_taxa_pd.shape, dtype=object)
+            for idx, col in enumerate(split_taxa_pd.columns):
+                labelled[:, idx] = ('%s__' % cols[idx] + split_taxa_pd[col].astype(str).str.replace(
+                    ' ', '_', regex=False)).values
+            labelled, _ = compact_rows(labelled, (split_taxa_pd.astype(str) != 'nan').values)
+            split_taxa_pd = pd.DataFrame(labelled, columns=cols[:labelled.shape[1]])
             split_taxa_pd.index = features
         split_taxa_pd.to_csv(tax_fpo, index=True, sep='\t')
         split_taxa_pds[dat] = (split_taxa_pd, tax_fpo)
         if rewrite:
             split_taxa_pd = pd.DataFrame({
                 'Feature ID': features,
-                'Taxon_edit': [';'.join([x for x in row if str(x) != 'nan']) for row in split_taxa_pd.values]
+                'Taxon_edit': join_taxa(split_taxa_pd)
             })
             split_taxa_fpo = '%s_taxSplit.tsv' % splitext(tax_fp[-1])[0]
             tax_extended_pd = tax_pd.merge(split_taxa_pd, on='Feature ID', how='left')
             tax_extended_pd.to_csv(split_taxa_fpo, index=False, sep='\t')
+        write_split_taxonomy_fingerprint(tax_fpo, fingerprint)
     return split_taxa_pds
 
 
@@ -256,11 +335,12 @@ def make_pies(i_datasets_folder: str, split_taxa_pds: dict,
                 ranks_col.append(ranks[(len([x for idx, x in enumerate(row)
                                              if str(x).lstrip('%s_' % ranks[idx]).strip('_')])-1)])
             split_taxa['rank'] = ranks_col
-            for idx, (tab_, meta) in enumerate(datasets_read[dat]):
+            for idx, tab_meta in enumerate(datasets_read[dat]):
+                tab_, meta = get_read_pds(tab_meta)
                 nsams = tab_.shape[1]
                 cur_raref = datasets_rarefs[dat][idx]
-                tab_sum = tab_.sum(1)
-                tab_bool = tab_.astype(bool).sum(1)
+                tab_sum = get_table_sums(tab_, 1)
+                tab_bool = get_table_prevalences(tab_)
                 tab = pd.concat([
                     tab_sum,
                     tab_sum / tab_sum.sum(),
@@ -396,7 +476,7 @@ def run_collapse(i_datasets_folder: str, datasets: dict, datasets_filt: dict, da
                         collapsed_qza = collapsed_tsv.replace('.tsv', '.qza')
                         collapsed_meta = '%s_tx-%s.tsv' % (splitext(meta_fp)[0], tax)
                         if isfile(collapsed_tsv) and isfile(collapsed_meta):
-                            collapsed_pd = pd.read_csv(collapsed_tsv, index_col=0, header=0, sep='\t')
+                            collapsed_pd = read_table_pd(collapsed_tsv)
                             if collapsed_pd.shape[0] < 5:
                                 collapsed_removed.add((dat, tax))
                                 print('Not using %s collapsed at level %s (< 5 features)' % (dat, tax))
@@ -422,29 +502,30 @@ def run_collapse(i_datasets_folder: str, datasets: dict, datasets_filt: dict, da
                                     collapsed_meta_pd = collapsed_meta_pd.loc[
                                         collapsed_meta_pd.sample_name.isin(collapsed_pd.columns.tolist())]
                                     collapsed_meta_pd.to_csv(collapsed_meta, index=False, sep='\t')
-                            datasets_read_update.setdefault(dat_tax, []).append(
-                                [collapsed_pd, collapsed_meta_pd])
-                            datasets_collapsed.setdefault(dat, []).append(dat_collapsed)
-                            datasets_collapsed_map[dat_collapsed] = dat
-                            datasets_update.setdefault(dat_tax, []).append([collapsed_tsv, collapsed_meta])
-                            datasets_rarefs.setdefault(dat_tax, []).append(datasets_rarefs[dat][idx])
-                            datasets_phylo_update[dat_tax] = ('', 0)
-                            continue
                         else:
                             written += 1
                             main_written += 1
-                            stop_for_collapse = True
                             write_collapse_taxo(tab_qza, tax_qza, collapsed_qza, collapsed_tsv,
                                                 meta_fp, collapsed_meta, level, remove_empty, cur_sh)
-                            # meta_pd = meta_pd.set_index('sample_name')
-                            # collapsed_meta_pd = meta_pd.loc[collapsed_pd.columns.tolist()].copy()
-                            # collapsed_pd.reset_index().to_csv(collapsed_tsv, index=False, sep='\t')
-                            # collapsed_meta_pd.reset_index().to_csv(collapsed_meta, index=False, sep='\t')
-                            #
-                            # datasets_update[dat_collapsed] = [[collapsed_tsv, collapsed_meta]]
-                            #
-                            # # EXPORT AND READ TO ADD HERE:
-                            # datasets_read_update[dat_collapsed] = [[collapsed_pd, collapsed_meta_pd.reset_index()]]
+                            if not dag_planning():
+                                stop_for_collapse = True
+                                continue
+                            # plan the downstream analyses against the table to come
+                            tab_pd, meta_pd = get_read_pds(datasets_read[dat][idx])
+                            collapsed_pd = get_expected_collapsed_pd(tab_pd, tax_fp, level, remove_empty)
+                            if collapsed_pd.shape[0] < 5:
+                                collapsed_removed.add((dat, tax))
+                                print('Not using %s collapsed at level %s (< 5 features)' % (dat, tax))
+                                continue
+                            collapsed_meta_pd = meta_pd.loc[
+                                meta_pd.sample_name.isin(collapsed_pd.columns.tolist())]
+                        datasets_read_update.setdefault(dat_tax, []).append(
+                            [collapsed_pd, collapsed_meta_pd])
+                        datasets_collapsed.setdefault(dat, []).append(dat_collapsed)
+                        datasets_collapsed_map[dat_collapsed] = dat
+                        datasets_update.setdefault(dat_tax, []).append([collapsed_tsv, collapsed_meta])
+                        datasets_rarefs.setdefault(dat_tax, []).append(datasets_rarefs[dat][idx])
+                        datasets_phylo_update[dat_tax] = ('', 0)
             if written:
                 run_xpbs(out_sh, out_pbs, '%s.cllps.%s%s' % (prjct_nm, dat, filt_raref), qiime_env,
                          run_params["time"], run_params["n_nodes"], run_params["n_procs"],
@@ -475,7 +556,7 @@ def run_taxonomy_others(force: bool, tsv_pd: pd.DataFrame,
     :param out_tsv: Taxonomy classification output exported.
     """
     cmd = ''
-    if force or not isfile(out_qza):
+    if is_stale(force, out_qza, (out_tsv,)):
         if not isfile(out_tsv):
             with open(out_tsv, 'w') as o:
                 o.write('Feature ID\tTaxon\n')
@@ -495,7 +576,7 @@ def run_taxonomy_wol(force: bool, tsv_pd: pd.DataFrame, out_qza: str,
     :param cur_datasets_features: gotu -> features name containing gotu
     """
     cmd = ''
-    if force or not isfile(out_qza):
+    if is_stale(force, out_qza, (out_tsv,)):
         g2lineage = parse_g2lineage()
         rev_cur_datasets_features = dict((y, x) for x, y in cur_datasets_features.items())
         if not isfile(out_tsv):
@@ -530,9 +611,9 @@ def run_taxonomy_amplicon(dat: str, i_datasets_folder: str, force: bool, tsv_pd:
         out_fp_seqs_rad = '%s/seq_%s' % (odir_seqs, dat)
         out_fp_seqs_fasta = '%s.fasta' % out_fp_seqs_rad
         out_fp_seqs_qza = '%s.qza' % out_fp_seqs_rad
-        if force or not isfile(out_fp_seqs_qza):
+        if is_stale(force, out_fp_seqs_qza, (), (get_features_fingerprint(tsv_pd.index),)):
             cmd += write_seqs_fasta(out_fp_seqs_fasta, out_fp_seqs_qza, tsv_pd)
-        if force or not isfile(out_qza):
+        if is_stale(force, out_qza, (out_fp_seqs_qza, ref_classifier_qza)):
             cmd += write_taxonomy_sklearn(out_qza, out_fp_seqs_qza, ref_classifier_qza)
             cmd += run_export(out_qza, out_tsv, '')
     return cmd
@@ -583,9 +664,9 @@ def run_taxonomy(method: str, i_datasets_folder: str, datasets: dict, datasets_r
                             print('Must have run rarefaction to use it further...\nExiting')
                             sys.exit(0)
                         tsv_pd, meta_pd = get_raref_tab_meta_pds(meta, tsv)
-                        datasets_read[dat][idx] = [tsv_pd, meta_pd]
+                        datasets_read[dat][idx] = [tsv, meta]
                     else:
-                        tsv_pd, meta_pd = tsv_meta_pds
+                        tsv_pd, meta_pd = get_read_pds(tsv_meta_pds)
 
                     odir = get_analysis_folder(i_datasets_folder, 'taxonomy/%s' % dat)
                     out_rad = '%s/tax_%s' % (odir, dat)
@@ -685,7 +766,7 @@ def run_barplot(i_datasets_folder: str, datasets: dict, taxonomies: dict,
                     qza = '%s.qza' % splitext(tsv)[0]
                     odir = get_analysis_folder(i_datasets_folder, 'barplot/%s' % dat)
                     out_qzv = '%s/bar_%s_%s.qzv' % (odir, dat, method)
-                    if force or not isfile(out_qzv):
+                    if is_stale(force, out_qzv, (qza, meta, tax_qza)):
                         write_barplots(out_qzv, qza, meta, tax_qza, cur_sh)
                         written += 1
             to_chunk.append(out_sh)
@@ -0,0 +1,54 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import pkg_resources
+from os.path import splitext
+
+# in-process worker state, only active when the --q2-worker mode is used.
+WORKER = {'active': False}
+
+
+def init_worker() -> None:
+    """
+    Activate the running of the commands of each job in a single
+    python interpreter (instead of one qiime2 command line call each).
+    """
+    WORKER['active'] = True
+
+
+def worker_mode() -> bool:
+    """
+    :return: whether the jobs run their commands in a single interpreter.
+    """
+    return WORKER['active']
+
+
+def write_worker_script(out_sh: str) -> None:
+    """
+    Move the commands of a job script to a bash script of commands (that
+    can still be run as is) and replace them by the call of the worker,
+    that runs the qiime2 commands in-process and the others with bash.
+
+    :param out_sh: bash script file.
+    """
+    RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+    q2_worker_fp = '%s/q2_worker.py' % RESOURCES
+    commands_sh = '%s_commands.sh' % splitext(out_sh)[0]
+    with open(out_sh) as f:
+        lines = f.readlines()
+    cwd = os.getcwd()
+    with open(commands_sh, 'w') as o:
+        for line in lines:
+            if cwd.startswith('/panfs'):
+                line = line.replace(cwd, '')
+            o.write(line)
+    if cwd.startswith('/panfs'):
+        commands_sh = commands_sh.replace(cwd, '')
+    with open(out_sh, 'w') as sh:
+        sh.write('python %s %s\n' % (q2_worker_fp, commands_sh))
@@ -7,10 +7,57 @@
 # ----------------------------------------------------------------------------
 
 import os
+import sys
 import subprocess
 from os.path import isfile
 from typing import TextIO
 
+from routine_qiime2_analyses._routine_q2_dag import add_dag_job
+from routine_qiime2_analyses._routine_q2_local import write_local_header
+from routine_qiime2_analyses._routine_q2_runs import record_script
+from routine_qiime2_analyses._routine_q2_registry import register_script
+from routine_qiime2_analyses._routine_q2_worker import worker_mode, write_worker_script
+
+# torque scripts writer state: written by Xpbs (default), or rendered
+# in-process (--no-xpbs) in one batch at the end of the planning:
+# torque script -> (header parameters, lines of the bash script).
+XPBS = {'active': False, 'batch': {}}
+
+
+def init_xpbs(xpbs: bool = True, chmod: str = '664', noloc: bool = False) -> None:
+    """
+    Write the torque scripts with Xpbs (one subprocess per script), after
+    checking that Xpbs is configured, or render them in-process otherwise
+    (all the scripts written at once when planning is over). The scripts
+    rendered in-process run in the working directory and do not change
+    the permissions of the outputs: computing on scratch (--loc) and a
+    non-default permission (-chmod) need Xpbs.
+
+    :param xpbs: Whether to write the Torque scripts with Xpbs.
+    :param chmod: whether to change permission of output files (defalt: 664).
+    :param noloc: whether to do compute on scratch.
+    """
+    if not xpbs:
+        if noloc or str(chmod) != '664':
+            print('Computing on scratch (--loc) or changing the output files permission '
+                  '(-chmod %s) needs Xpbs\n(use --no-loc and the default -chmod with '
+                  '--no-xpbs)\nExiting...' % chmod)
+            sys.exit(1)
+        XPBS['active'] = False
+        return
+    ret_code, ret_path = subprocess.getstatusoutput('which Xpbs')
+    if ret_code:
+        print('Xpbs is not installed (and make sure to edit its config.txt)\nExiting...')
+        sys.exit(1)
+    else:
+        with open(ret_path) as f:
+            for line in f:
+                break
+        if line.startswith('$HOME'):
+            print('Xpbs is installed but its config.txt need editing!\nExiting...')
+            sys.exit(1)
+    XPBS['active'] = True
+
 
 def run_xpbs(out_sh: str, out_pbs: str, job_name: str,
              qiime_env: str, time: str, n_nodes: str,
@@ -18,7 +65,7 @@ def run_xpbs(out_sh: str, out_pbs: str, job_name: str,
              written: int, single: str, o: TextIO = None,
              noloc: bool = True, jobs: bool = True, tmp: str = None) -> None:
     """
-    Run the Xpbs script assorted with print or writing in higher-level command.
+    Write the torque script assorted with print or writing in higher-level command.
 
     :param out_sh: input bash script file.
     :param out_pbs: output torque script file.
@@ -36,17 +83,27 @@ def run_xpbs(out_sh: str, out_pbs: str, job_name: str,
     :return:
     """
     if written:
-        if os.getcwd().startswith('/panfs'):
-            out_sh_lines = open(out_sh).readlines()
-            with open(out_sh, 'w') as sh:
-                if not jobs:
-                    sh.write('conda activate %s\n' % qiime_env)
-                for out_sh_line in out_sh_lines:
-                    sh.write(out_sh_line.replace(os.getcwd(), ''))
+        register_script(out_sh)
+        record_script(out_sh, n_nodes, n_procs, mem_num, mem_dim, time)
+        if worker_mode():
+            write_worker_script(out_sh)
         if jobs:
             xpbs_call(out_sh, out_pbs, job_name, qiime_env,
                       time, n_nodes, n_procs, mem_num,
                       mem_dim, chmod, noloc, tmp)
+            if os.getcwd().startswith('/panfs'):
+                add_dag_job(out_pbs.replace(os.getcwd(), ''), False, [out_sh])
+            else:
+                add_dag_job(out_pbs, False, [out_sh])
+        else:
+            if os.getcwd().startswith('/panfs'):
+                out_sh_lines = open(out_sh).readlines()
+                with open(out_sh, 'w') as sh:
+                    sh.write('conda activate %s\n' % qiime_env)
+                    for out_sh_line in out_sh_lines:
+                        sh.write(out_sh_line.replace(os.getcwd(), ''))
+            write_local_header(out_sh, qiime_env, n_nodes, n_procs, mem_num, mem_dim, time)
+            add_dag_job(out_sh)
         if single:
             if os.getcwd().startswith('/panfs'):
                 out_pbs = out_pbs.replace(os.getcwd(), '')
@@ -67,11 +124,108 @@ def run_xpbs(out_sh: str, out_pbs: str, job_name: str,
             os.remove(out_pbs)
 
 
+def get_pbs_header(job_name: str, qiime_env: str, time: str, n_nodes: str,
+                   n_procs: str, mem_num: str, mem_dim: str, chmod: str,
+                   noloc: bool, tmp: str = None) -> str:
+    """
+    Render the torque directives and the environment setup of a job
+    (the directives given to Xpbs, without spawning it). The jobs run in
+    the working directory, without changing the permissions of the outputs:
+    the planning stops if computing on scratch (--loc) or a non-default
+    permission (-chmod) is asked without Xpbs (see init_xpbs()).
+
+    :param job_name: job name.
+    :param qiime_env: conda environment.
+    :param time: walltime in hours.
+    :param n_nodes: number of nodes to use.
+    :param n_procs: number of processors to use.
+    :param mem_num: memory in number.
+    :param mem_dim: memory dimension to the number.
+    :param chmod: whether to change permission of output files (defalt: 775).
+    :param noloc: whether to do compute on scratch.
+    :param tmp: folder in which to create the scratch folder.
+    :return: the header of the torque script.
+    """
+    header = [
+        '#!/bin/bash',
+        '#PBS -N %s' % job_name,
+        '#PBS -V',
+        '#PBS -l walltime=%s:00:00' % time,
+        '#PBS -l nodes=%s:ppn=%s' % (n_nodes, n_procs),
+        '#PBS -l mem=%s%s' % (mem_num, mem_dim.lower()),
+        '#PBS -j oe',
+        '#PBS -m a',
+        '',
+        'source $HOME/.bashrc',
+        'conda activate %s' % qiime_env,
+        'cd $PBS_O_WORKDIR'
+    ]
+    if tmp:
+        header.append('export TMPDIR=%s' % tmp)
+    header.extend(['', 'echo "Start: $(date)"', ''])
+    return '\n'.join(header) + '\n'
+
+
 def xpbs_call(out_sh: str, out_pbs: str, prjct_nm: str,
               qiime_env: str, time: str, n_nodes: str,
               n_procs: str, mem_num: str, mem_dim: str,
               chmod: str, noloc: bool, tmp: str = None) -> None:
     """
+    Write the torque script for the current bash script with Xpbs, or add
+    it to the batch of torque scripts rendered in-process: the bash script
+    is read now (with its paths rewritten when working on /panfs), and the
+    torque script is written with the batch (see write_pbs_batch()).
+
+    :param out_sh: input current bash script.
+    :param out_pbs: output script with directives.
+    :param prjct_nm: project/job name.
+    :param qiime_env: conda environment.
+    :param time: walltime in hours.
+    :param n_nodes: number of nodes to use.
+    :param n_procs: number of processors to use.
+    :param mem_num: memory in number.
+    :param mem_dim: memory dimension to the number.
+    :param chmod: whether to change permission of output files (defalt: 775).
+    :return:
+    """
+    if XPBS['active']:
+        call_xpbs(out_sh, out_pbs, prjct_nm, qiime_env, time, n_nodes,
+                  n_procs, mem_num, mem_dim, chmod, noloc, tmp)
+        return
+    cwd = os.getcwd()
+    with open(out_sh) as f:
+        if cwd.startswith('/panfs'):
+            lines = [x.replace(cwd, '') for x in f]
+        else:
+            lines = f.readlines()
+    header = (prjct_nm, qiime_env, str(time), str(n_nodes), str(n_procs),
+              str(mem_num), str(mem_dim), str(chmod), noloc, tmp)
+    # a re-written script is moved at the end of the batch
+    XPBS['batch'].pop(out_pbs, None)
+    XPBS['batch'][out_pbs] = (header, lines)
+
+
+def write_pbs_batch() -> None:
+    """
+    Write the batch of torque scripts rendered in-process, with the header
+    rendered once for all the scripts that share it.
+    """
+    pbs_headers = {}
+    for out_pbs, (header, lines) in XPBS['batch'].items():
+        if header not in pbs_headers:
+            pbs_headers[header] = get_pbs_header(*header)
+        with open(out_pbs, 'w') as pbs:
+            pbs.write(pbs_headers[header])
+            pbs.writelines(lines)
+            pbs.write('\necho "End: $(date)"\n')
+    XPBS['batch'] = {}
+
+
+def call_xpbs(out_sh: str, out_pbs: str, prjct_nm: str,
+              qiime_env: str, time: str, n_nodes: str,
+              n_procs: str, mem_num: str, mem_dim: str,
+              chmod: str, noloc: bool, tmp: str = None) -> None:
+    """
     Call the subprocess to run Xpbs on the current bash script.
 
     :param out_sh: input current bash script.
@@ -92,11 +246,11 @@ def xpbs_call(out_sh: str, out_pbs: str, prjct_nm: str,
         '-j', prjct_nm,
         '-o', out_pbs,
         '-e', qiime_env,
-        '-t', time,
-        '-n', n_nodes,
-        '-p', n_procs,
-        '-M', mem_num, mem_dim,
-        '-c', chmod,
+        '-t', str(time),
+        '-n', str(n_nodes),
+        '-p', str(n_procs),
+        '-M', str(mem_num), str(mem_dim),
+        '-c', str(chmod),
         '--noq'
     ]
     if tmp:
@@ -7,9 +7,9 @@
 # ----------------------------------------------------------------------------
 
 import sys
-import subprocess
 from os.path import abspath, exists, isdir, isfile
 
+from routine_qiime2_analyses._routine_q2_xpbs import init_xpbs, print_message, write_pbs_batch
 from routine_qiime2_analyses._routine_q2_io_utils import (get_prjct_nm, get_datasets,
                                                           get_run_params, summarize_songbirds,
                                                           get_analysis_folder)
@@ -42,6 +42,15 @@ from routine_qiime2_analyses._routine_q2_phate import run_phate
 from routine_qiime2_analyses._routine_q2_songbird import run_songbird
 from routine_qiime2_analyses._routine_q2_mmvec import run_mmvec
 from routine_qiime2_analyses._routine_q2_mmbird import run_mmbird
+from routine_qiime2_analyses._routine_q2_dag import init_dag, set_dag_stage, write_dag_launcher
+from routine_qiime2_analyses._routine_q2_arrays import init_arrays
+from routine_qiime2_analyses._routine_q2_worker import init_worker
+from routine_qiime2_analyses._routine_q2_engines import init_engines
+from routine_qiime2_analyses._routine_q2_sequential import init_sequential
+from routine_qiime2_analyses._routine_q2_pool import init_pool
+from routine_qiime2_analyses._routine_q2_cache import init_fingerprints
+from routine_qiime2_analyses._routine_q2_runs import init_runs
+from routine_qiime2_analyses._routine_q2_metadata import init_cases
 
 
 def routine_qiime2_analyses(
@@ -92,7 +101,17 @@ def routine_qiime2_analyses(
         p_filt3d_config: str,
         filt_only: bool,
         jobs: bool,
-        chunkit: int) -> None:
+        chunkit: int,
+        dag: bool,
+        arrays: bool,
+        arrays_cap: int,
+        plan_workers: int,
+        q2_worker: bool,
+        beta_engine: bool,
+        permanova_engine: bool,
+        max_permutations: int,
+        xpbs: bool,
+        run_manifest: bool) -> None:
     """
     Main qiime2 functions writer.
 
@@ -118,6 +137,16 @@ def routine_qiime2_analyses(
     :param gpu: Use GPUs instead of CPUs for MMVEC.
     :param standalone:
     :param raref: Whether to only perform the routine analyses on the rarefied datasets.
+    :param dag: Whether to chain all the jobs in one launcher using Torque dependencies.
+    :param arrays: Whether to write one Torque array job per analysis.
+    :param arrays_cap: Maximum number of array tasks running at the same time.
+    :param plan_workers: Number of processes writing the scripts of each analysis.
+    :param q2_worker: Whether to run the qiime2 commands of each job in a single interpreter.
+    :param beta_engine: Whether to compute the non-phylogenetic beta diversity metrics with the beta engine.
+    :param permanova_engine: Whether to run the beta group significance tests with the PERMANOVA engine.
+    :param max_permutations: Maximum number of permutations of the sequential permutation tests.
+    :param xpbs: Whether to write the Torque scripts with Xpbs.
+    :param run_manifest: Whether to record the planned commands and their status in the run manifest.
     """
 
     # INITIALIZATION ------------------------------------------------------------
@@ -131,21 +160,23 @@ def routine_qiime2_analyses(
         print('%s is a file. Needs a folder as input\nExiting...' % i_datasets_folder)
         sys.exit(1)
 
-    # check Xpbs
-    ret_code, ret_path = subprocess.getstatusoutput('which Xpbs')
-    if ret_code:
-        print('Xpbs is not installed (and make sure to edit its config.txt)\nExiting...')
-        sys.exit(1)
-    else:
-        with open(ret_path) as f:
-            for line in f:
-                break
-        if line.startswith('$HOME'):
-            print('Xpbs is installed but its config.txt need editing!\nExiting...')
-            sys.exit(1)
-
     prjct_nm = get_prjct_nm(project_name)
     run_params = get_run_params(p_run_params)
+    init_fingerprints(qiime_env)
+    init_cases(i_datasets_folder)
+    if run_manifest:
+        init_runs(i_datasets_folder, prjct_nm)
+    if dag:
+        init_dag()
+    if arrays:
+        init_arrays(arrays_cap)
+    init_pool(plan_workers)
+    if q2_worker:
+        init_worker()
+    init_engines(beta_engine, permanova_engine)
+    init_sequential(max_permutations)
+    if jobs:
+        init_xpbs(xpbs, chmod, noloc)
 
     # READ ------------------------------------------------------------
     print('(get_datasets)')
@@ -162,6 +193,7 @@ def routine_qiime2_analyses(
         p_procrustes = 1
 
     # PREPROCESSING ------------------------------------------------------------
+    set_dag_stage('import')
     print('(import_datasets)')
     import_datasets(i_datasets_folder, datasets, datasets_phylo,
                     force, prjct_nm, qiime_env, chmod, noloc,
@@ -170,6 +202,7 @@ def routine_qiime2_analyses(
     datasets_filt = {}
     datasets_filt_map = {}
     if p_filt_threshs:
+        set_dag_stage('filter')
         print('(filter_rare_samples)')
         filter_rare_samples(i_datasets_folder, datasets, datasets_read, datasets_features,
                             datasets_rarefs, datasets_filt, datasets_filt_map, datasets_phylo,
@@ -178,6 +211,7 @@ def routine_qiime2_analyses(
 
     eval_depths = {}
     if raref:
+        set_dag_stage('rarefy')
         print('(run_rarefy)')
         eval_depths = run_rarefy(
             i_datasets_folder, datasets, datasets_read, datasets_phylo,
@@ -197,6 +231,7 @@ def routine_qiime2_analyses(
                                method)
     if i_qemistree and 'qemistree' not in p_skip:
         if isdir(i_qemistree):
+            set_dag_stage('qemistree')
             print('(run_qemistree)')
             run_qemistree(i_datasets_folder, datasets, prjct_nm,
                           i_qemistree, taxonomies, force, qiime_env,
@@ -206,17 +241,20 @@ def routine_qiime2_analyses(
             print('[Warning] The Qemistree path %s is not a folder.')
 
     if 'taxonomy' not in p_skip:
+        set_dag_stage('taxonomy')
         print('(run_taxonomy)')
         run_taxonomy(method, i_datasets_folder, datasets, datasets_read,
                      datasets_phylo, datasets_features, datasets_filt_map, i_classifier,
                      taxonomies, force, prjct_nm, qiime_env, chmod, noloc,
                      run_params['taxonomy'], filt_raref, jobs, chunkit)
         if 'barplot' not in p_skip:
+            set_dag_stage('barplot')
             print('(run_barplot)')
             run_barplot(i_datasets_folder, datasets, taxonomies,
                         force, prjct_nm, qiime_env, chmod, noloc,
                         run_params['barplot'], filt_raref, jobs, chunkit)
 
+        set_dag_stage('edit_taxonomy')
         print('(run_edit_taxonomies)')
         edit_taxonomies(i_datasets_folder, taxonomies, force,
                         prjct_nm, qiime_env, chmod, noloc,
@@ -229,11 +267,13 @@ def routine_qiime2_analyses(
                           datasets_filt_map, datasets_phylo,
                           trees)
     if 'wol' not in p_skip:
+        set_dag_stage('wol')
         print('(shear_tree)')
         shear_tree(i_datasets_folder, datasets, datasets_read, datasets_phylo,
                    datasets_features, prjct_nm, i_wol_tree, trees, datasets_rarefs,
                    force, qiime_env, chmod, noloc, run_params['wol'], filt_raref, jobs)
     if i_sepp_tree and 'sepp' not in p_skip:
+        set_dag_stage('sepp')
         print('(run_sepp)')
         run_sepp(i_datasets_folder, datasets, datasets_read, datasets_phylo,
                  datasets_rarefs, prjct_nm, i_sepp_tree, trees, force,
@@ -253,6 +293,7 @@ def routine_qiime2_analyses(
     datasets_collapsed = {}
     datasets_collapsed_map = {}
     if p_collapse_taxo and 'collapse' not in p_skip:
+        set_dag_stage('collapse')
         print('(run_collapse)')
         collapsed = run_collapse(i_datasets_folder, datasets, datasets_filt, datasets_read,
                                  datasets_features, datasets_phylo, split_taxa_pds,
@@ -270,6 +311,7 @@ def routine_qiime2_analyses(
 
     # ALPHA ------------------------------------------------------------
     if 'alpha' not in p_skip:
+        set_dag_stage('alpha')
         print('(alpha)')
         diversities = run_alpha(i_datasets_folder, datasets, datasets_read,
                                 datasets_phylo, datasets_rarefs, p_alpha_subsets,
@@ -277,6 +319,7 @@ def routine_qiime2_analyses(
                                 As, dropout, run_params['alpha'], filt_raref,
                                 eval_depths, jobs, chunkit)
         if 'merge_alpha' not in p_skip:
+            set_dag_stage('merge_alpha')
             print('(to_export)')
             to_export = merge_meta_alpha(i_datasets_folder, datasets, datasets_rarefs,
                                          diversities, force, prjct_nm, qiime_env, chmod,
@@ -286,6 +329,7 @@ def routine_qiime2_analyses(
                 print('(export_meta_alpha)')
                 export_meta_alpha(datasets, filt_raref, datasets_rarefs, to_export, dropout)
         if 'alpha_correlations' not in p_skip:
+            set_dag_stage('alpha_correlations')
             print('(run_correlations)')
             run_correlations(i_datasets_folder, datasets, diversities,
                              datasets_rarefs, force, prjct_nm, qiime_env,
@@ -293,6 +337,7 @@ def routine_qiime2_analyses(
                              filt_raref, jobs, chunkit)
         if p_longi_column:
             if 'volatility' not in p_skip:
+                set_dag_stage('volatility')
                 print('(run_volatility)')
                 run_volatility(i_datasets_folder, datasets, p_longi_column,
                                datasets_rarefs, force, prjct_nm, qiime_env, chmod,
@@ -300,44 +345,55 @@ def routine_qiime2_analyses(
 
     # BETA ----------------------------------------------------------------------
     if 'beta' not in p_skip:
+        # only mmvec, songbird and the filtering exploration read the tables after beta
+        read_later = bool(filt3d or (p_mmvec_pairs and 'mmvec' not in p_skip) or (
+                p_diff_models and 'songbird' not in p_skip))
+        set_dag_stage('beta')
         print('(betas)')
         betas = run_beta(i_datasets_folder, datasets, datasets_phylo,
                          datasets_read, datasets_rarefs, p_beta_subsets,
                          p_beta_groups, trees, force, prjct_nm, qiime_env,
                          chmod, noloc, Bs, dropout, run_params['beta'],
-                         filt_raref, eval_depths, jobs, chunkit)
+                         filt_raref, eval_depths, jobs, chunkit, read_later)
         if 'export_beta' not in p_skip:
+            set_dag_stage('export_beta')
             print('(export_beta)')
             export_beta(i_datasets_folder, betas, datasets_rarefs,
                         force, prjct_nm, qiime_env, chmod, noloc,
                         run_params['export_beta'], filt_raref, jobs, chunkit)
         if 'pcoa' not in p_skip:
+            set_dag_stage('pcoa')
             print('(run_pcoas)')
             pcoas = run_pcoas(i_datasets_folder, betas, datasets_rarefs,
                               force, prjct_nm, qiime_env, chmod, noloc,
                               run_params['pcoa'], filt_raref, jobs, chunkit)
             if 'emperor' not in p_skip:
+                set_dag_stage('emperor')
                 print('(run_emperor)')
                 run_emperor(i_datasets_folder, pcoas, datasets_rarefs,
                             prjct_nm, qiime_env, chmod, noloc,
                             run_params['emperor'], filt_raref, jobs, chunkit)
             if 'empress' not in p_skip:
+                set_dag_stage('empress')
                 print('(run_empress)')
                 run_empress(i_datasets_folder, pcoas, trees, datasets_phylo,
                             datasets_rarefs, taxonomies, prjct_nm, qiime_env, chmod,
                             noloc, run_params['empress'], filt_raref, jobs, chunkit)
         if 'biplot' not in p_skip:
+            set_dag_stage('biplot')
             print('(run_biplots)')
             biplots, biplots_raw = run_biplots(i_datasets_folder, betas,
                                                datasets_rarefs,  taxonomies,
                                                force, prjct_nm, qiime_env, chmod, noloc,
                                                run_params['biplot'], filt_raref, jobs, chunkit)
             if 'emperor_biplot' not in p_skip:
+                set_dag_stage('emperor_biplot')
                 print('(run_emperor_biplot)')
                 run_emperor_biplot(i_datasets_folder, biplots, biplots_raw, taxonomies,
                                    split_taxa_pds, datasets_rarefs, prjct_nm, qiime_env, chmod,
                                    noloc, run_params['emperor_biplot'], filt_raref, jobs, chunkit)
             if 'empress_biplot' not in p_skip:
+                set_dag_stage('empress_biplot')
                 print('(run_empress_biplot)')
                 run_empress_biplot(i_datasets_folder, biplots, biplots_raw, trees, datasets_phylo,
                                    taxonomies, datasets_rarefs, prjct_nm, qiime_env, chmod,
@@ -345,6 +401,7 @@ def routine_qiime2_analyses(
 
     # STATS ------------------------------------------------------------------
     if 'alpha' not in p_skip and 'alpha_group_significance' not in p_skip and 'alpha_kw' not in p_skip:
+        set_dag_stage('alpha_kw')
         print('(run_alpha_group_significance)')
         run_alpha_group_significance(i_datasets_folder, datasets, diversities,
                                      datasets_rarefs, p_beta_groups, force,
@@ -352,30 +409,35 @@ def routine_qiime2_analyses(
                                      run_params['alpha_kw'], filt_raref, jobs, chunkit)
 
     if 'beta' not in p_skip and 'deicode' not in p_skip:
+        set_dag_stage('deicode')
         print('(run_deicode)')
         run_deicode(i_datasets_folder, datasets, datasets_rarefs,
                     p_beta_groups, force, prjct_nm, qiime_env, chmod,
                     noloc, run_params['deicode'], filt_raref, jobs, chunkit)
 
     if 'beta' not in p_skip and p_perm_tests and 'permanova' not in p_skip:
+        set_dag_stage('permanova')
         print('(run_permanova)')
         permanovas = run_permanova(i_datasets_folder, betas, p_perm_tests,
                                    p_beta_type, datasets_rarefs, p_beta_groups,
                                    force, prjct_nm, qiime_env, chmod, noloc, split,
                                    run_params['permanova'], filt_raref, jobs, chunkit)
 
+        set_dag_stage('permanova_summarize')
         summarize_permanova(i_datasets_folder, permanovas,
                             prjct_nm, qiime_env, chmod, noloc, split,
                             run_params['permanova'], filt_raref,
                             jobs, chunkit)
 
     if 'beta' not in p_skip and p_formulas and 'adonis' not in p_skip:
+        set_dag_stage('adonis')
         print('(run_adonis)')
         run_adonis(p_formulas, i_datasets_folder, betas, datasets_rarefs,
                    p_beta_groups, force, prjct_nm, qiime_env, chmod,
                    noloc, split, run_params['adonis'], filt_raref, jobs, chunkit)
 
     if 'beta' not in p_skip and p_procrustes and 'procrustes' not in p_skip:
+        set_dag_stage('procrustes')
         print('(run_procrustes)')
         run_procrustes(i_datasets_folder, datasets_filt, p_procrustes, betas,
                        force, prjct_nm, qiime_env, chmod, noloc, split,
@@ -383,12 +445,14 @@ def routine_qiime2_analyses(
                        filt_only, eval_depths, jobs, chunkit)
 
     if 'beta' not in p_skip and p_mantel and 'mantel' not in p_skip:
+        set_dag_stage('mantel')
         print('(run_mantel)')
         run_mantel(i_datasets_folder, datasets_filt, p_mantel, betas,
                    force,  prjct_nm, qiime_env, chmod, noloc, split,
                    run_params['mantel'], filt_raref,  filt_only, eval_depths, jobs, chunkit)
 
     if 'beta' not in p_skip and p_nestedness_groups and 'nestedness' not in p_skip:
+        set_dag_stage('nestedness')
         print('(run_nestedness)')
         nestedness_res, colors, nodfs_fps = run_nestedness(
             i_datasets_folder, betas, datasets_collapsed_map, p_nestedness_groups,
@@ -396,6 +460,7 @@ def routine_qiime2_analyses(
             run_params['nestedness'], filt_raref, jobs, chunkit)
 
         if nestedness_res:
+            set_dag_stage('nestedness_figures')
             print('(making_nestedness_figures (graphs))')
             nestedness_graphs(i_datasets_folder, nestedness_res, datasets,
                                           split_taxa_pds, datasets_rarefs, colors,
@@ -403,6 +468,7 @@ def routine_qiime2_analyses(
                                           prjct_nm, qiime_env, chmod, noloc, split,
                                           run_params['nestedness'], jobs, chunkit)
         if nodfs_fps:
+            set_dag_stage('nestedness_figures')
             print('(making_nestedness_figures (nodfs))')
             nestedness_nodfs(i_datasets_folder, nodfs_fps, collapsed,
                              filt_raref, prjct_nm, qiime_env, chmod,
@@ -410,6 +476,7 @@ def routine_qiime2_analyses(
                              jobs, chunkit)
 
     if 'beta' not in p_skip and p_distance_decay and 'decay' not in p_skip:
+        set_dag_stage('decay')
         print('(run_distance_decay)')
         distance_decay_res = run_distance_decay(i_datasets_folder, betas, p_distance_decay,
                                                 datasets_rarefs, force, prjct_nm, qiime_env,
@@ -422,6 +489,7 @@ def routine_qiime2_analyses(
 
     # PHATE ---------------------------------------------------------------------
     if p_phate_config and 'phate' not in p_skip:
+            set_dag_stage('phate')
             print('(run_phate)')
             phates = run_phate(
                 p_phate_config, i_datasets_folder, datasets, datasets_rarefs,
@@ -432,6 +500,7 @@ def routine_qiime2_analyses(
 
     # DISSIMILARITY OVERLAP --------------------------------------------
     if 'doc' not in p_skip and p_doc_config:
+        set_dag_stage('doc')
         print('(run_doc)')
         run_doc(i_datasets_folder, datasets, p_doc_config,
                 datasets_rarefs, force, prjct_nm, qiime_env, chmod, noloc,
@@ -439,6 +508,7 @@ def routine_qiime2_analyses(
 
     # SOURCETRACKING --------------------------------------------
     if p_sourcetracking_config and 'sourcetracking' not in p_skip:
+        set_dag_stage('sourcetracking')
         print('(run_sourcetracking)')
         run_sourcetracking(i_datasets_folder, datasets, p_sourcetracking_config,
                            datasets_rarefs, force, prjct_nm, qiime_env, chmod,
@@ -453,6 +523,7 @@ def routine_qiime2_analyses(
         if filt3d:
             filts.update(get_filt3d_params(p_mmvec_pairs, 'mmvec'))
         elif 'mmvec' not in p_skip:
+            set_dag_stage('mmvec')
             print('(run_mmvec)')
             mmvec_outputs = run_mmvec(p_mmvec_pairs, i_datasets_folder, datasets,
                                       datasets_filt, datasets_read, force, gpu,
@@ -465,6 +536,7 @@ def routine_qiime2_analyses(
         if filt3d:
             filts.update(get_filt3d_params(p_diff_models, 'songbird'))
         elif 'songbird' not in p_skip:
+            set_dag_stage('songbird')
             print('(run_songbird)')
             songbird_outputs = run_songbird(p_diff_models, i_datasets_folder,
                                             datasets, datasets_read, datasets_filt,
@@ -484,9 +556,17 @@ def routine_qiime2_analyses(
                           datasets_filt, datasets_filt_map,
                           filts, p_filt3d_config)
     elif p_mmvec_pairs and 'mmbird' not in p_skip:
+        set_dag_stage('mmbird')
         print('(run_mmbird)')
         run_mmbird(
             i_datasets_folder, songbird_outputs, p_mmvec_highlights,
             p_xmmvec, mmvec_outputs, force, prjct_nm, qiime_env, chmod,
             noloc, filt_raref, run_params['mmbird'],
             input_to_filtered, jobs, chunkit)
+
+    write_pbs_batch()
+    if dag:
+        launcher = write_dag_launcher(i_datasets_folder, prjct_nm, filt_raref, jobs)
+        if launcher:
+            print('# All jobs chained by file dependencies')
+            print_message('', 'sh', launcher, jobs)
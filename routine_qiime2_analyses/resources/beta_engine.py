@@ -0,0 +1,177 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Compute several non-phylogenetic beta diversity metrics from a feature
+# table that is loaded (and decompressed) once, as "qiime diversity beta"
+# would for each metric (aitchison: euclidean distance between the clr of
+# the counts + 1, jaccard: on presence/absence, others: as in scipy), and
+# save each distance matrix as a DistanceMatrix artifact. The table stays
+# sparse: the metrics based on dot products are computed from the sparse
+# products, and the others on blocks of features densified one at a time.
+#
+# usage: python beta_engine.py --i-table <table.qza> \
+#           --p-metric <metric> --o-distance-matrix <metric_DM.qza> [...] \
+#           --p-n-jobs <threads>
+
+import sys
+import argparse
+import numpy as np
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial.distance import cdist
+
+SCIPY_METRICS = {'braycurtis', 'euclidean', 'cityblock', 'canberra',
+                 'chebyshev', 'correlation', 'cosine', 'sqeuclidean'}
+
+# metrics summed (or maxed) over the features, computed on blocks of
+# features that are densified one at a time
+BLOCK_METRICS = {'braycurtis', 'cityblock', 'canberra', 'chebyshev'}
+
+# number of cells (samples x features) of each densified block of features
+BLOCK_CELLS = 2 ** 24
+
+
+def get_row_blocks(fun, n, n_jobs):
+    """Apply fun to blocks of rows (start, stop) in threads and stack."""
+    step = max(1, -(-n // n_jobs))
+    starts = range(0, n, step)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        blocks = pool.map(lambda s: fun(s, min(n, s + step)), starts)
+        return np.vstack(list(blocks))
+
+
+def get_gram(x, n_jobs):
+    """Dot products between the (sparse) samples, per block of samples."""
+    xt = x.T.tocsc()
+    return get_row_blocks(lambda s, e: (x[s:e] @ xt).toarray(), x.shape[0], n_jobs)
+
+
+def get_euclidean(gram, squared=False):
+    """Euclidean distances from the dot products."""
+    sq = np.diag(gram)
+    d2 = np.maximum(sq[:, None] + sq[None, :] - 2 * gram, 0)
+    if squared:
+        return d2
+    return np.sqrt(d2)
+
+
+def get_cosine(gram):
+    norms = np.sqrt(np.diag(gram))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1 - gram / np.outer(norms, norms)
+
+
+def get_correlation(counts, n_jobs):
+    """Cosine distances of the centered samples, from the sparse dot products."""
+    n_features = counts.shape[1]
+    means = np.asarray(counts.sum(1)).ravel() / n_features
+    gram = get_gram(counts, n_jobs) - n_features * np.outer(means, means)
+    return get_cosine(gram)
+
+
+def get_jaccard(counts, n_jobs):
+    presence = (counts > 0).astype(float)
+    inter = get_gram(presence, n_jobs)
+    n = np.diag(inter)
+    union = n[:, None] + n[None, :] - inter
+    with np.errstate(invalid='ignore', divide='ignore'):
+        d = 1 - inter / union
+    d[union == 0] = 0
+    return d
+
+
+def get_aitchison(counts, n_jobs):
+    """Euclidean distances between the clr of the counts + 1: the logs
+    of the counts + 1 stay sparse, and centering the samples only removes
+    the squared difference of their means times the number of features."""
+    logs = counts.copy()
+    logs.data = np.log1p(logs.data)
+    means = np.asarray(logs.sum(1)).ravel() / counts.shape[1]
+    d2 = get_euclidean(get_gram(logs, n_jobs), True)
+    d2 -= counts.shape[1] * (means[:, None] - means[None, :]) ** 2
+    return np.sqrt(np.maximum(d2, 0))
+
+
+def get_blocks(counts, metric, n_jobs, block_cells=BLOCK_CELLS):
+    """Distances summed (or maxed) over blocks of features, each block
+    densified and compared between blocks of samples in threads."""
+    n, n_features = counts.shape
+    columns = counts.tocsc()
+    step = max(1, block_cells // max(1, n))
+    block_metric = 'cityblock' if metric == 'braycurtis' else metric
+    d = np.zeros((n, n))
+    for start in range(0, n_features, step):
+        block = columns[:, start:start + step].toarray()
+        dist = get_row_blocks(lambda s, e: cdist(block[s:e], block, block_metric), n, n_jobs)
+        if metric == 'chebyshev':
+            np.maximum(d, dist, out=d)
+        else:
+            d += dist
+    if metric == 'braycurtis':
+        totals = np.asarray(counts.sum(1)).ravel()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            d /= totals[:, None] + totals[None, :]
+    return d
+
+
+def get_distances(counts, metric, n_jobs, block_cells=BLOCK_CELLS):
+    """Distances between the samples (rows) of a dense or sparse table."""
+    counts = sparse.csr_matrix(counts, dtype=float)
+    if metric == 'jaccard':
+        d = get_jaccard(counts, n_jobs)
+    elif metric == 'aitchison':
+        d = get_aitchison(counts, n_jobs)
+    elif metric in BLOCK_METRICS:
+        d = get_blocks(counts, metric, n_jobs, block_cells)
+    elif metric == 'correlation':
+        d = get_correlation(counts, n_jobs)
+    elif metric == 'cosine':
+        d = get_cosine(get_gram(counts, n_jobs))
+    else:
+        d = get_euclidean(get_gram(counts, n_jobs), metric == 'sqeuclidean')
+    # exactly symmetric and hollow, as expected for a DistanceMatrix
+    d = np.triu(d, 1)
+    return d + d.T
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--i-table', required=True)
+    parser.add_argument('--p-metric', action='append', required=True)
+    parser.add_argument('--o-distance-matrix', action='append', required=True)
+    parser.add_argument('--p-n-jobs', type=int, default=1)
+    args = parser.parse_args()
+    if len(args.p_metric) != len(args.o_distance_matrix):
+        print('One --o-distance-matrix is needed per --p-metric', file=sys.stderr)
+        return 1
+    unknown = [x for x in args.p_metric if x not in SCIPY_METRICS | {'jaccard', 'aitchison'}]
+    if unknown:
+        print('Unsupported metric(s): %s' % ', '.join(unknown), file=sys.stderr)
+        return 1
+
+    import biom
+    import qiime2
+    import skbio
+
+    table = qiime2.Artifact.load(args.i_table).view(biom.Table)
+    if table.is_empty():
+        print('The table %s is empty' % args.i_table, file=sys.stderr)
+        return 1
+    ids = table.ids(axis='sample')
+    # samples as rows of the sparse table (never densified as a whole)
+    counts = table.matrix_data.T.tocsr().astype(float)
+    n_jobs = max(1, args.p_n_jobs)
+    for metric, out_fp in zip(args.p_metric, args.o_distance_matrix):
+        dm = skbio.DistanceMatrix(get_distances(counts, metric, n_jobs), ids=ids)
+        qiime2.Artifact.import_data('DistanceMatrix', dm).save(out_fp)
+        print('Saved DistanceMatrix to: %s' % out_fp)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
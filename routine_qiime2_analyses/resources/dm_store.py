@@ -0,0 +1,111 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Store of the distance matrices, next to each <name>_DM.qza artifact:
+# - <name>_DM.dm.npy: condensed distances (upper triangle, row by row, as
+#   scipy's squareform) in a binary file that is memory-mapped for reading,
+#   so that the jobs reading the same matrix share it instead of loading it;
+# - <name>_DM.dm.ids: sample IDs, in the order of the matrix.
+# The scripts in this folder import it to read the matrices from the store.
+#
+# usage: python dm_store.py --i-distance-matrix <DM.qza> [...] [--p-precision float32]
+
+import os
+import sys
+import argparse
+import numpy as np
+from os.path import getmtime, isfile, splitext
+
+
+def get_store(dm_fp):
+    root = splitext(dm_fp)[0]
+    return '%s.dm.npy' % root, '%s.dm.ids' % root
+
+
+def has_store(dm_fp):
+    """Whether the store of the matrix exists, is complete (IDs not older
+    than the distances) and is not older than the matrix."""
+    npy, ids_fp = get_store(dm_fp)
+    if not isfile(npy) or not isfile(ids_fp) or getmtime(ids_fp) < getmtime(npy):
+        return False
+    return not isfile(dm_fp) or getmtime(npy) >= getmtime(dm_fp)
+
+
+def write_store(dm_fp, data, ids, precision='float64'):
+    npy, ids_fp = get_store(dm_fp)
+    n = len(ids)
+    condensed = np.asarray(data)[np.triu_indices(n, 1)]
+    # both written to temporary files first, the IDs after the distances:
+    # readers never see a partial store, nor IDs older than the distances
+    np.save('%s.tmp.npy' % npy[:-4], condensed.astype(precision))
+    os.replace('%s.tmp.npy' % npy[:-4], npy)
+    with open('%s.tmp' % ids_fp, 'w') as o:
+        for sample in ids:
+            o.write('%s\n' % sample)
+    os.replace('%s.tmp' % ids_fp, ids_fp)
+
+
+def read_store(dm_fp):
+    """Sample IDs and memory-mapped condensed distances of a matrix."""
+    npy, ids_fp = get_store(dm_fp)
+    with open(ids_fp) as f:
+        ids = [x.rstrip('\n') for x in f]
+    return ids, np.load(npy, mmap_mode='r')
+
+
+def get_condensed_index(n, i, j):
+    """Index in the condensed distances of the pairs of samples i and j."""
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+def get_square(condensed, n, keep=None):
+    """Square matrix of the samples to keep (all by default), reading from
+    the condensed distances only the distances between these samples."""
+    if keep is None:
+        rows, cols = np.triu_indices(n, 1)
+        values = condensed
+    else:
+        keep = np.asarray(keep)
+        rows, cols = np.triu_indices(len(keep), 1)
+        values = condensed[get_condensed_index(n, keep[rows], keep[cols])]
+    square = np.zeros((n if keep is None else len(keep),) * 2)
+    square[rows, cols] = values
+    return square + square.T
+
+
+def load_dm(dm_fp):
+    """Sample IDs and condensed distances of a matrix (memory-mapped from
+    its store if it is up-to-date, otherwise from its artifact), to read
+    the square matrix of the tested samples only (see get_square)."""
+    if has_store(dm_fp):
+        return read_store(dm_fp)
+    import qiime2
+    import skbio
+    dm = qiime2.Artifact.load(dm_fp).view(skbio.DistanceMatrix)
+    return list(dm.ids), dm.condensed_form()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--i-distance-matrix', action='append', required=True)
+    parser.add_argument('--p-precision', default='float64', choices=['float32', 'float64'])
+    args = parser.parse_args()
+
+    import qiime2
+    import skbio
+
+    for dm_fp in args.i_distance_matrix:
+        dm = qiime2.Artifact.load(dm_fp).view(skbio.DistanceMatrix)
+        write_store(dm_fp, dm.data, dm.ids, args.p_precision)
+        print('Stored %s to: %s' % (dm_fp, get_store(dm_fp)[0]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
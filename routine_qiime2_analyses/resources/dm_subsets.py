@@ -0,0 +1,55 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Filter a distance matrix for several metadata files at once: the matrix
+# is loaded once and each subset (the samples of the distance matrix that
+# are in a metadata file, as "qiime diversity filter-distance-matrix")
+# is sliced by sample index and saved as a DistanceMatrix artifact.
+# The matrix is read from its memory-mapped store if it is up-to-date
+# (see dm_store.py), reading only the distances of the subsets.
+#
+# usage: python dm_subsets.py --i-distance-matrix <DM.qza> \
+#           --m-metadata-file <case.meta> --o-filtered-distance-matrix <case_DM.qza> [...]
+
+import sys
+import argparse
+import numpy as np
+
+from dm_store import get_square, load_dm
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--i-distance-matrix', required=True)
+    parser.add_argument('--m-metadata-file', action='append', required=True)
+    parser.add_argument('--o-filtered-distance-matrix', action='append', required=True)
+    args = parser.parse_args()
+    if len(args.m_metadata_file) != len(args.o_filtered_distance_matrix):
+        print('One --o-filtered-distance-matrix is needed per --m-metadata-file', file=sys.stderr)
+        return 1
+
+    import qiime2
+    import skbio
+
+    ids, condensed = load_dm(args.i_distance_matrix)
+    ids = np.array(ids)
+    ret = 0
+    for meta, out_fp in zip(args.m_metadata_file, args.o_filtered_distance_matrix):
+        keep = np.flatnonzero(np.isin(ids, list(qiime2.Metadata.load(meta).get_ids())))
+        if not keep.size:
+            print('All samples were filtered out of the distance matrix for %s' % meta, file=sys.stderr)
+            ret = 1
+            continue
+        case_dm = skbio.DistanceMatrix(get_square(condensed, len(ids), keep), ids=ids[keep])
+        qiime2.Artifact.import_data('DistanceMatrix', case_dm).save(out_fp)
+        print('Saved DistanceMatrix to: %s' % out_fp)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
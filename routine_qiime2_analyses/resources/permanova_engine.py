@@ -0,0 +1,266 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Run all the beta group significance tests of a distance matrix at once
+# (as "qiime diversity beta-group-significance" for each test), with the
+# matrix loaded once (from its store if it is up-to-date, see dm_store.py).
+# Each test uses the samples of the matrix that are in its metadata file
+# and that have a value in its column, as in qiime2, and its results are
+# written in the same html table as exported from the qiime2 visualization.
+# - permanova (pseudo-F) and anosim (R): the statistic of every permutation
+#   is computed from the sums of the squared distances (resp. distances
+#   ranks) within groups, for batches of permutations at once (matrix
+#   products) in threads. The permutations are drawn once per number of
+#   samples and shared by all the tests with that number of samples.
+#   The p-values are computed as in scikit-bio's permanova and anosim:
+#   (number of permuted statistics >= statistic + 1) / (permutations + 1).
+# - permdisp (F-value): the samples are placed once in the principal
+#   coordinates of the matrix of the tested samples (all the axes with a
+#   positive eigenvalue), and for each permutation the distances of the
+#   samples to the geometric median of their group (as in scikit-bio's
+#   permdisp) are compared between groups (one-way ANOVA), in threads.
+# With --p-stages, the tests are sequential (see sequential_perms.py): the
+# permutations are run by stages (numbers of permutations in total), and
+# each test stops at the first stage where its p-value is decided.
+#
+# usage: python permanova_engine.py --i-distance-matrix <DM.qza> \
+#           --test <meta> <column> <permanova|anosim|permdisp> <out.html> [...] \
+#           --p-permutations 999 --p-n-jobs <threads> [--p-stages 99 999 ... --p-alpha 0.05] [--p-seed 0]
+
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from scipy.stats import rankdata
+
+from dm_store import get_square, load_dm
+from sequential_perms import is_decided
+
+RESULTS_INDEX = ['method name', 'test statistic name', 'sample size', 'number of groups',
+                 'test statistic', 'p-value', 'number of permutations']
+METHODS = {'permanova': ('PERMANOVA', 'pseudo-F'),
+           'anosim': ('ANOSIM', 'R'),
+           'permdisp': ('PERMDISP', 'F-value')}
+PERMUTATIONS = {}
+GENERATORS = {}
+SEED = {'seed': 0}
+BATCH = 64
+
+
+def get_permutations(n, stop):
+    """First permutations of n samples, drawn once per number of samples
+    (and extended when a test needs more of them), from a generator seeded
+    by the seed and the number of samples: the same at every run."""
+    if n not in GENERATORS:
+        GENERATORS[n] = np.random.default_rng([SEED['seed'], n])
+    perms = PERMUTATIONS.get(n, np.zeros((0, n), dtype=int))
+    if perms.shape[0] < stop:
+        perms = np.vstack([perms, GENERATORS[n].permuted(
+            np.tile(np.arange(n), (stop - perms.shape[0], 1)), axis=1)])
+        PERMUTATIONS[n] = perms
+    return perms[:stop]
+
+
+def get_grouping(meta, column, ids):
+    """Positions in the matrix and group labels of the samples to test."""
+    meta_pd = pd.read_csv(meta, header=0, sep='\t', dtype=str, keep_default_na=False)
+    meta_pd = meta_pd.loc[meta_pd.iloc[:, 0] != '#q2:types']
+    meta_pd = meta_pd.set_index(meta_pd.columns[0])[column]
+    meta_pd = meta_pd.loc[meta_pd.str.strip() != '']
+    positions = dict((sample, idx) for idx, sample in enumerate(ids))
+    meta_samples = set(meta_pd.index)
+    samples = [x for x in ids if x in meta_samples]
+    groups, labels = np.unique(meta_pd.loc[samples].values, return_inverse=True)
+    return np.array([positions[x] for x in samples]), labels, len(groups)
+
+
+def get_within_sums(mat, label_rows, n_groups, n_jobs):
+    """Sum of the matrix values between the samples of each group (each
+    pair once), for each row of labels (observed or permuted)."""
+    n = label_rows.shape[1]
+
+    def get_batch(start):
+        batch = label_rows[start:start + BATCH]
+        onehot = (batch[:, :, None] == np.arange(n_groups)).astype(float)
+        onehot = onehot.transpose(1, 0, 2).reshape(n, -1)
+        return ((onehot * mat.dot(onehot)).sum(0) / 2).reshape(-1, n_groups)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        return np.vstack(list(pool.map(get_batch, range(0, label_rows.shape[0], BATCH))))
+
+
+def get_permanova_stats(square, labels, n_groups, n_jobs):
+    """Function returning the pseudo-F of each row of labels."""
+    n = len(labels)
+    sq = square ** 2
+    s_t = sq.sum() / 2 / n
+    group_sizes = np.bincount(labels, minlength=n_groups)
+
+    def get_stats(label_rows):
+        s_w = (get_within_sums(sq, label_rows, n_groups, n_jobs) / group_sizes).sum(1)
+        return ((s_t - s_w) / (n_groups - 1)) / (s_w / (n - n_groups))
+    return get_stats
+
+
+def get_anosim_stats(square, labels, n_groups, n_jobs):
+    """Function returning the R statistic of each row of labels."""
+    n = len(labels)
+    rows, cols = np.triu_indices(n, 1)
+    ranks = np.zeros((n, n))
+    ranks[rows, cols] = rankdata(square[rows, cols], method='average')
+    ranks += ranks.T
+    group_sizes = np.bincount(labels, minlength=n_groups)
+    n_within = (group_sizes * (group_sizes - 1) / 2).sum()
+    n_between = n * (n - 1) / 2 - n_within
+    r_total = ranks.sum() / 2
+
+    def get_stats(label_rows):
+        r_within = get_within_sums(ranks, label_rows, n_groups, n_jobs).sum(1)
+        r_b = (r_total - r_within) / n_between
+        return (r_b - r_within / n_within) / (n * ((n - 1) / 4))
+    return get_stats
+
+
+def run_test(get_stats, labels, stages, alpha):
+    """Statistic, p-value and number of permutations run: the permutations
+    of each stage are added to those of the previous stages, until the
+    p-value is decided (only one stage if the test is not sequential)."""
+    stat = get_stats(labels[None, :])[0]
+    greater, done = 0, 0
+    for stage in stages:
+        if stage > done:
+            perm_stats = get_stats(labels[get_permutations(len(labels), stage)[done:]])
+            greater += (perm_stats >= stat).sum()
+            done = stage
+        if len(stages) > 1 and is_decided(greater, done, alpha):
+            break
+    if not done:
+        return stat, np.nan, 0
+    return stat, (greater + 1) / (done + 1), done
+
+
+def get_pcoa(square):
+    """Coordinates of the samples on the principal coordinates axes that
+    have a positive eigenvalue (the other axes are null in scikit-bio)."""
+    n = square.shape[0]
+    centering = np.eye(n) - 1. / n
+    eigvals, eigvecs = np.linalg.eigh(-0.5 * centering.dot(square ** 2).dot(centering))
+    positive = eigvals > eigvals.max() * 1e-10
+    return eigvecs[:, positive] * np.sqrt(eigvals[positive])
+
+
+def get_geomedian(x, eps=1e-7, maxiters=500):
+    """Geometric median of the rows of x (as hdmedians, in scikit-bio)."""
+    y = x.mean(0)
+    if x.shape[0] == 1:
+        return y
+    for _ in range(maxiters):
+        dists = np.sqrt(((x - y) ** 2).sum(1))
+        nonzero = dists > eps
+        if not nonzero.any():
+            break
+        dinv = np.where(nonzero, 1. / np.where(nonzero, dists, 1.), 0.)
+        dinvs = dinv.sum()
+        t = (dinv[nonzero, None] * x[nonzero]).sum(0) / dinvs
+        nzeros = (~nonzero).sum()
+        if not nzeros:
+            y1 = t
+        else:
+            r = np.sqrt((((t - y) * dinvs) ** 2).sum())
+            rinv = nzeros / r if r > eps else 0.
+            y1 = max(0, 1 - rinv) * t + min(1, rinv) * y
+        if np.sqrt(((y - y1) ** 2).sum()) < eps:
+            break
+        y = y1
+    return y
+
+
+def get_permdisp_stats(square, labels, n_groups, n_jobs):
+    """Function returning the F-value of the distances to the group
+    medians, for each row of labels (the ordination is computed once)."""
+    n = len(labels)
+    coords = get_pcoa(square)
+
+    def get_stat(row):
+        dists = np.zeros(n)
+        for group in range(n_groups):
+            in_group = row == group
+            dists[in_group] = np.sqrt(((coords[in_group] - get_geomedian(coords[in_group])) ** 2).sum(1))
+        sizes = np.bincount(row, minlength=n_groups)
+        means = np.bincount(row, weights=dists, minlength=n_groups) / sizes
+        s_b = (sizes * (means - dists.mean()) ** 2).sum()
+        s_w = ((dists - means[row]) ** 2).sum()
+        return (s_b / (n_groups - 1)) / (s_w / (n - n_groups))
+
+    def get_stats(label_rows):
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            return np.array(list(pool.map(get_stat, label_rows)))
+    return get_stats
+
+
+def write_results(out_html, method, sample_size, n_groups, stat, p_value, permutations):
+    result = pd.Series([METHODS[method][0], METHODS[method][1], sample_size, n_groups,
+                        stat, p_value, permutations], index=RESULTS_INDEX,
+                       name='%s results' % METHODS[method][0])
+    with open(out_html, 'w') as o:
+        o.write('<html>\n<body>\n%s\n</body>\n</html>\n' % result.to_frame().to_html())
+    print('Saved results to: %s' % out_html)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--i-distance-matrix', required=True)
+    parser.add_argument('--test', nargs=4, action='append', required=True,
+                        metavar=('META', 'COLUMN', 'METHOD', 'HTML'))
+    parser.add_argument('--p-permutations', type=int, default=999)
+    parser.add_argument('--p-n-jobs', type=int, default=1)
+    parser.add_argument('--p-stages', type=int, nargs='+')
+    parser.add_argument('--p-alpha', type=float, default=0.05)
+    parser.add_argument('--p-seed', type=int, default=0)
+    args = parser.parse_args()
+    SEED['seed'] = args.p_seed
+    n_jobs = max(1, args.p_n_jobs)
+    stages = args.p_stages if args.p_stages else [args.p_permutations]
+
+    ids, condensed = load_dm(args.i_distance_matrix)
+    squares = {}
+    ret = 0
+    for meta, column, method, out_html in args.test:
+        if method not in METHODS:
+            print('Unsupported method "%s" for %s' % (method, out_html), file=sys.stderr)
+            ret = 1
+            continue
+        try:
+            keep, labels, n_groups = get_grouping(meta, column, ids)
+        except KeyError:
+            print('Column "%s" not in %s (for %s)' % (column, meta, out_html), file=sys.stderr)
+            ret = 1
+            continue
+        n = len(keep)
+        if n_groups < 2 or n_groups == n:
+            print('Not testing "%s" (%s groups for %s samples) for %s' % (
+                column, n_groups, n, out_html), file=sys.stderr)
+            ret = 1
+            continue
+        if keep.tobytes() not in squares:
+            squares[keep.tobytes()] = get_square(condensed, len(ids), keep)
+        square = squares[keep.tobytes()]
+        if method == 'permanova':
+            get_stats = get_permanova_stats(square, labels, n_groups, n_jobs)
+        elif method == 'anosim':
+            get_stats = get_anosim_stats(square, labels, n_groups, n_jobs)
+        else:
+            get_stats = get_permdisp_stats(square, labels, n_groups, n_jobs)
+        stat, p_value, permutations = run_test(get_stats, labels, stages, args.p_alpha)
+        write_results(out_html, method, n, n_groups, stat, p_value, permutations)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
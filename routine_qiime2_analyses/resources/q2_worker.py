@@ -0,0 +1,157 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Run the commands of a job script in a single python interpreter:
+# the "qiime ..." commands are run in-process by the qiime2 command line
+# (i.e. the same actions of the Artifact API, with the same outputs),
+# so that the plugins are only loaded once for all the commands.
+# The other commands (and all the commands if qiime2 is not available)
+# are run by bash, as they would be in the script.
+#
+# usage: python q2_worker.py <commands.sh>
+
+import re
+import sys
+import shlex
+import subprocess
+import traceback
+
+RUNS_STATUS_END = '# q2_status end\n'
+SHELL_RE = re.compile(r'[|&;<>$`()]')
+
+
+def get_open_quote(line, quote=''):
+    """Quote still opened at the end of a line ('' if none)."""
+    escaped = False
+    previous = ' '
+    for char in line:
+        if escaped:
+            escaped = False
+        elif char == '\\' and quote != "'":
+            escaped = True
+        elif quote:
+            if char == quote:
+                quote = ''
+        elif char in '"\'':
+            quote = char
+        elif char == '#' and previous.isspace():
+            break
+        previous = char
+    return quote
+
+
+def get_blocks(lines):
+    """Blocks of lines separated by empty lines (that are not quoted,
+    e.g. in the echo of the commands)."""
+    blocks = [[]]
+    quote = ''
+    for line in lines:
+        if line.strip() or quote:
+            blocks[-1].append(line)
+        elif blocks[-1]:
+            blocks.append([])
+        quote = get_open_quote(line, quote)
+    return [x for x in blocks if x]
+
+
+def split_block(block):
+    """Get the echo lines, the command and the status lines of a block,
+    or None if the block is not a single qiime2 command."""
+    echos, command, status = [], [], []
+    in_echo = False
+    for line in block:
+        if in_echo or (not command and line.startswith('echo ')):
+            echos.append(line)
+            if line.replace('\\"', '').count('"') % 2:
+                in_echo = not in_echo
+        elif line.startswith('q2_status ') and command:
+            status.append(line)
+        elif status or (command and not command[-1].rstrip().endswith('\\')):
+            return None
+        else:
+            command.append(line)
+    command = ''.join(command).replace('\\\n', ' ').strip()
+    if not command.startswith('qiime ') or SHELL_RE.search(command):
+        return None
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return None
+    return echos, args, status
+
+
+def run_bash(prelude, lines):
+    return subprocess.call(['bash', '-c', prelude + ''.join(lines)])
+
+
+def run_qiime(root, args):
+    import click
+    try:
+        ret = root.main(args=args[1:], prog_name='qiime', standalone_mode=False)
+    except SystemExit as e:
+        ret = e.code
+    except click.exceptions.Exit as e:
+        ret = e.exit_code
+    except click.exceptions.ClickException as e:
+        e.show()
+        ret = e.exit_code
+    except click.exceptions.Abort:
+        ret = 1
+    except Exception:
+        traceback.print_exc()
+        ret = 1
+    if ret is None or isinstance(ret, int):
+        return ret or 0
+    return 0
+
+
+def get_root():
+    try:
+        from q2cli.commands import RootCommand
+    except ImportError:
+        print('q2cli not available: running all the commands with bash', file=sys.stderr)
+        return None
+    return RootCommand()
+
+
+def main(commands_sh):
+    with open(commands_sh) as f:
+        lines = f.readlines()
+    prelude = ''
+    if RUNS_STATUS_END in lines:
+        prelude = ''.join(lines[:lines.index(RUNS_STATUS_END) + 1])
+        lines = lines[lines.index(RUNS_STATUS_END) + 1:]
+    root = get_root()
+    failed = []
+    ret = 0
+    for block in get_blocks(lines):
+        split = split_block(block) if root is not None else None
+        if split is None:
+            ret = run_bash(prelude, block)
+            continue
+        echos, args, status = split
+        if echos:
+            run_bash('', echos)
+        sys.stdout.flush()
+        ret = run_qiime(root, args)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if ret:
+            failed.append((ret, ' '.join(args[:3])))
+        if status:
+            run_bash(prelude, ['(exit %s)\n' % ret] + status)
+    for code, command in failed:
+        print('[FAILED] %s (exit code %s)' % (command, code), file=sys.stderr)
+    if failed:
+        # the job fails (and its dependent jobs are not released)
+        return 1
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1]))
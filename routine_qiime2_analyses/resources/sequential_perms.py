@@ -0,0 +1,100 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Sequential permutation tests: the permutations are run in increasing
+# stages, and the test stops once the 99% confidence interval of its
+# p-value is entirely below or above alpha (or at the last stage), so
+# that only the borderline tests are run with many permutations.
+# The scripts in this folder import it, and the jobs call it to check
+# the p-value of a qiime2 visualization exported to html. With a counts
+# file, each stage only runs the permutations it adds to the previous
+# stages: the counts of permutations (and of permuted statistics >= the
+# statistic) are accumulated in the counts file, and the p-value and the
+# number of permutations of the html are those of all the stages (the
+# qiime2 visualization keeps those of the last stage only).
+#
+# usage: python sequential_perms.py <index.html> <permutations> <alpha> <max permutations> [<counts>]
+#   exit code 0: p-value decided (or maximum reached), 1: to re-run with more permutations,
+#             2: no p-value in the html (the test failed).
+
+import sys
+from os.path import isfile
+from math import sqrt
+
+Z = 2.5758
+
+
+def get_interval(greater, permutations):
+    """Wilson interval of the p-value (greater + 1) / (permutations + 1)."""
+    n = permutations + 1.
+    p = (greater + 1) / n
+    centre = (p + Z * Z / (2 * n)) / (1 + Z * Z / n)
+    half = Z * sqrt(p * (1 - p) / n + Z * Z / (4 * n * n)) / (1 + Z * Z / n)
+    return centre - half, centre + half
+
+
+def is_decided(greater, permutations, alpha):
+    """Whether the p-value is clearly below or above alpha."""
+    low, high = get_interval(greater, permutations)
+    return high < alpha or low > alpha
+
+
+def read_p_value(html):
+    with open(html) as f:
+        lines = [x.strip() for x in f]
+    for ldx, line in enumerate(lines):
+        if '<th>p-value</th>' in line:
+            return float(lines[ldx + 1].split('<td>')[-1].split('</td>')[0])
+    return None
+
+
+def add_counts(html, greater, permutations, counts):
+    """Add the counts of a stage to those of the previous stages (in the
+    counts file) and write the p-value of all the stages in the html."""
+    if isfile(counts):
+        with open(counts) as f:
+            previous = [int(x) for x in f.read().split()]
+        greater += previous[0]
+        permutations += previous[1]
+    with open(counts, 'w') as o:
+        o.write('%s\t%s\n' % (greater, permutations))
+    with open(html) as f:
+        lines = f.readlines()
+    for ldx, line in enumerate(lines[:-1]):
+        if '<th>p-value</th>' in line:
+            value = (greater + 1) / (permutations + 1.)
+        elif '<th>' in line and 'permutations</th>' in line.lower():
+            value = permutations
+        else:
+            continue
+        td = lines[ldx + 1]
+        lines[ldx + 1] = '%s<td>%s</td>%s' % (td.split('<td>')[0], value, td.split('</td>')[-1])
+    with open(html, 'w') as o:
+        o.write(''.join(lines))
+    return greater, permutations
+
+
+def main(html, permutations, alpha, max_permutations, counts=None):
+    try:
+        p_value = read_p_value(html)
+    except (IOError, ValueError):
+        p_value = None
+    if p_value is None:
+        print('No p-value in %s' % html, file=sys.stderr)
+        return 2
+    greater = int(round(p_value * (permutations + 1))) - 1
+    if counts:
+        greater, permutations = add_counts(html, greater, permutations, counts)
+    if permutations >= max_permutations or is_decided(greater, permutations, alpha):
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1], int(sys.argv[2]), float(sys.argv[3]), int(sys.argv[4]),
+                  sys.argv[5] if len(sys.argv) > 5 else None))
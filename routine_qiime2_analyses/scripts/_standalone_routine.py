@@ -9,10 +9,23 @@
 import click
 
 from routine_qiime2_analyses._routine_qiime2_analyses import routine_qiime2_analyses
+from routine_qiime2_analyses.scripts._standalone_run_local import standalone_run_local
 from routine_qiime2_analyses import __version__
 
 
-@click.command()
+class RoutineCommand(click.Command):
+    """
+    Main command, that runs the "run-local" subcommand when it is
+    given as first argument (the other arguments go to the subcommand).
+    """
+    def parse_args(self, ctx, args):
+        if args and args[0] == 'run-local':
+            standalone_run_local.main(args[1:], prog_name='%s run-local' % ctx.info_name)
+        return super().parse_args(ctx, args)
+
+
+@click.command(cls=RoutineCommand, epilog="Run 'routine_qiime2_analyses run-local --help' "
+                                          "to run the launchers written using --no-jobs.")
 @click.option(
     "-i", "--i-datasets-folder", required=True,
     help="Path to the folder containing the sub-folders 'data' and 'metadata'."
@@ -246,13 +259,83 @@ from routine_qiime2_analyses import __version__
 )
 @click.option(
     "--jobs/--no-jobs", default=True, show_default=True,
-    help="Whether to prepare Torque jobs from scripts."
+    help="Whether to prepare Torque jobs from scripts (the launchers written "
+         "using --no-jobs can be run with 'routine_qiime2_analyses run-local')."
 )
 @click.option(
     "-chunkit", "--p-chunkit", required=False, show_default=False,
     type=int, default=None,
     help="Maximum number of jobs at which extra jobs will be added in chunks"
 )
+@click.option(
+    "--dag/--no-dag", default=False, show_default=True,
+    help="Write a single launcher chaining the jobs of all the steps "
+         "with Torque dependencies (-W depend=afterok): each job waits for "
+         "the jobs writing the files it uses. The analyses of the "
+         "distance matrices computed by the launcher (PERMANOVA, Adonis, "
+         "Procrustes, Mantel, decay, nestedness) are chained in it, and so are "
+         "the analyses of the rarefied and collapsed tables (planned against "
+         "the samples and taxa they will contain). Kruskal-Wallis on alpha "
+         "diversity is planned at the next call, once the alpha vectors exist."
+)
+@click.option(
+    "--arrays/--no-arrays", default=False, show_default=True,
+    help="Write one Torque array job per analysis (-t 0-N) instead of one job "
+         "per script (the array tasks are the scripts listed in an index file)."
+)
+@click.option(
+    "-arrays_cap", "--p-arrays-cap", required=False, show_default=False,
+    type=int, default=None,
+    help="Maximum number of array tasks running at the same time (-t 0-N%K)."
+)
+@click.option(
+    "-plan_workers", "--p-plan-workers", required=False, show_default=False,
+    type=int, default=None,
+    help="Number of processes writing the scripts of each analysis in parallel "
+         "(the scripts are the same as when written by a single process)."
+)
+@click.option(
+    "--q2-worker/--no-q2-worker", default=False, show_default=True,
+    help="Run the commands of each job in a single python interpreter, with the "
+         "qiime2 commands run in-process (the plugins are loaded once per job). "
+         "The commands are kept in a bash script that can be run as is."
+)
+@click.option(
+    "--beta-engine/--no-beta-engine", default=False, show_default=True,
+    help="Compute the non-phylogenetic beta diversity metrics of each feature "
+         "table together, with the table loaded once and kept sparse, instead "
+         "of one \"qiime diversity beta\" command per metric. The distance "
+         "matrices are imported from the computed distances: their qiime2 "
+         "provenance is not kept."
+)
+@click.option(
+    "--permanova-engine/--no-permanova-engine", default=False, show_default=True,
+    help="Run the beta group significance tests (PERMANOVA, ANOSIM, PERMDISP) "
+         "of each distance matrix together, with the matrix loaded once and the "
+         "permutations shared by the tests, instead of one qiime2 command per test "
+         "(always used for the sequential permutation tests). Only the results "
+         "table (.html) of each test is written: no qiime2 visualization (.qzv), "
+         "i.e. no pairwise tests, boxplots or provenance."
+)
+@click.option(
+    "--xpbs/--no-xpbs", default=True, show_default=True,
+    help="Write the Torque scripts with Xpbs (that must be installed and configured), "
+         "or render their directives in-process (without Xpbs). The jobs rendered "
+         "in-process run in the working directory and keep the default permissions "
+         "of the outputs: --no-xpbs needs --no-loc and the default -chmod."
+)
+@click.option(
+    "--run-manifest/--no-run-manifest", default=False, show_default=True,
+    help="Record each planned command and the status of its job in a SQLite "
+         "database (runs_<project>.sqlite, in the main folder), and plan the next "
+         "calls from it instead of looking for the outputs of the succeeded commands."
+)
+@click.option(
+    "-max_permutations", "--p-max-permutations", required=False, show_default=False,
+    type=int, default=None,
+    help="Run the PERMANOVA, Mantel and Procrustes tests with sequential permutations: "
+         "99, 999, ... up to this maximum, stopping once the p-value is decided."
+)
 @click.version_option(__version__, prog_name="routine_qiime2_analyses")
 
 
@@ -304,7 +387,17 @@ def standalone_routine(
         p_filt3d_config,
         filt_only,
         jobs,
-        p_chunkit
+        p_chunkit,
+        dag,
+        arrays,
+        p_arrays_cap,
+        p_plan_workers,
+        q2_worker,
+        beta_engine,
+        permanova_engine,
+        p_max_permutations,
+        xpbs,
+        run_manifest
 ):
 
     routine_qiime2_analyses(
@@ -355,7 +448,17 @@ def standalone_routine(
         p_filt3d_config,
         filt_only,
         jobs,
-        p_chunkit
+        p_chunkit,
+        dag,
+        arrays,
+        p_arrays_cap,
+        p_plan_workers,
+        q2_worker,
+        beta_engine,
+        permanova_engine,
+        p_max_permutations,
+        xpbs,
+        run_manifest
     )
 
 
@@ -0,0 +1,55 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import sys
+import click
+
+from routine_qiime2_analyses._routine_q2_local import run_local
+from routine_qiime2_analyses import __version__
+
+
+@click.command()
+@click.option(
+    "-l", "--i-launchers", multiple=True, required=True,
+    help="Launcher(s) written using --no-jobs (e.g. jobs/beta/2_run_beta_<project>.sh). "
+         "Multiple is possible: they are run one after the other."
+)
+@click.option(
+    "-c", "--p-cpus", required=False, show_default=False, type=int, default=None,
+    help="Number of processors available (default to all the processors of the machine)."
+)
+@click.option(
+    "-M", "--p-mem", required=False, show_default=False, type=float, default=None,
+    help="Memory available in gb (default to all the memory of the machine)."
+)
+@click.option(
+    "-o", "--p-logs", required=False, show_default=False, default=None,
+    help="Folder where to write the log of each script (default to next to each script)."
+)
+@click.version_option(__version__, prog_name="routine_qiime2_analyses")
+
+
+def standalone_run_local(
+        i_launchers,
+        p_cpus,
+        p_mem,
+        p_logs
+):
+
+    exit_codes = run_local(
+        i_launchers,
+        p_cpus,
+        p_mem,
+        p_logs
+    )
+    if [x for x in exit_codes.values() if x]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    standalone_run_local()
@@ -0,0 +1,4 @@
+echo "qiime tools import"
+qiime tools import \
+--input-path a.tsv \
+--output-path a.qza
@@ -0,0 +1,64 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from routine_qiime2_analyses._routine_q2_arrays import (
+    ARRAYS, add_array_directive, arrays_mode, init_arrays)
+
+PBS = '#!/bin/bash\n#PBS -N job\n#PBS -l walltime=2:00:00\n\necho start\n'
+
+
+class ArrayDirectiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.out_pbs = os.path.join(self.tmp, 'job.pbs')
+
+    def tearDown(self):
+        ARRAYS.update({'active': False, 'cap': 0})
+        shutil.rmtree(self.tmp)
+
+    def add(self, content, n_tasks):
+        with open(self.out_pbs, 'w') as pbs:
+            pbs.write(content)
+        add_array_directive(self.out_pbs, n_tasks)
+        with open(self.out_pbs) as f:
+            return f.read()
+
+    def test_init(self):
+        self.assertFalse(arrays_mode())
+        init_arrays()
+        self.assertTrue(arrays_mode())
+        self.assertEqual(ARRAYS['cap'], 0)
+
+    def test_after_last_directive(self):
+        self.assertEqual(
+            self.add(PBS, 5),
+            '#!/bin/bash\n#PBS -N job\n#PBS -l walltime=2:00:00\n'
+            '#PBS -t 0-4\n\necho start\n')
+
+    def test_cap(self):
+        init_arrays(3)
+        self.assertIn('#PBS -t 0-9%3\n', self.add(PBS, 10))
+
+    def test_replace(self):
+        content = self.add(self.add(PBS, 5), 2)
+        self.assertIn('#PBS -t 0-1\n', content)
+        self.assertNotIn('#PBS -t 0-4\n', content)
+
+    def test_no_directive(self):
+        self.assertEqual(self.add('#!/bin/bash\necho start\n', 2),
+                         '#!/bin/bash\n#PBS -t 0-1\necho start\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import sys
+import unittest
+import pkg_resources
+import numpy as np
+from scipy import sparse
+from scipy.spatial.distance import pdist, squareform
+from skbio.stats.composition import clr
+
+from routine_qiime2_analyses._routine_q2_beta import BETA_BATCH_METRICS, is_beta_batch
+from routine_qiime2_analyses._routine_q2_engines import init_engines
+
+RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+sys.path.insert(0, RESOURCES)
+
+from beta_engine import SCIPY_METRICS, get_distances
+
+
+def get_expected(counts, metric):
+    if metric == 'jaccard':
+        return squareform(pdist(counts > 0, 'jaccard'))
+    if metric == 'aitchison':
+        return squareform(pdist(clr(counts + 1), 'euclidean'))
+    return squareform(pdist(counts, metric))
+
+
+class BetaEngineTests(unittest.TestCase):
+    """The engine's distances against scipy's (and scikit-bio's clr)."""
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.counts = np.random.poisson(3, (17, 40)).astype(float)
+
+    def test_supported_metrics(self):
+        self.assertEqual(BETA_BATCH_METRICS - SCIPY_METRICS, {'jaccard', 'aitchison'})
+
+    def test_engine_flag(self):
+        # opt-in, without the --q2-worker mode
+        self.assertFalse(is_beta_batch('braycurtis'))
+        init_engines(True)
+        self.assertTrue(is_beta_batch('braycurtis'))
+        self.assertFalse(is_beta_batch('unweighted_unifrac'))
+        init_engines()
+
+    def test_distances(self):
+        for metric in sorted(BETA_BATCH_METRICS):
+            for n_jobs in [1, 4]:
+                d = get_distances(self.counts, metric, n_jobs)
+                np.testing.assert_allclose(
+                    d, get_expected(self.counts, metric), atol=1e-10, err_msg=metric)
+                self.assertTrue((d == d.T).all())
+                self.assertTrue((np.diag(d) == 0).all())
+
+    def test_sparse_blocks(self):
+        # a sparse table, with its features compared a few at a time
+        counts = self.counts * (np.random.random(self.counts.shape) < 0.3)
+        for metric in sorted(BETA_BATCH_METRICS):
+            d = get_distances(sparse.csc_matrix(counts), metric, 2, block_cells=17 * 3)
+            np.testing.assert_allclose(
+                d, get_expected(counts, metric), atol=1e-10, err_msg=metric)
+
+    def test_empty_samples(self):
+        counts = self.counts.copy()
+        counts[[0, 1]] = 0
+        d = get_distances(counts, 'jaccard', 1)
+        self.assertEqual(d[0, 1], 0)
+        self.assertEqual(d[0, 2], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
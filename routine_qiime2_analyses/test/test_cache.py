@@ -0,0 +1,120 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from routine_qiime2_analyses._routine_q2_cache import (
+    FINGERPRINTS, MANIFEST, get_features_fingerprint, get_file_fingerprint, get_input_fingerprint,
+    init_fingerprints, is_stale, write_fingerprints)
+from routine_qiime2_analyses._routine_q2_runs import RUNS, init_runs, write_runs
+
+
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.input = self.write('tab.tsv', 'a\t1\n')
+        self.output = '%s/dm.qza' % self.tmp
+
+    def tearDown(self):
+        FINGERPRINTS.update({'active': False, 'env': '', 'manifests': {},
+                             'dirty': set(), 'files': {}, 'journal': None})
+        RUNS.update({'active': False, 'recorded': {}, 'planned': {}, 'to_write': {}, 'adopted': {}})
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content, mtime=None):
+        path = '%s/%s' % (self.tmp, name)
+        with open(path, 'w') as o:
+            o.write(content)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_inactive(self):
+        self.assertTrue(is_stale(False, self.output, (self.input,)))
+        self.write('dm.qza', 'dm')
+        self.assertFalse(is_stale(False, self.output, (self.input,)))
+        self.assertTrue(is_stale(True, self.output, (self.input,)))
+
+    def test_file_fingerprint(self):
+        self.assertEqual(get_file_fingerprint('%s/missing' % self.tmp), '')
+        fingerprint = get_file_fingerprint(self.input)
+        self.write('tab.tsv', 'a\t2\n', 1000)
+        self.assertNotEqual(get_file_fingerprint(self.input), fingerprint)
+
+    def test_features_fingerprint(self):
+        fingerprint = get_features_fingerprint(['f%s' % x for x in range(10000)])
+        self.assertEqual(len(fingerprint), 32)
+        self.assertEqual(get_features_fingerprint(('f%s' % x for x in range(10000))), fingerprint)
+        self.assertNotEqual(get_features_fingerprint(['f1', 'f2']), get_features_fingerprint(['f2', 'f1']))
+
+    def test_output_computed_after_planning(self):
+        init_fingerprints('qiime2-2020.2')
+        self.assertTrue(is_stale(False, self.output, (self.input,), ('bray',)))
+        self.write('dm.qza', 'dm')
+        self.assertFalse(is_stale(False, self.output, (self.input,), ('bray',)))
+
+    def test_planned_but_not_recomputed(self):
+        init_fingerprints('qiime2-2020.2')
+        self.write('dm.qza', 'dm', 1000)
+        self.assertTrue(is_stale(True, self.output, (self.input,)))
+        self.assertTrue(is_stale(False, self.output, (self.input,)))
+        self.write('dm.qza', 'dm', 2000)
+        self.assertFalse(is_stale(False, self.output, (self.input,)))
+
+    def test_adopted_output(self):
+        init_fingerprints('qiime2-2020.2')
+        self.write('dm.qza', 'dm')
+        self.assertFalse(is_stale(False, self.output, (self.input,)))
+
+    def test_changed_param_or_input(self):
+        init_fingerprints('qiime2-2020.2')
+        self.write('dm.qza', 'dm')
+        self.assertFalse(is_stale(False, self.output, (self.input,), ('bray',)))
+        self.assertTrue(is_stale(False, self.output, (self.input,), ('jaccard',)))
+        self.write('dm.qza', 'dm', 1000)
+        self.assertFalse(is_stale(False, self.output, (self.input,), ('jaccard',)))
+        self.write('tab.tsv', 'a\t2\n', 1000)
+        self.assertTrue(is_stale(False, self.output, (self.input,), ('jaccard',)))
+
+    def test_pending_input(self):
+        init_fingerprints('qiime2-2020.2')
+        self.write('dm.qza', 'dm')
+        self.assertFalse(is_stale(False, self.output, ('%s/missing' % self.tmp,)))
+        self.assertEqual(FINGERPRINTS['manifests'][self.tmp]['dm.qza'][0], 'pending')
+
+    def test_write_fingerprints(self):
+        init_fingerprints('qiime2-2020.2')
+        self.write('dm.qza', 'dm')
+        is_stale(False, self.output, (self.input,))
+        write_fingerprints()
+        with open('%s/%s' % (self.tmp, MANIFEST)) as f:
+            line = f.read().strip().split('\t')
+        self.assertEqual(line[0], 'dm.qza')
+        self.assertEqual(line[2], 'ok')
+        self.assertEqual(FINGERPRINTS['dirty'], set())
+
+    def test_run_manifest(self):
+        init_fingerprints('qiime2-2020.2')
+        init_runs(self.tmp, 'test')
+        self.write('dm.qza', 'dm')
+        self.assertFalse(is_stale(False, self.output, (self.input,)))
+        write_runs()
+        # up-to-date according to the manifest, without looking for it
+        os.remove(self.output)
+        self.assertFalse(is_stale(False, self.output, (self.input,)))
+        self.assertTrue(get_input_fingerprint(self.output).startswith('run:'))
+        self.assertTrue(is_stale(False, self.output, (self.input,), ('jaccard',)))
+        self.assertIn(self.output, RUNS['planned'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from routine_qiime2_analyses._routine_q2_dag import (
+    DAG, DAG_MAX_DEPEND, add_dag_job, get_dag_ancestors,
+    init_dag, set_dag_stage, write_dag_launcher)
+
+
+class DagTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.tab = '%s/data/tab.tsv' % self.tmp
+        self.write('data/tab.tsv', '')
+        init_dag()
+        # import, two independent beta jobs, a PERMANOVA on one of them
+        self.add_job('import', 'i', 'qiime tools import --input-path %s --output-path %s/tab.qza\n' % (
+            self.tab, self.tmp))
+        self.add_job('beta', 'b1', 'qiime diversity beta --i-table %s/tab.qza --o-distance-matrix %s/b1.qza\n' % (
+            self.tmp, self.tmp))
+        self.add_job('beta', 'b2', 'qiime diversity beta --i-table %s/other.qza --o-distance-matrix %s/b2.qza\n' % (
+            self.tmp, self.tmp))
+        self.add_job('permanova', 'p', 'qiime diversity beta-group-significance --i-distance-matrix %s/b1.qza '
+                                       '--o-visualization %s/p.qzv\n' % (self.tmp, self.tmp))
+
+    def tearDown(self):
+        DAG['active'] = False
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        fp = '%s/%s' % (self.tmp, name)
+        if '/' in name:
+            os.makedirs('%s/%s' % (self.tmp, name.rsplit('/', 1)[0]), exist_ok=True)
+        with open(fp, 'w') as o:
+            o.write(content)
+        return fp
+
+    def add_job(self, stage, name, command, array=False):
+        set_dag_stage(stage)
+        out_sh = self.write('%s.sh' % name, command)
+        add_dag_job('%s.pbs' % name, array, [out_sh])
+
+    def get_launcher(self, jobs=True):
+        with open(write_dag_launcher(self.tmp, 'prj', '', jobs)) as f:
+            return f.read()
+
+    def test_ancestors(self):
+        ancestors = get_dag_ancestors('permanova_summarize')
+        self.assertTrue({'permanova', 'beta', 'rarefy', 'filter', 'import'} <= ancestors)
+        self.assertNotIn('alpha', ancestors)
+        self.assertEqual(get_dag_ancestors('import'), set())
+
+    def test_depends_on_producers(self):
+        # existing inputs are not produced by any job
+        self.assertNotIn(self.tab, DAG['producers'])
+        self.assertEqual(DAG['depends'], {0: [], 1: [0], 2: [], 3: [1]})
+
+    def test_script_added_once(self):
+        self.add_job('beta', 'b1', 'qiime diversity beta --i-table %s/tab.qza\n' % self.tmp)
+        self.assertEqual(len(DAG['jobs']), 4)
+        self.assertEqual(DAG['scripts']['b1.pbs'], 1)
+
+    def test_planned_existing_output(self):
+        # an output that exists but is re-written at this call
+        DAG['planned'].add('%s/b3.qza' % self.tmp)
+        self.write('b3.qza', '')
+        self.add_job('beta', 'b3', 'qiime diversity beta --i-table %s/tab.qza --o-distance-matrix %s/b3.qza\n' % (
+            self.tmp, self.tmp))
+        self.add_job('permanova', 'p3', 'qiime diversity beta-group-significance --i-distance-matrix %s/b3.qza '
+                                        '--o-visualization %s/p3.qzv\n' % (self.tmp, self.tmp))
+        self.assertEqual(DAG['depends'][5], [4])
+
+    def test_torque_launcher(self):
+        launcher = self.get_launcher()
+        self.assertIn('j0=$(qsub i.pbs)\n', launcher)
+        self.assertIn('j1=$(qsub -W depend=afterok:${j0} b1.pbs)\n', launcher)
+        self.assertIn('j2=$(qsub b2.pbs)\n', launcher)
+        self.assertIn('j3=$(qsub -W depend=afterok:${j1} p.pbs)\n', launcher)
+        self.assertLess(launcher.index('# beta'), launcher.index('# permanova'))
+
+    def test_array_launcher(self):
+        self.add_job('permanova', 'pa', 'qiime diversity beta-group-significance --i-distance-matrix %s/b2.qza '
+                                        '--o-visualization %s/pa.qzv\n' % (self.tmp, self.tmp), True)
+        self.add_job('permanova_summarize', 's', 'summarize %s/pa.qzv %s/p.qzv\n' % (self.tmp, self.tmp))
+        launcher = self.get_launcher()
+        self.assertIn('j4=$(qsub -W depend=afterok:${j2} pa.pbs)\n', launcher)
+        self.assertIn('j5=$(qsub -W depend=afterok:${j3},afterokarray:${j4} s.pbs)\n', launcher)
+
+    def test_sentinel_jobs(self):
+        for idx in range(DAG_MAX_DEPEND + 1):
+            self.add_job('beta', 'm%s' % idx, 'qiime diversity beta --o-distance-matrix %s/m%s.qza\n' % (
+                self.tmp, idx))
+        self.add_job('mantel', 'all', ' '.join(['%s/m%s.qza' % (self.tmp, x)
+                                                for x in range(DAG_MAX_DEPEND + 1)]))
+        launcher = self.get_launcher()
+        self.assertIn('s1=$(echo "true" | qsub -N prj.dag -l walltime=00:01:00 -W depend=afterok:${j4}', launcher)
+        self.assertIn('s2=$(echo "true" | qsub -N prj.dag -l walltime=00:01:00 -W depend=afterok:${j%s})\n' % (
+            DAG_MAX_DEPEND + 4), launcher)
+        self.assertIn('=$(qsub -W depend=afterok:${s1}:${s2} all.pbs)\n', launcher)
+
+    def test_local_launcher(self):
+        launcher = self.get_launcher(False)
+        self.assertIn('set -e\n', launcher)
+        self.assertNotIn('qsub', launcher)
+        self.assertLess(launcher.index('sh i.pbs\n'), launcher.index('sh b2.pbs\n'))
+        self.assertLess(launcher.index('sh b2.pbs\n'), launcher.index('sh p.pbs\n'))
+
+    def test_no_jobs(self):
+        init_dag()
+        self.assertEqual(write_dag_launcher(self.tmp, 'prj', '', True), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import pkg_resources
+import numpy as np
+from scipy.spatial.distance import pdist, squareform
+
+from routine_qiime2_analyses._routine_q2_cmds import (
+    write_distance_decay, write_diversity_adonis, write_diversity_beta_group_significance)
+
+RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+sys.path.insert(0, RESOURCES)
+
+from dm_store import (get_condensed_index, get_square, get_store, has_store,
+                      load_dm, read_store, write_store)
+
+
+class DmStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dm_fp = os.path.join(self.tmp, 'bray_DM.qza')
+        np.random.seed(12345)
+        self.condensed = pdist(np.random.rand(9, 5))
+        self.data = squareform(self.condensed)
+        self.ids = ['s%s' % x for x in range(9)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_condensed_index(self):
+        n = len(self.ids)
+        for i in range(n):
+            for j in range(n):
+                if i != j:
+                    self.assertEqual(self.condensed[get_condensed_index(n, i, j)],
+                                     self.data[i, j])
+
+    def test_round_trip(self):
+        write_store(self.dm_fp, self.data, self.ids)
+        ids, condensed = read_store(self.dm_fp)
+        self.assertEqual(ids, self.ids)
+        np.testing.assert_array_equal(condensed, self.condensed)
+        np.testing.assert_array_equal(get_square(condensed, len(ids)), self.data)
+
+    def test_keep(self):
+        write_store(self.dm_fp, self.data, self.ids)
+        ids, condensed = read_store(self.dm_fp)
+        keep = [7, 0, 3, 4]
+        np.testing.assert_array_equal(get_square(condensed, len(ids), keep),
+                                      self.data[np.ix_(keep, keep)])
+
+    def test_precision(self):
+        write_store(self.dm_fp, self.data, self.ids, 'float32')
+        ids, condensed = read_store(self.dm_fp)
+        self.assertEqual(condensed.dtype, np.float32)
+        np.testing.assert_allclose(get_square(condensed, len(ids)), self.data, rtol=1e-6)
+
+    def test_single_sample(self):
+        write_store(self.dm_fp, np.zeros((1, 1)), ['s0'])
+        ids, condensed = read_store(self.dm_fp)
+        self.assertEqual(get_square(condensed, 1).shape, (1, 1))
+
+    def test_ids_after_distances(self):
+        # the IDs of a store being re-written are older than its distances
+        write_store(self.dm_fp, self.data, self.ids)
+        npy, ids_fp = get_store(self.dm_fp)
+        os.utime(ids_fp, (os.path.getmtime(npy) - 10,) * 2)
+        self.assertFalse(has_store(self.dm_fp))
+        self.assertFalse(os.path.isfile('%s.tmp' % ids_fp))
+
+    def test_has_store(self):
+        self.assertFalse(has_store(self.dm_fp))
+        write_store(self.dm_fp, self.data, self.ids)
+        self.assertTrue(has_store(self.dm_fp))
+        ids, condensed = load_dm(self.dm_fp)
+        np.testing.assert_array_equal(get_square(condensed, len(ids)), self.data)
+        with open(self.dm_fp, 'w') as o:
+            o.write('newer')
+        npy = get_store(self.dm_fp)[0]
+        os.utime(npy, (os.path.getmtime(self.dm_fp) - 10,) * 2)
+        self.assertFalse(has_store(self.dm_fp))
+
+
+class DmConsumersTests(unittest.TestCase):
+    """The downstream steps read the matrix through dm_subsets.py (store)."""
+
+    def check(self, write, *args):
+        cur_sh = io.StringIO()
+        write(*args, cur_sh)
+        cmds = cur_sh.getvalue()
+        self.assertIn('%s/dm_subsets.py' % RESOURCES, cmds)
+        self.assertIn('--i-distance-matrix dm_DM.qza \\\n--m-metadata-file case.meta', cmds)
+        self.assertNotIn('filter-distance-matrix', cmds)
+
+    def test_consumers(self):
+        self.check(write_diversity_adonis, 'case.meta', 'dm_DM.qza', 'case_DM.qza', 'a+b', 'a.qzv')
+        self.check(write_distance_decay, 'dm_DM.qza', 'case_DM.qza', 'decay.qza', 'decay.tsv',
+                   'case.meta', 'individual', '', '', '', '', '', 10, 10, 1, 1)
+        self.check(write_diversity_beta_group_significance, 'case.meta', 'dm_DM.qza', 'case_DM.qza',
+                   'group', 'permanova', 'p.qzv', 'p.html', 999)
+
+
+if __name__ == '__main__':
+    unittest.main()
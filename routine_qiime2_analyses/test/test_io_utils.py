@@ -0,0 +1,202 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from os.path import isfile
+
+from routine_qiime2_analyses._routine_q2_io_utils import (
+    PERMUTATIONS_COST, READ_PDS, get_collapsed_taxon, get_expected_collapsed_pd,
+    get_expected_raref_pd, get_lpt_chunks, get_raref_tab_meta_pds, get_read_pds,
+    get_script_cost, release_read_pds)
+from routine_qiime2_analyses._routine_q2_cmds import SUBSETS, get_features_subset, write_filter_features
+
+
+class LptChunksTests(unittest.TestCase):
+
+    def test_balanced(self):
+        costs = {'a': 7., 'b': 5., 'c': 4., 'd': 3., 'e': 1.}
+        chunks = get_lpt_chunks(costs, 2)
+        self.assertEqual(sorted([cost for cost, _ in chunks]), [10., 10.])
+        self.assertEqual(sorted([x for _, items in chunks for x in items]), sorted(costs))
+
+    def test_largest_first(self):
+        chunks = get_lpt_chunks({'a': 1., 'b': 10., 'c': 2.}, 2)
+        self.assertEqual(chunks, [(10., ['b']), (3., ['c', 'a'])])
+
+    def test_more_chunks_than_items(self):
+        chunks = get_lpt_chunks({'a': 1., 'b': 2.}, 4)
+        self.assertEqual(len(chunks), 2)
+
+    def test_deterministic_ties(self):
+        costs = dict(('s%s' % x, 1.) for x in range(6))
+        self.assertEqual(get_lpt_chunks(costs, 3), get_lpt_chunks(dict(reversed(list(costs.items()))), 3))
+
+
+class ScriptCostTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.script = '%s/run.sh' % self.tmp
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def get_cost(self, content, size=1.):
+        with open(self.script, 'w') as o:
+            o.write(content)
+        return get_script_cost(self.script, size)
+
+    def test_missing_script(self):
+        self.assertEqual(get_script_cost('%s/missing.sh' % self.tmp), 0.)
+
+    def test_commands(self):
+        content = 'qiime tools import \\\n--input-path a \\\n--output-path b\n\nrm a\n'
+        self.assertEqual(self.get_cost(content), 2.)
+        self.assertEqual(self.get_cost(content, 10.), 20.)
+
+    def test_echo_not_counted(self):
+        content = 'echo "\nqiime a \\\n--p-permutations 999\n\nqiime b\n"\nqiime a \\\n--p-permutations 999\n'
+        self.assertEqual(self.get_cost(content), 999 / PERMUTATIONS_COST)
+
+    def test_permutations_weight(self):
+        cost = self.get_cost('qiime diversity beta-group-significance \\\n--p-permutations 999\nqiime b\n')
+        self.assertEqual(cost, 999 / PERMUTATIONS_COST + 1.)
+        self.assertEqual(self.get_cost('qiime a --p-permutations 9\n'), 1.)
+
+
+
+class ExpectedTablesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.tab_pd = pd.DataFrame(
+            [[1, 0, 5], [0, 0, 2], [3, 1, 0], [4, 0, 0]],
+            index=['f1', 'f2', 'f3', 'f4'], columns=['s1', 's2', 's3'])
+        self.tax_fp = '%s/tax.tsv' % self.tmp
+        with open(self.tax_fp, 'w') as o:
+            o.write('Feature ID\tTaxon\n')
+            o.write('f1\tk__A; p__B; c__C\n')
+            o.write('f2\tk__A; p__B\n')
+            o.write('f3\tk__A; p__D; c__E\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_raref(self):
+        raref_pd = get_expected_raref_pd(self.tab_pd, ['s2', 's3'])
+        self.assertEqual(raref_pd.columns.tolist(), ['s2', 's3'])
+        self.assertEqual(raref_pd.index.tolist(), ['f1', 'f2', 'f3'])
+
+    def test_collapsed_taxon(self):
+        self.assertEqual(get_collapsed_taxon('k__A; p__B', 2), 'k__A;p__B')
+        self.assertEqual(get_collapsed_taxon('k__A; p__B', 3), 'k__A;p__B')
+        self.assertEqual(get_collapsed_taxon('k__A; p__B; c__C', 1), 'k__A')
+
+    def test_collapsed(self):
+        collapsed_pd = get_expected_collapsed_pd(self.tab_pd, self.tax_fp, 2, set())
+        self.assertEqual(collapsed_pd.index.tolist(), ['Unassigned', 'k__A;p__B', 'k__A;p__D'])
+        self.assertEqual(collapsed_pd.sparse.to_dense().loc['k__A;p__B'].tolist(), [1, 0, 7])
+        collapsed_pd = get_expected_collapsed_pd(self.tab_pd, self.tax_fp, 2, {'k__A;p__D', 'Unassigned'})
+        self.assertEqual(collapsed_pd.index.tolist(), ['k__A;p__B'])
+        self.assertEqual(collapsed_pd.columns.tolist(), ['s1', 's3'])
+
+    def test_planned_subset(self):
+        qza_subset = '%s/tab_raref2_sub_noDropout.qza' % self.tmp
+        cur_sh = io.StringIO()
+        raref_pd = get_expected_raref_pd(self.tab_pd, ['s2', 's3'])
+        write_filter_features(raref_pd, ['f1', 'f2'], 'tab_raref2.qza', qza_subset,
+                              'sub.meta', cur_sh, False, True)
+        # the counts of the table to come are not written at planning time
+        self.assertFalse(isfile('%s/tab_raref2_sub_noDropout.tsv' % self.tmp))
+        self.assertIn('qiime feature-table filter-features', cur_sh.getvalue())
+        self.assertIn('--i-table tab_raref2.qza', cur_sh.getvalue())
+        self.assertIn('--p-no-filter-empty-samples', cur_sh.getvalue())
+
+
+
+class FeaturesSubsetTests(unittest.TestCase):
+
+    def setUp(self):
+        self.features = pd.Index(['AA', 'ab', 'ba', 'x1'])
+
+    def test_single_pattern(self):
+        self.assertEqual(get_features_subset(self.features, ['^a', '1$']), ['AA', 'ab', 'x1'])
+
+    def test_backreferences_and_flags(self):
+        # searched one by one: the references point to the regex's own groups
+        self.assertEqual(get_features_subset(self.features, [r'x', r'(a)\1']), ['AA', 'x1'])
+        self.assertEqual(get_features_subset(self.features, [r'(b)a', r'(a)\1']), ['AA', 'ba'])
+        self.assertEqual(get_features_subset(self.features, ['(?s)b.', 'x']), ['ba', 'x1'])
+
+    def test_memo_by_table(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            tsv = '%s/tab.tsv' % tmp
+            with open(tsv, 'w') as o:
+                o.write('table')
+            self.assertEqual(get_features_subset(self.features, ['b'], tsv), ['ab', 'ba'])
+            self.assertEqual(get_features_subset(pd.Index([]), ['b'], tsv), ['ab', 'ba'])
+            # another table content, another result
+            with open(tsv, 'w') as o:
+                o.write('other table')
+            self.assertEqual(get_features_subset(pd.Index(['b']), ['b'], tsv), ['b'])
+        finally:
+            SUBSETS.clear()
+            shutil.rmtree(tmp)
+
+
+class ReadPdsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.tsv = '%s/tab_raref2.tsv' % self.tmp
+        self.meta = '%s/meta_raref2.tsv' % self.tmp
+        with open(self.tsv, 'w') as o:
+            o.write('#OTU ID\ts1\ts3\nf1\t1\t0\nf2\t1\t2\n')
+        with open(self.meta, 'w') as o:
+            o.write('#SampleID\tvar\ns1\ta\ns2\tb\ns3\ta\n')
+        READ_PDS.clear()
+
+    def tearDown(self):
+        READ_PDS.clear()
+        shutil.rmtree(self.tmp)
+
+    def test_on_demand(self):
+        tab_pd, meta_pd = get_read_pds([self.tsv, self.meta])
+        self.assertEqual(tab_pd.shape, (2, 2))
+        self.assertEqual(meta_pd.sample_name.tolist(), ['s1', 's2', 's3'])
+        self.assertIs(get_read_pds([self.tsv, self.meta])[0], tab_pd)
+        frames = [tab_pd, meta_pd]
+        self.assertIs(get_read_pds(frames)[1], meta_pd)
+        release_read_pds([[self.tsv, self.meta], frames])
+        self.assertEqual(READ_PDS, {})
+        self.assertIsNot(get_read_pds([self.tsv, self.meta])[0], tab_pd)
+
+    def test_release_kept(self):
+        get_read_pds([self.tsv, self.meta])
+        raref_tsv = '%s/tab_raref3.tsv' % self.tmp
+        READ_PDS[raref_tsv] = None
+        release_read_pds([[self.tsv, self.meta], [raref_tsv, self.meta]], [[self.tsv, self.meta]])
+        self.assertEqual(sorted(READ_PDS), [self.meta, self.tsv])
+
+    def test_raref_tab_meta(self):
+        tab_pd, meta_pd = get_raref_tab_meta_pds(self.meta, self.tsv)
+        self.assertEqual(meta_pd.sample_name.tolist(), ['s1', 's3'])
+        self.assertIn(self.tsv, READ_PDS)
+        self.assertNotIn(self.meta, READ_PDS)
+        # the callers keep the paths: the metadata file holds the subset
+        self.assertIs(get_read_pds([self.tsv, self.meta])[0], tab_pd)
+        self.assertEqual(get_read_pds([self.tsv, self.meta])[1].sample_name.tolist(), ['s1', 's3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
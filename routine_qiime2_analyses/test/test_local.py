@@ -0,0 +1,149 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from routine_qiime2_analyses._routine_q2_local import (
+    get_local_log, get_local_resources, run_local, write_local_header)
+from routine_qiime2_analyses._routine_q2_io_utils import simple_chunks, write_main_sh
+
+
+class RunLocalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.trace = '%s/trace.txt' % self.tmp
+        self.logs = '%s/logs' % self.tmp
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_script(self, name, procs=1, mem='1', ret=0, sleep=0.2, folder='jobs/beta'):
+        script = '%s/%s/%s.sh' % (self.tmp, folder, name)
+        if not os.path.isdir(os.path.dirname(script)):
+            os.makedirs(os.path.dirname(script))
+        with open(script, 'w') as o:
+            o.write('echo start %s >> %s\n' % (name, self.trace))
+            o.write('sleep %s\n' % sleep)
+            o.write('echo end %s >> %s\n' % (name, self.trace))
+            o.write('exit %s\n' % ret)
+        write_local_header(script, '', '1', str(procs), mem, 'mb', '1')
+        return script
+
+    def write_launcher(self, name, groups):
+        launcher = '%s/%s.sh' % (self.tmp, name)
+        with open(launcher, 'w') as o:
+            for group in groups:
+                for script in group:
+                    o.write('sh %s\n' % script)
+                o.write('wait\n')
+        return launcher
+
+    def get_trace(self):
+        with open(self.trace) as f:
+            return [x.split() for x in f]
+
+    def get_max_concurrent(self):
+        running, max_running = 0, 0
+        for event, _ in self.get_trace():
+            running += 1 if event == 'start' else -1
+            max_running = max(running, max_running)
+        return max_running
+
+    def test_resources(self):
+        resources = get_local_resources(self.write_script('a', procs=4, mem='2'))
+        self.assertEqual(resources, {'env': '', 'procs': 4, 'mem': 2.})
+
+    def test_procs_tokens(self):
+        scripts = [self.write_script(x, procs=2) for x in 'abc']
+        run_local((self.write_launcher('l', [scripts]),), 4, 1, self.logs)
+        self.assertEqual(self.get_max_concurrent(), 2)
+        os.remove(self.trace)
+        run_local((self.write_launcher('l', [scripts]),), 3, 1, self.logs)
+        self.assertEqual(self.get_max_concurrent(), 1)
+
+    def test_mem_tokens(self):
+        scripts = [self.write_script(x, mem='600') for x in 'abc']
+        run_local((self.write_launcher('l', [scripts]),), 4, 1, self.logs)
+        self.assertEqual(self.get_max_concurrent(), 1)
+
+    def test_too_large_runs_alone(self):
+        scripts = [self.write_script('a', procs=8), self.write_script('b')]
+        exit_codes = run_local((self.write_launcher('l', [scripts]),), 2, 1, self.logs)
+        self.assertEqual(exit_codes, dict((x, 0) for x in scripts))
+        self.assertEqual(self.get_max_concurrent(), 1)
+
+    def test_groups_in_order(self):
+        first = [self.write_script(x, sleep=0.3) for x in 'ab']
+        second = [self.write_script('c', sleep=0)]
+        run_local((self.write_launcher('l', [first, second]),), 4, 1, self.logs)
+        self.assertEqual(self.get_trace()[-2:], [['start', 'c'], ['end', 'c']])
+
+    def test_failure_exit(self):
+        failed = self.write_script('a', ret=3)
+        slow = self.write_script('b', sleep=0.6)
+        pending = self.write_script('c', sleep=0)
+        launchers = (self.write_launcher('l1', [[failed, slow, pending]]),
+                     self.write_launcher('l2', [[self.write_script('d')]]))
+        exit_codes = run_local(launchers, 2, 1, self.logs)
+        # the running script is waited for, the others are not started
+        self.assertEqual(exit_codes, {failed: 3, slow: 0})
+        self.assertEqual(sorted(x[1] for x in self.get_trace()), ['a', 'a', 'b', 'b'])
+
+    def test_logs_per_job_folder(self):
+        scripts = [self.write_script('run', folder='jobs/beta/chunks'),
+                   self.write_script('run', folder='jobs/alpha/chunks')]
+        self.assertEqual(get_local_log(scripts[0], self.logs), '%s/beta_chunks_run.log' % self.logs)
+        run_local((self.write_launcher('l', [scripts]),), 2, 1, self.logs)
+        self.assertEqual(sorted(os.listdir(self.logs)), ['alpha_chunks_run.log', 'beta_chunks_run.log'])
+        self.assertEqual(get_local_log('%s/x/run.sh' % self.tmp, self.logs), '%s/x_run.log' % self.logs)
+
+
+class LocalChunksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.scripts = []
+        for name in 'abc':
+            script = '%s/run_%s.sh' % (self.tmp, name)
+            with open(script, 'w') as o:
+                o.write('qiime %s\n' % name)
+            self.scripts.append(script)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_simple_chunks_resources(self):
+        run_sh = '%s/run.sh' % self.tmp
+        simple_chunks(run_sh, self.tmp, self.scripts, 'beta', 'prj', '4', '1', '6',
+                      '3', 'gb', 'qiime2-2020.2', '775', True, False, 2)
+        with open(run_sh) as f:
+            chunks = [x.split()[1] for x in f]
+        self.assertEqual(len(chunks), 2)
+        for chunk in chunks:
+            self.assertEqual(get_local_resources(chunk),
+                             {'env': 'qiime2-2020.2', 'procs': 6, 'mem': 3072.})
+
+    def test_main_sh_resources(self):
+        all_sh_pbs = {('a', '%s/chunk_a.sh' % self.tmp): self.scripts[:2],
+                      ('c', '%s/chunk_c.sh' % self.tmp): self.scripts[2:]}
+        main_sh = write_main_sh(self.tmp, 'permanova', all_sh_pbs, 'prj', '4', '2', '1',
+                                '500', 'mb', 'qiime2-2020.2', '775', True, False, None)
+        with open(main_sh) as f:
+            chunks = [x.split()[1] for x in f]
+        self.assertEqual(chunks, ['%s/chunk_a.sh' % self.tmp, '%s/chunk_c.sh' % self.tmp])
+        for chunk in chunks:
+            self.assertEqual(get_local_resources(chunk),
+                             {'env': 'qiime2-2020.2', 'procs': 2, 'mem': 500.})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from os.path import dirname, isdir, isfile
+
+from routine_qiime2_analyses._routine_q2_metadata import (
+    CASES, get_meta_column_index, get_stored_meta_pd, init_cases, write_case_meta, write_meta_pd)
+from routine_qiime2_analyses._routine_q2_cmds import get_new_meta_pd
+
+
+def parse_meta(meta, rep_col):
+    return pd.read_table(meta, dtype={rep_col: str})
+
+
+class MetaColumnIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.meta = '%s/meta.tsv' % self.tmp
+        pd.DataFrame({'sample_name': ['s1', 's2', 's3'], 'var': ['a', 'b', 'a']}).to_csv(
+            self.meta, index=False, sep='\t')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_indexed(self):
+        meta_pd = get_stored_meta_pd(self.meta, 'sample_name', parse_meta)
+        column_index = get_meta_column_index(meta_pd, 'var')
+        self.assertEqual(column_index['factors'], {'a', 'b'})
+        self.assertEqual(column_index['rows']['a'].tolist(), [0, 2])
+        meta_pd = meta_pd.set_index('sample_name')
+        self.assertIs(get_meta_column_index(meta_pd, 'var'), column_index)
+
+    def test_same_shape_not_indexed(self):
+        meta_pd = get_stored_meta_pd(self.meta, 'sample_name', parse_meta)
+        self.assertIsNone(get_meta_column_index(meta_pd.iloc[::-1], 'var'))
+        self.assertIsNone(get_meta_column_index(meta_pd.set_axis(meta_pd.index + 1), 'var'))
+        self.assertIsNone(get_meta_column_index(meta_pd.set_index('sample_name').iloc[::-1], 'var'))
+        meta_pd['var'] = ['b', 'b', 'a']
+        self.assertIsNone(get_meta_column_index(meta_pd, 'var'))
+
+
+class WriteMetaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.meta = '%s/cases/meta.tsv' % self.tmp
+        self.meta_pd = pd.DataFrame({'sample_name': ['s1', 's2'], 'var': ['a', 'b']})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_unchanged_not_rewritten(self):
+        write_meta_pd(self.meta, self.meta_pd)
+        os.utime(self.meta, ns=(0, 0))
+        write_meta_pd(self.meta, self.meta_pd.copy())
+        self.assertEqual(os.stat(self.meta).st_mtime_ns, 0)
+        write_meta_pd(self.meta, self.meta_pd.iloc[:1])
+        self.assertNotEqual(os.stat(self.meta).st_mtime_ns, 0)
+        self.assertEqual(pd.read_table(self.meta).shape, (1, 2))
+
+
+class WriteCaseMetaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.meta = '%s/metadata/meta.tsv' % self.tmp
+        os.makedirs(dirname(self.meta))
+        pd.DataFrame({'sample_name': ['s1', 's2', 's3'], 'var': ['a', 'b', 'a']}).to_csv(
+            self.meta, index=False, sep='\t')
+        self.new_meta = '%s/out/case.meta' % self.tmp
+
+    def tearDown(self):
+        CASES['folder'] = ''
+        shutil.rmtree(self.tmp)
+
+    def get_case_pd(self):
+        meta_pd = get_stored_meta_pd(self.meta, 'sample_name', parse_meta)
+        return get_new_meta_pd(meta_pd.set_index('sample_name'), 'var_a', 'var', ['a'])
+
+    def test_shared_in_output_tree(self):
+        init_cases(self.tmp)
+        case_meta = write_case_meta(self.new_meta, self.get_case_pd())
+        self.assertEqual(dirname(case_meta), '%s/qiime/cases' % self.tmp)
+        self.assertFalse(isdir('%s/metadata/cases' % self.tmp))
+        self.assertEqual(write_case_meta(self.new_meta, self.get_case_pd()), case_meta)
+        self.assertEqual(pd.read_table(case_meta)['sample_name'].tolist(), ['s1', 's3'])
+
+    def test_no_output_tree(self):
+        self.assertEqual(write_case_meta(self.new_meta, self.get_case_pd()), self.new_meta)
+        self.assertTrue(isfile(self.new_meta))
+
+
+if __name__ == '__main__':
+    unittest.main()
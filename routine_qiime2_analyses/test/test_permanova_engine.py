@@ -0,0 +1,109 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import sys
+import shutil
+import tempfile
+import unittest
+import pkg_resources
+import numpy as np
+import skbio
+from scipy.spatial.distance import pdist, squareform
+from skbio.stats.distance import anosim, permanova, permdisp
+
+RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+sys.path.insert(0, RESOURCES)
+
+from dm_store import write_store
+from permanova_engine import (GENERATORS, PERMUTATIONS, get_anosim_stats, get_permanova_stats,
+                              get_permdisp_stats, get_permutations, main, run_test)
+from sequential_perms import read_p_value
+
+
+class PermanovaEngineTests(unittest.TestCase):
+    """The engine's tests against scikit-bio's, on the same permutations."""
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.labels = np.array([0, 1, 2] * 5)
+        self.data = np.random.random((15, 6)) + self.labels[:, None] * 0.1
+        self.square = squareform(pdist(self.data))
+        self.ids = ['s%s' % x for x in range(15)]
+        self.dm = skbio.DistanceMatrix(self.square, ids=self.ids)
+        PERMUTATIONS.clear()
+        GENERATORS.clear()
+
+    def check_skbio(self, get_stats, skbio_test, permutations=199):
+        stat, p_value, done = run_test(get_stats, self.labels, [permutations], 0.05)
+        skbio_stat = skbio_test(self.dm, self.labels, permutations=0)['test statistic']
+        self.assertAlmostEqual(stat, skbio_stat)
+        perm_stats = np.array([
+            skbio_test(self.dm, self.labels[perm], permutations=0)['test statistic']
+            for perm in get_permutations(len(self.labels), permutations)])
+        self.assertEqual(done, permutations)
+        self.assertAlmostEqual(p_value, ((perm_stats >= skbio_stat).sum() + 1) / (permutations + 1))
+
+    def test_permanova(self):
+        self.check_skbio(get_permanova_stats(self.square, self.labels, 3, 2), permanova)
+
+    def test_anosim(self):
+        self.check_skbio(get_anosim_stats(self.square, self.labels, 3, 2), anosim)
+
+    def test_seeded_permutations(self):
+        perms = get_permutations(15, 30)
+        PERMUTATIONS.clear()
+        GENERATORS.clear()
+        np.random.seed(1)
+        np.testing.assert_array_equal(get_permutations(15, 10), perms[:10])
+        np.testing.assert_array_equal(get_permutations(15, 30), perms)
+        self.assertTrue((np.sort(perms, 1) == np.arange(15)).all())
+
+    def test_permdisp(self):
+        self.check_skbio(get_permdisp_stats(self.square, self.labels, 3, 2), permdisp, 49)
+
+    def test_permdisp_stages(self):
+        # each stage only adds its permutations to those of the previous stage
+        get_stats = get_permdisp_stats(self.square, self.labels, 3, 1)
+        rows = []
+        counted = lambda label_rows: rows.append(len(label_rows)) or get_stats(label_rows)
+        stat, p_value, done = run_test(counted, self.labels, [19, 49], 0.5)
+        self.assertEqual((rows, done), ([1, 19, 30], 49))
+
+    def test_sequential_stops_once_decided(self):
+        data = np.random.random((15, 6)) + self.labels[:, None] * 10
+        get_stats = get_permanova_stats(squareform(pdist(data)), self.labels, 3, 1)
+        stat, p_value, done = run_test(get_stats, self.labels, [99, 999, 9999], 0.05)
+        # p-value of 0.01 after 99 permutations is not decided at 99% confidence
+        self.assertEqual(done, 999)
+        self.assertAlmostEqual(p_value, 0.001)
+
+    def test_missing_column_is_skipped(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            dm_fp = '%s/dm_DM.qza' % tmp
+            write_store(dm_fp, self.square, self.ids)
+            meta = '%s/meta.tsv' % tmp
+            with open(meta, 'w') as o:
+                o.write('sample_name\tgroup\n')
+                for sample, label in zip(self.ids, self.labels):
+                    o.write('%s\tg%s\n' % (sample, label))
+            sys.argv = ['permanova_engine.py', '--i-distance-matrix', dm_fp,
+                        '--test', meta, 'missing', 'permanova', '%s/missing.html' % tmp,
+                        '--test', meta, 'group', 'permanova', '%s/group.html' % tmp,
+                        '--p-permutations', '99']
+            self.assertEqual(main(), 1)
+            with open('%s/group.html' % tmp) as f:
+                self.assertIn('PERMANOVA', f.read())
+            # read as the html exported from qiime2 by the summary step
+            self.assertLess(read_p_value('%s/group.html' % tmp), 1)
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
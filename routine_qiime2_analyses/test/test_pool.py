@@ -0,0 +1,64 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import sys
+import time
+import unittest
+from contextlib import redirect_stdout
+
+from routine_qiime2_analyses._routine_q2_pool import POOL, init_pool, run_pool
+
+
+def plan(tdx, delay):
+    time.sleep(delay)
+    print('task %s' % tdx)
+    return tdx * 10
+
+
+def plan_exit(tdx):
+    if tdx == 1:
+        print('exit %s' % tdx)
+        sys.exit(3)
+    return tdx
+
+
+class PoolTests(unittest.TestCase):
+
+    def tearDown(self):
+        init_pool()
+
+    def test_serial(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            results = run_pool(plan, [(0, 0), (1, 0)])
+        self.assertEqual(results, [0, 10])
+        self.assertEqual(out.getvalue(), 'task 0\ntask 1\n')
+
+    def test_task_order(self):
+        init_pool(2)
+        tasks = [(0, 0.2), (1, 0), (2, 0.1), (3, 0)]
+        out = io.StringIO()
+        with redirect_stdout(out):
+            results = run_pool(plan, tasks, ['a', 'b', 'a', 'c'])
+        self.assertEqual(results, [0, 10, 20, 30])
+        self.assertEqual(out.getvalue(), 'task 0\ntask 1\ntask 2\ntask 3\n')
+        self.assertEqual(POOL['tasks'], [])
+
+    def test_exit(self):
+        init_pool(2)
+        out = io.StringIO()
+        with redirect_stdout(out):
+            with self.assertRaises(SystemExit) as e:
+                run_pool(plan_exit, [(0,), (1,), (2,)])
+        self.assertEqual(e.exception.code, 3)
+        self.assertEqual(out.getvalue(), 'exit 1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
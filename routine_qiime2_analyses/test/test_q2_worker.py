@@ -0,0 +1,55 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import sys
+import unittest
+import pkg_resources
+
+RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+sys.path.insert(0, RESOURCES)
+
+from q2_worker import get_blocks, split_block
+
+ECHO = ['echo "qiime diversity beta \\\n', '\n', '  --o-distance-matrix dm.qza"\n']
+BETA = ['qiime diversity beta \\\n', '  --i-table "my tab.qza" \\\n', '  --o-distance-matrix dm.qza\n']
+STATUS = ['q2_status $? 0123abcd\n']
+
+
+class SplitBlockTests(unittest.TestCase):
+
+    def test_qiime_command(self):
+        echos, args, status = split_block(ECHO + BETA + STATUS)
+        self.assertEqual(echos, ECHO)
+        self.assertEqual(args, ['qiime', 'diversity', 'beta', '--i-table', 'my tab.qza',
+                                '--o-distance-matrix', 'dm.qza'])
+        self.assertEqual(status, STATUS)
+
+    def test_no_echo_nor_status(self):
+        echos, args, status = split_block(BETA)
+        self.assertEqual((echos, args[:3], status), ([], ['qiime', 'diversity', 'beta'], []))
+
+    def test_not_qiime(self):
+        self.assertIsNone(split_block(['mkdir -p out\n']))
+        self.assertIsNone(split_block(['echo "start"\n', 'rm dm.qza\n']))
+
+    def test_shell_characters(self):
+        self.assertIsNone(split_block(['qiime tools export --input-path dm.qza > log\n']))
+        self.assertIsNone(split_block(['qiime tools export --input-path $dm\n']))
+        self.assertIsNone(split_block(['qiime tools export --input-path dm.qza; ls\n']))
+
+    def test_several_commands(self):
+        self.assertIsNone(split_block(BETA + BETA))
+        self.assertIsNone(split_block(BETA + STATUS + BETA))
+
+    def test_blocks(self):
+        lines = ['\n'] + ECHO + BETA + STATUS + ['\n', '\n', 'mkdir -p out\n', '\n']
+        self.assertEqual(get_blocks(lines), [ECHO + BETA + STATUS, ['mkdir -p out\n']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from routine_qiime2_analyses._routine_q2_dag import DAG, init_dag, set_dag_stage
+from routine_qiime2_analyses._routine_q2_registry import (
+    REGISTRY, get_script_commands, normalize_command, register_script)
+
+BETA = 'qiime diversity beta \\\n  --i-table tab.qza \\\n  --o-distance-matrix dm.qza\n\n'
+ECHO = 'echo "qiime diversity beta \\\n\n  --o-distance-matrix dm.qza"\n\n'
+
+
+class RegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        REGISTRY['commands'] = {}
+        init_dag()
+
+    def tearDown(self):
+        REGISTRY['commands'] = {}
+        DAG['active'] = False
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        out_sh = os.path.join(self.tmp, name)
+        with open(out_sh, 'w') as sh:
+            sh.write(content)
+        return out_sh
+
+    def read(self, out_sh):
+        with open(out_sh) as f:
+            return f.read()
+
+    def test_normalize_command(self):
+        self.assertEqual(
+            normalize_command(BETA),
+            'qiime diversity beta --i-table tab.qza --o-distance-matrix dm.qza')
+
+    def test_blocks_with_quoted_empty_line(self):
+        blocks = get_script_commands((ECHO + BETA).splitlines(True))
+        self.assertEqual([''.join(x) for x in blocks], [ECHO, BETA])
+
+    def test_duplicate_within_script(self):
+        set_dag_stage('beta')
+        out_sh = self.write('b.sh', BETA + BETA)
+        register_script(out_sh)
+        self.assertEqual(self.read(out_sh), BETA)
+
+    def test_duplicate_from_ancestor_stage(self):
+        set_dag_stage('beta')
+        register_script(self.write('b.sh', BETA))
+        set_dag_stage('permanova')
+        out_sh = self.write('p.sh', ECHO + BETA)
+        register_script(out_sh)
+        self.assertEqual(self.read(out_sh), ECHO)
+
+    def test_duplicate_from_other_branch(self):
+        set_dag_stage('alpha')
+        register_script(self.write('a.sh', BETA))
+        set_dag_stage('permanova')
+        out_sh = self.write('p.sh', BETA)
+        register_script(out_sh)
+        self.assertEqual(self.read(out_sh), BETA)
+
+    def test_no_dag(self):
+        DAG['active'] = False
+        set_dag_stage('beta')
+        register_script(self.write('b.sh', BETA))
+        set_dag_stage('permanova')
+        out_sh = self.write('p.sh', BETA + BETA)
+        register_script(out_sh)
+        self.assertEqual(self.read(out_sh), BETA)
+
+
+if __name__ == '__main__':
+    unittest.main()
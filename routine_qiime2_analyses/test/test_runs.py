@@ -0,0 +1,111 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from routine_qiime2_analyses._routine_q2_runs import (
+    RUNS, adopt_command, apply_runs_journal, get_open_quote,
+    get_recorded_fingerprint, get_script_statements, get_status_fp, init_runs,
+    is_done, plan_command, record_script, start_runs_journal, stop_runs_journal,
+    write_runs)
+
+
+class StatementsTests(unittest.TestCase):
+
+    def test_open_quote(self):
+        self.assertEqual(get_open_quote('echo "\n'), '"')
+        self.assertEqual(get_open_quote('--o-x a.qza"\n', '"'), '')
+        self.assertEqual(get_open_quote('echo "it\'s"\n'), '')
+        self.assertEqual(get_open_quote('ls # it\'s\n'), '')
+        self.assertEqual(get_open_quote('echo \\"\n'), '')
+
+    def test_statements(self):
+        lines = ['echo "\n', 'qiime a \\\n', '--o-x a.qza\n', '\n', 'rm b\n', '"\n',
+                 'qiime a \\\n', '--o-x a.qza\n', '\n', 'rm b\n']
+        self.assertEqual(get_script_statements(lines), [
+            lines[:6], lines[6:8], ['\n'], ['rm b\n']])
+
+
+class RecordScriptTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        RUNS.update({'active': False, 'recorded': {}, 'planned': {}, 'to_write': {}, 'adopted': {}})
+        init_runs(self.tmp, 'test')
+        self.out = '%s/out' % self.tmp
+        os.makedirs(self.out)
+        self.script = '%s/run.sh' % self.tmp
+        with open(self.script, 'w') as o:
+            o.write('echo "false \\\n--o-x %s/x.qza"\n' % self.out)
+            o.write('false \\\n--o-x %s/x.qza\n' % self.out)
+            o.write('touch %s/y.txt\n' % self.out)
+            o.write('rm -f %s/tmp.qza\n\n' % self.out)
+        for output in ['%s/x.qza' % self.out, '%s/y.txt' % self.out]:
+            plan_command((output,), [], (), 'fp')
+
+    def tearDown(self):
+        RUNS['active'] = False
+        shutil.rmtree(self.tmp)
+
+    def test_status_per_command(self):
+        record_script(self.script, '1', '1', '1', 'gb', '1')
+        write_runs()
+        subprocess.call(['bash', self.script])
+        self.assertTrue(os.path.isfile(get_status_fp(self.script)))
+        init_runs(self.tmp, 'test')
+        self.assertEqual(RUNS['recorded']['%s/x.qza' % self.out], ('fp', 'failed'))
+        self.assertEqual(RUNS['recorded']['%s/y.txt' % self.out], ('fp', 'succeeded'))
+        self.assertTrue(is_done(('%s/y.txt' % self.out,), 'fp'))
+        # answered from the manifest only
+        os.remove('%s/y.txt' % self.out)
+        self.assertTrue(is_done(('%s/y.txt' % self.out,), 'fp'))
+        self.assertFalse(is_done(('%s/y.txt' % self.out,), 'fp2'))
+        self.assertEqual(get_recorded_fingerprint('%s/y.txt' % self.out), 'fp')
+        self.assertEqual(get_recorded_fingerprint('%s/x.qza' % self.out), '')
+
+    def test_rewritten_script_resets_status(self):
+        record_script(self.script, '1', '1', '1', 'gb', '1')
+        subprocess.call(['bash', self.script])
+        plan_command(('%s/y.txt' % self.out,), [], (), 'fp2')
+        record_script(self.script, '1', '1', '1', 'gb', '1')
+        self.assertFalse(os.path.isfile(get_status_fp(self.script)))
+        with open(self.script) as f:
+            self.assertEqual(len([x for x in f if x.startswith('q2_status $?')]), 1)
+
+    def test_adopted(self):
+        adopt_command(('%s/z.qza' % self.out,), [], (), 'fp')
+        record_script(self.script, '1', '1', '1', 'gb', '1')
+        write_runs()
+        self.assertTrue(is_done(('%s/z.qza' % self.out,), 'fp'))
+        adopt_command(('%s/y.txt' % self.out,), [], (), 'fp3')
+        write_runs()
+        init_runs(self.tmp, 'test')
+        self.assertEqual(RUNS['recorded']['%s/y.txt' % self.out], ('fp3', 'succeeded'))
+        self.assertEqual(RUNS['recorded']['%s/z.qza' % self.out], ('fp', 'succeeded'))
+
+    def test_journal(self):
+        start_runs_journal()
+        self.assertEqual(get_recorded_fingerprint('%s/x.qza' % self.out), 'fp')
+        plan_command(('%s/z.qza' % self.out,), [], (), 'fp')
+        record_script(self.script, '1', '1', '1', 'gb', '1')
+        journal = stop_runs_journal()
+        self.assertEqual(sorted(journal[0]), ['%s/z.qza' % self.out])
+        self.assertEqual(sorted(journal[1]), ['%s/x.qza' % self.out, '%s/y.txt' % self.out])
+        RUNS['planned'] = {'%s/x.qza' % self.out: {}, '%s/y.txt' % self.out: {}}
+        RUNS['to_write'] = {}
+        apply_runs_journal(journal)
+        self.assertEqual(sorted(RUNS['planned']), ['%s/z.qza' % self.out])
+        self.assertEqual(len(RUNS['to_write']), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import pkg_resources
+
+from routine_qiime2_analyses._routine_q2_sequential import (
+    get_permutations_increments, get_permutations_stages, init_sequential, sequential_mode)
+
+RESOURCES = pkg_resources.resource_filename("routine_qiime2_analyses", "resources")
+sys.path.insert(0, RESOURCES)
+
+from sequential_perms import get_interval, is_decided, main
+
+HTML = '<table>\n<tr>\n<th>test statistic</th>\n<td>1.52</td>\n</tr>\n' \
+       '<tr>\n<th>Permutations</th>\n<td>%s</td>\n</tr>\n' \
+       '<tr>\n<th>p-value</th>\n<td>%s</td>\n</tr>\n</table>\n'
+
+
+class SequentialTests(unittest.TestCase):
+
+    def tearDown(self):
+        init_sequential()
+
+    def test_init(self):
+        init_sequential(None)
+        self.assertFalse(sequential_mode())
+        init_sequential(9999)
+        self.assertTrue(sequential_mode())
+
+    def test_stages(self):
+        for max_permutations, stages in [
+                (150, [150]),
+                (999, [99, 999]),
+                (5000, [99, 999, 5000]),
+                (100000, [99, 999, 9999, 100000])]:
+            init_sequential(max_permutations)
+            self.assertEqual(get_permutations_stages(), stages)
+            self.assertEqual(sum(get_permutations_increments()), max_permutations)
+
+
+class SequentialPermsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.html = os.path.join(self.tmp, 'index.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_html(self, p_value, permutations=99):
+        with open(self.html, 'w') as o:
+            o.write(HTML % (permutations, p_value))
+
+    def test_interval(self):
+        for greater, permutations in [(0, 99), (10, 999), (500, 999)]:
+            low, high = get_interval(greater, permutations)
+            self.assertLess(low, (greater + 1) / (permutations + 1.))
+            self.assertGreater(high, (greater + 1) / (permutations + 1.))
+        self.assertLess(get_interval(0, 9999)[1], get_interval(0, 999)[1])
+
+    def test_decided(self):
+        self.assertFalse(is_decided(0, 99, 0.05))
+        self.assertTrue(is_decided(0, 999, 0.05))
+        self.assertTrue(is_decided(50, 99, 0.05))
+        self.assertFalse(is_decided(49, 999, 0.05))
+
+    def test_main(self):
+        self.write_html(0.001)
+        self.assertEqual(main(self.html, 999, 0.05, 9999), 0)
+        self.write_html(0.01)
+        self.assertEqual(main(self.html, 99, 0.05, 9999), 1)
+        self.assertEqual(main(self.html, 9999, 0.05, 9999), 0)
+
+    def test_main_counts(self):
+        counts = os.path.join(self.tmp, 'index.perms')
+        # 1 and 9 permuted statistics >= the statistic, in 99 then 900 permutations
+        self.write_html(0.02)
+        self.assertEqual(main(self.html, 99, 0.05, 9999, counts), 1)
+        self.write_html(0.011, 900)
+        self.assertEqual(main(self.html, 900, 0.05, 9999, counts), 0)
+        with open(counts) as f:
+            self.assertEqual(f.read(), '10\t999\n')
+        with open(self.html) as f:
+            self.assertEqual(f.read(), HTML % (999, 0.011))
+
+    def test_main_no_p_value(self):
+        self.assertEqual(main(self.html, 99, 0.05, 999), 2)
+        with open(self.html, 'w') as o:
+            o.write('<table></table>\n')
+        self.assertEqual(main(self.html, 99, 0.05, 999), 2)
+        # including at the last stage
+        self.assertEqual(main(self.html, 999, 0.05, 999), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+import pkg_resources
+
+from routine_qiime2_analyses._routine_q2_xpbs import (
+    XPBS, call_xpbs, init_xpbs, write_pbs_batch, xpbs_call)
+
+PBS = pkg_resources.resource_filename("routine_qiime2_analyses", "test/files/pbs")
+
+
+class XpbsTests(unittest.TestCase):
+    """The torque scripts rendered in-process (--no-xpbs)."""
+
+    def setUp(self):
+        XPBS['active'] = False
+        XPBS['batch'] = {}
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        XPBS['batch'] = {}
+        shutil.rmtree(self.tmp)
+
+    def render(self, *params):
+        out_pbs = '%s/rendered.pbs' % self.tmp
+        xpbs_call('%s/job.sh' % PBS, out_pbs, *params)
+        write_pbs_batch()
+        with open(out_pbs) as f:
+            return f.read()
+
+    def test_directives(self):
+        pbs = self.render('prj', 'qiime2-2020.2', '4', '2', '8', '6', 'GB', '775', True, None)
+        self.assertTrue(pbs.startswith('#!/bin/bash\n#PBS -N prj\n#PBS -V\n'))
+        for line in ['#PBS -l walltime=4:00:00', '#PBS -l nodes=2:ppn=8', '#PBS -l mem=6gb',
+                     'conda activate qiime2-2020.2', 'cd $PBS_O_WORKDIR']:
+            self.assertIn('\n%s\n' % line, pbs)
+        with open('%s/job.sh' % PBS) as f:
+            self.assertIn(f.read(), pbs)
+        # nothing that is not given to Xpbs
+        for line in ['umask', 'TMPDIR', 'mkdir', 'trap']:
+            self.assertNotIn(line, pbs)
+
+    def test_tmp(self):
+        pbs = self.render('prj', 'qiime2-2020.2', '4', '1', '1', '2', 'gb', '664', False, '/scratch/tmp')
+        self.assertIn('\nexport TMPDIR=/scratch/tmp\n', pbs)
+
+    @unittest.skipUnless(shutil.which('Xpbs'), 'Xpbs is not installed')
+    def test_xpbs_parity(self):
+        # byte-for-byte against the scripts written by Xpbs (the parameters
+        # allowed with --no-xpbs: not computing on scratch, default -chmod)
+        for params in [('prj', 'qiime2-2020.2', '4', '1', '8', '6', 'gb', '664', False, None),
+                       ('prj', 'qiime2-2020.2', '24', '2', '4', '500', 'mb', '664', False, None),
+                       ('prj', 'qiime2-2020.2', '1', '1', '1', '2', 'GB', '664', False, '/scratch/tmp')]:
+            xpbs_pbs = '%s/xpbs.pbs' % self.tmp
+            call_xpbs('%s/job.sh' % PBS, xpbs_pbs, *params)
+            with open(xpbs_pbs) as f:
+                self.assertEqual(self.render(*params), f.read())
+
+    def test_batch(self):
+        params = ('prj', 'qiime2-2020.2', '4', '1', '8', '6', 'gb', '775', True, None)
+        out_sh = '%s/job.sh' % self.tmp
+        with open(out_sh, 'w') as o:
+            o.write('first\n')
+        xpbs_call(out_sh, '%s/a.pbs' % self.tmp, *params)
+        xpbs_call('%s/job.sh' % PBS, '%s/b.pbs' % self.tmp, *params)
+        with open(out_sh, 'w') as o:
+            o.write('second\n')
+        xpbs_call(out_sh, '%s/a.pbs' % self.tmp, *params)
+        self.assertFalse(os.path.isfile('%s/a.pbs' % self.tmp))
+        write_pbs_batch()
+        self.assertEqual(XPBS['batch'], {})
+        with open('%s/a.pbs' % self.tmp) as f:
+            content = f.read()
+        self.assertIn('\nsecond\n', content)
+        self.assertNotIn('\nfirst\n', content)
+        self.assertTrue(os.path.isfile('%s/b.pbs' % self.tmp))
+
+
+class InitXpbsTests(unittest.TestCase):
+    """The default Xpbs mode, checking that Xpbs is installed and configured."""
+
+    def setUp(self):
+        XPBS['active'] = False
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.environ['PATH']
+        # only the folder of the "which" command, and that of a mock Xpbs
+        os.environ['PATH'] = '%s:%s' % (self.tmp, os.path.dirname(shutil.which('which')))
+
+    def tearDown(self):
+        XPBS['active'] = False
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmp)
+
+    def write_xpbs(self, first_line):
+        xpbs = '%s/Xpbs' % self.tmp
+        with open(xpbs, 'w') as o:
+            o.write('%s\n' % first_line)
+        os.chmod(xpbs, 0o755)
+
+    def check_exit(self):
+        with redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                init_xpbs()
+        self.assertFalse(XPBS['active'])
+
+    def test_not_installed(self):
+        self.check_exit()
+
+    def test_in_process(self):
+        init_xpbs(False)
+        self.assertFalse(XPBS['active'])
+
+    def test_in_process_needs_xpbs(self):
+        # no scratch nor permission change without Xpbs
+        for chmod, noloc in [('664', True), ('775', False)]:
+            with redirect_stdout(io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    init_xpbs(False, chmod, noloc)
+
+    def test_not_configured(self):
+        self.write_xpbs('$HOME/config.txt')
+        self.check_exit()
+
+    def test_configured(self):
+        self.write_xpbs('/home/user/config.txt')
+        init_xpbs()
+        self.assertTrue(XPBS['active'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -56,6 +56,7 @@ setup(
         "click",
         "pandas",
         "numpy",
+        "scipy",
         "scikit-bio",
         "pyyaml",
         "plotly==4.8.2",
@@ -75,6 +76,12 @@ setup(
             'resources/run_params.yml',
             'resources/spatial_autocorrelation_modeling.sh',
             'resources/summarize_permanovas.py',
+            'resources/q2_worker.py',
+            'resources/beta_engine.py',
+            'resources/dm_subsets.py',
+            'resources/dm_store.py',
+            'resources/permanova_engine.py',
+            'resources/sequential_perms.py',
             'resources/nestedness_graphs.py',
             'resources/nestedness_nodfs.py',
             'resources/wol_tree.nwk',